@@ -6,17 +6,21 @@ import math
 import re
 import cmath
 from decimal import Decimal
-import datetime
 import numpy as np
 import neuron
 from neuron import h
 #if change neuron_reduce function in test folder it will not update here... need to figure out how to import from test_neuron_reduce
-from test_neuron_reduce.subtree_reductor_func import (load_model, gather_subtrees, mark_subtree_sections_with_subtree_index, create_segments_to_mech_vals, 
-                                                 calculate_nsegs_from_lambda, create_sections_in_hoc, append_to_section_lists, calculate_subtree_q,
-                                                 type_of_point_process,synapse_properties_match,textify_seg_to_seg,
-                                                 Neuron)
-from neuron_reduce.reducing_methods import (_get_subtree_biophysical_properties, measure_input_impedance_of_subtree, find_lowest_subtree_impedance, 
-                                            find_space_const_in_cm, push_section, find_best_real_X)
+from test_neuron_reduce.subtree_reductor_func import (load_model, gather_subtrees, mark_subtree_sections_with_subtree_index, find_section_type, create_segments_to_mech_vals, 
+                                                 calculate_nsegs_from_lambda, create_sections_in_hoc, append_to_section_lists, set_cable_params, calculate_subtree_q,
+                                                 textify_seg_to_seg,
+                                                 SynapseMergeIndex, add_PP_properties_to_dict,
+                                                 handle_orphan_segments, Neuron)
+from test_neuron_reduce.point_process_params import PointProcessParams, clone_point_processes
+from test_neuron_reduce.reducing_methods import (_get_subtree_biophysical_properties, find_space_const_in_cm, push_section,
+                                                 ImpedanceCache, find_best_real_X_batch)
+from test_neuron_reduce.cell_copy import copy_cell
+from test_neuron_reduce.netcon_registry import NetConRegistry
+from test_neuron_reduce import instrumentation
 # can replace Neuron class import with another python cell class
 
 h.load_file("stdrun.hoc")
@@ -29,9 +33,12 @@ CableParams = collections.namedtuple('CableParams',
 SynapseLocation = collections.namedtuple('SynapseLocation', 'subtree_index, section_num, x, section_type')
 
 logger = logging.getLogger(__name__)
+
 SOMA_LABEL = "soma"
 EXCLUDE_MECHANISMS = ('pas', 'na_ion', 'k_ion', 'ca_ion', 'h_ion', 'ttx_ion', )
+NOT_REDISTRIBUTED = -1  # netcon_assignment of the netcons of synapses that were not duplicated
 
+@instrumentation.profiled
 def cable_expander(original_cell,
                      sections_to_expand, 
                      furcations_x, 
@@ -44,6 +51,11 @@ def cable_expander(original_cell,
                      PP_params_dict=None,
                      mapping_type='impedance',
                      return_seg_to_seg=False,
+                     in_place=True,
+                     netcon_rng=None,
+                     stratify_netcons=False,
+                     netcon_assignment=None,
+                     collapse_branches=False,
                      ):
 
     '''
@@ -73,11 +85,34 @@ def cable_expander(original_cell,
                            original_number_of_segments*total_segments_manual
     return_seg_to_seg: if True the function will also return a textify version of the mapping
                        between the original segments to the reduced segments 
+    in_place: if False, the cell, synapses and netcons are copied (see
+              test_neuron_reduce.cell_copy) and the copies are expanded, so the
+              original model is left untouched
+    netcon_rng: the random generator choosing the branch of every NetCon of a
+                duplicated synapse - None for the global numpy RNG (np.random.seed),
+                a seed or a np.random.Generator
+    stratify_netcons: if True the NetCons of every synapse are split evenly
+                      among its copies (the counts differ by at most one)
+    netcon_assignment: the cell.netcon_assignment of an earlier expansion of
+                       the same model (e.g. loaded with np.load), replayed
+                       instead of drawing the branches of the NetCons again
+    collapse_branches: if True every expanded section gets one representative
+                       branch standing for its nbranches identical branches
+                       (see collapsed_branch_params), which keeps all the
+                       synapses and NetCons of the branches instead of
+                       duplicating them - exact for the symmetric part of the
+                       input, much cheaper to simulate. False builds the full
+                       tree (to validate the collapsed one against)
     Returns the new reduced cell, a list of the new synapses, and the list of
     the inputted netcons which now have connections with the new synapses.
+    cell.netcon_assignment holds the branch drawn for every NetCon (see
+    distribute_branch_synapses), to cache and replay.
+    cell.branch_multiplicity holds the number of branches every branch section
+    of each expanded section stands for (1 unless collapse_branches).
     Notes:
     1) The original cell instance, synapses and Netcons given as arguments are altered
-    by the function and cannot be used outside of it in their original context.
+    by the function and cannot be used outside of it in their original context
+    (unless in_place=False).
     2) Synapses are determined to be of the same type and mergeable if their reverse
     potential, tau1 and tau2 values are identical.
     3) Merged synapses are assigned a single new synapse object that represents them
@@ -91,6 +126,10 @@ def cable_expander(original_cell,
 
     if PP_params_dict is None:
         PP_params_dict = {}
+    if not in_place:
+        with instrumentation.stage('copy_cell'):
+            original_cell, synapses_list, netcons_list, section_map = copy_cell(original_cell, synapses_list, netcons_list)
+        sections_to_expand = [section_map[sec] for sec in sections_to_expand]
     h.init()
     
     model_obj_name = load_model(model_filename)
@@ -134,7 +173,7 @@ def cable_expander(original_cell,
         h.disconnect(sec=section_to_expand)
 
     # expanding the subtrees
-    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),"Branching the section using (d)3/2 and electrotonic length rule to preserve service area and electrical properties.")
+    logger.info("Branching the section using (d)3/2 and electrotonic length rule to preserve service area and electrical properties.")
     all_trunk_properties=[] #list of all trunk cable properties
     all_branch_properties=[] #list of all branch cable properties
     all_trunk_types=[]
@@ -143,6 +182,12 @@ def cable_expander(original_cell,
       all_trunk_properties.append(trunk_properties)
       all_branch_properties.append(branch_properties)
       all_trunk_types.append(trunk_type)
+    branch_multiplicity = [1] * len(nbranches)
+    if collapse_branches:
+      all_branch_properties = [collapsed_branch_params(branch_properties, nbranch)
+                               for branch_properties, nbranch in zip(all_branch_properties, nbranches)]
+      branch_multiplicity, nbranches = list(nbranches), [1] * len(nbranches)
+      logger.info("Collapsing the branches of every expanded section into one representative branch")
     trunk_nsegs = calculate_nsegs_from_lambda(all_trunk_properties)
     branch_nsegs = calculate_nsegs_from_lambda(all_branch_properties)
     
@@ -181,9 +226,10 @@ def cable_expander(original_cell,
                                                                                 subtrees_xs)
     
 
-    syn_to_netcon = get_syn_to_netcons(netcons_list) # dictionary mapping netcons to their synapse
+    syn_to_netcon = NetConRegistry(netcons_list, synapses_list) # maps synapses to their netcons and back, updated on every setpost below
+    impedance_cache = ImpedanceCache() # impedance of each section to expand is computed once and shared below
     
-    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),"Spreading synapses onto branches")
+    logger.info("Spreading synapses onto branches")
     
     new_synapses_list, subtree_ind_to_q = adjust_new_tree_synapses(
         num_of_subtrees,roots_of_subtrees,
@@ -198,28 +244,34 @@ def cable_expander(original_cell,
         original_cell,
         basals, apicals,
         cell,
-        reduction_frequency)
+        reduction_frequency,
+        impedance_cache)
     
-    print("PP_params_dict: ",PP_params_dict)
-    for synapse,params in PP_params_dict.items():
-      print(synapse,params)
-
     #check synapses_list with netcons_list
-    for netcon in netcons_list:
-       syn=netcon.syn()
-       if syn not in synapses_list:
-         print('Not on the list:',syn, netcon)
-
-    syn_to_netcon = get_syn_to_netcons(netcons_list) # dictionary mapping netcons to their synapse # re call to account for changes.. may need to adjust for efficiency
-    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),"duplicating branch 1 synapses onto the other branches and randomly distributing Netcons")
-    print("number of reduced synapses before duplicating synapses to branches:",len(new_synapses_list))
-    new_synapses_list=distribute_branch_synapses(branches,netcons_list,new_synapses_list,PP_params_dict,syn_to_netcon) #adjust synapses
-    print("number of reduced synapses after duplicating synapses to branches:",len(new_synapses_list))
-    syn_to_netcon = get_syn_to_netcons(netcons_list) # dictionary mapping netcons to their synapse
-    print("netcon mapping after expansion:",syn_to_netcon)
+    if logger.isEnabledFor(logging.WARNING):
+      listed_synapses = set(synapses_list)
+      for netcon in netcons_list:
+         syn=netcon.syn()
+         if syn not in listed_synapses:
+           logger.warning('%s of %s is not on the synapses list' % (syn, netcon))
+
+    logger.info("duplicating branch 1 synapses onto the other branches and randomly distributing Netcons")
+    logger.debug("number of reduced synapses before duplicating synapses to branches: %d" % len(new_synapses_list))
+    replay = netcon_assignment is not None
+    if replay:
+      netcon_assignment = np.asarray(netcon_assignment, dtype=int)
+      if netcon_assignment.shape != (len(netcons_list),):
+        raise ValueError('netcon_assignment has %s entries, there are %d netcons' % (netcon_assignment.shape, len(netcons_list)))
+    else:
+      netcon_assignment = np.full(len(netcons_list), NOT_REDISTRIBUTED, dtype=int)
+      if netcon_rng is not None:
+        netcon_rng = np.random.default_rng(netcon_rng)
+    new_synapses_list=distribute_branch_synapses(branches,netcons_list,new_synapses_list,PP_params_dict,syn_to_netcon,
+                                                 netcon_rng,stratify_netcons,netcon_assignment,replay) #adjust synapses
+    logger.debug("number of reduced synapses after duplicating synapses to branches: %d" % len(new_synapses_list))
     # create segment to segment mapping
-    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),"Mapping segments")
-    original_seg_to_reduced_seg, reduced_seg_to_original_seg, = create_seg_to_seg(
+    logger.info("Mapping segments")
+    original_index, expanded_index = create_seg_to_seg(
         original_cell,
         section_per_subtree_index,
         sections_to_expand,
@@ -231,19 +283,20 @@ def cable_expander(original_cell,
         subtree_ind_to_q,
         mapping_type,
         reduction_frequency,
-        trunks, branches)
+        trunks, branches,
+        all_expanded_sections,
+        impedance_cache)
 
     # copy active mechanisms
-    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),"Mapping mechanisms")
-    copy_dendritic_mech(original_seg_to_reduced_seg,
-                        reduced_seg_to_original_seg,
-                        apicals,
-                        basals,
+    logger.info("Mapping mechanisms")
+    copy_dendritic_mech(original_index,
+                        expanded_index,
                         segment_to_mech_vals, all_expanded_sections,
                         mapping_type)
     
     if return_seg_to_seg:
-        original_seg_to_reduced_seg_text = textify_seg_to_seg(original_seg_to_reduced_seg)
+        original_seg_to_reduced_seg_text = textify_seg_to_seg(
+            seg_to_seg_dict(original_index, expanded_index, sections_to_expand, all_expanded_sections))
 
     # Connect disconnected sections back to the soma
     if len(sections_to_keep) > 0:
@@ -253,11 +306,13 @@ def cable_expander(original_cell,
         else:
             sections_to_keep[i].connect(soma, soma_sections_to_keep_x[i])
             
-    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),"Deleting original model sections")
+    logger.info("Deleting original model sections")
     # Now we delete the original model sections
-    for section in sections_to_expand:
-        with push_section(section):
-            h.delete_section()
+    impedance_cache.invalidate()
+    with instrumentation.stage('delete_sections'):
+      for section in sections_to_expand:
+          with push_section(section):
+              h.delete_section()
     
     #now we add the sections to our list
     if cell.hoc_model.axon is not None:
@@ -291,7 +346,7 @@ def cable_expander(original_cell,
           elif soma_child_sec_type=='axon':
             axons.append(soma_child)
           else:
-            print('did not append',soma_child,'to a section list')
+            logger.warning('did not append %s to a section list' % soma_child)
             
           if soma_child.children() != []:
               for sec_child in soma_child.children(): #takes care of branches
@@ -304,9 +359,9 @@ def cable_expander(original_cell,
                 elif sec_child_sec_type=='axon':
                   axons.append(sec_child)
                 else:
-                  print('did not append',sec_child,'to a section list')
+                  logger.warning('did not append %s to a section list' % sec_child)
       else:
-        print('soma sec has no children')
+        logger.debug('soma sec has no children')
           # print(sec)
           
     for i,sec in enumerate(dends):
@@ -329,24 +384,20 @@ def cable_expander(original_cell,
 
     with push_section(cell.hoc_model.soma[0]):
         h.delete_section()
+    if not in_place:
+        cell.cell_copy = original_cell  # keeps the copied sections alive
+    cell.netcon_assignment = netcon_assignment
+    cell.branch_multiplicity = branch_multiplicity
     if return_seg_to_seg:
         return cell, new_synapses_list, netcons_list, original_seg_to_reduced_seg_text
     else:
         return cell, new_synapses_list, netcons_list
       
-def apply_params_to_section(name, type_of_sectionlist, instance_as_str, section, cable_params, nseg):
-    section.L = cable_params.length
-    section.diam = cable_params.diam
-    section.nseg = nseg
-
-    append_to_section_lists(name, type_of_sectionlist, instance_as_str)
-
-    section.insert('pas')
-    section.cm = cable_params.cm
-    section.g_pas = 1.0 / cable_params.rm
-    section.Ra = cable_params.ra
-    section.e_pas = cable_params.e_pas 
+def apply_params_to_section(name, type_of_sectionlist, instance, section, cable_params, nseg):
+    set_cable_params(section, cable_params, nseg)
+    append_to_section_lists(section, type_of_sectionlist, instance)
     
+@instrumentation.timed
 def expand_cable(section_to_expand, frequency, furcation_x, nbranch):
     '''expand a cylinder (cable) from the reduced_cell into one trunk and nbranch identical branch sections.
     The expansion is done by finding cable parameters of the trunk and branch.
@@ -387,9 +438,20 @@ def expand_cable(section_to_expand, frequency, furcation_x, nbranch):
     branch_params = CableParams(length=branch_L, diam=branch_diam_in_micron, space_const=branch_space_const_in_micron,
                                 cm=cm, rm=rm, ra=ra, e_pas=e_pas, electrotonic_length=branch_elec_L,
                                 type=sec_type, furcation_x=furcation_x)
-    print('branch_L:',branch_L,'|branch_diam:',branch_diam_in_micron,'|trunk_L:',trunk_L,'|trunk_diam:',trunk_diam)
+    logger.debug('branch_L: %s |branch_diam: %s |trunk_L: %s |trunk_diam: %s' % (branch_L, branch_diam_in_micron, trunk_L, trunk_diam))
     return trunk_params, branch_params, sec_type
+
+def collapsed_branch_params(branch_params, nbranch):
+    '''the cable params of one branch standing for nbranch identical branches that are driven alike.
+    Its membrane area is nbranch times larger (diam*nbranch, so the mechanism densities stay the same)
+    and so is its axial conductance to the trunk (Ra*nbranch, the axial conductance goes as diam**2/Ra).
+    The length, space constant and electrotonic length are those of a single branch.
+    For a linear cable, an input to any one of the branches reaches the trunk as the
+    same input to the collapsed branch would (the rest of it is antisymmetric among the branches)
+    '''
+    return branch_params._replace(diam=branch_params.diam*nbranch, ra=branch_params.ra*nbranch)
         
+@instrumentation.timed
 def create_dendritic_cell(soma_cable,
                         has_apical,
                         original_cell,
@@ -399,12 +461,13 @@ def create_dendritic_cell(soma_cable,
                         subtrees_xs):
     h("objref reduced_dendritic_cell")
     h("reduced_dendritic_cell = new " + model_obj_name + "()")
+    reduced_dendritic_cell = h.reduced_dendritic_cell
 
-    create_sections_in_hoc("soma", 1, "reduced_dendritic_cell")
+    create_sections_in_hoc("soma", 1, reduced_dendritic_cell)
 
     try: soma = original_cell.soma[0] if original_cell.soma.hname()[-1] == ']' else original_cell.soma
     except: soma = original_cell.soma
-    append_to_section_lists("soma[0]", "somatic", "reduced_dendritic_cell")
+    append_to_section_lists("soma[0]", "somatic", reduced_dendritic_cell)
     sec_type_list=[]
     trunk_sec_type_list = []
     kept_sec_type_list = []
@@ -445,7 +508,7 @@ def create_dendritic_cell(soma_cable,
       num_sec_type_for_this_unique_sec_type=sec_type_list.count(unique_sec_type)
       # print(unique_sec_type)
       # print(num_sec_type_for_this_unique_sec_type)
-      create_sections_in_hoc(unique_sec_type,num_sec_type_for_this_unique_sec_type,"reduced_dendritic_cell")
+      create_sections_in_hoc(unique_sec_type,num_sec_type_for_this_unique_sec_type,reduced_dendritic_cell)
       # print(len(h.reduced_dendritic_cell.apic))
       if unique_sec_type=='apic':
         apicals = [h.reduced_dendritic_cell.apic[i] for i in range(num_sec_type_for_this_unique_sec_type)]
@@ -477,7 +540,7 @@ def create_dendritic_cell(soma_cable,
           trunk_index=number_of_sections_in_basal_list # trunk index of basal list
           trunk_cable_params.sec_index_for_type=trunk_index
           # print('test: trunk_cable_params.sec_index_for_type:',trunk_cable_params.sec_index_for_type) #check is this works
-          apply_params_to_section("dend"+"[" + str(trunk_index) + "]", "basal", "reduced_dendritic_cell",  #apply params to trunk
+          apply_params_to_section("dend"+"[" + str(trunk_index) + "]", "basal", reduced_dendritic_cell,  #apply params to trunk
                                 basals[trunk_index], trunk_cable_params, trunk_nseg)
           basals[trunk_index].connect(soma, subtrees_xs[i], 0) #connect trunk to soma where it was previously connected
           trunk_sec_type_list_indices.append(trunk_index) #get list of trunk indices for trunk's respective sec_type_list (apic or dend)
@@ -488,7 +551,7 @@ def create_dendritic_cell(soma_cable,
           branches_for_trunk = [] # list of branches for this trunk
           for j in range(nbranch): #apply branch parameters to next nbranch sections
                     branch_index=number_of_sections_in_apical_list
-                    apply_params_to_section("dend"+"[" + str(branch_index) + "]", "basal", "reduced_dendritic_cell",  #apply params to branch
+                    apply_params_to_section("dend"+"[" + str(branch_index) + "]", "basal", reduced_dendritic_cell,  #apply params to branch
                                 basals[branch_index], branch_cable_params, branch_nseg)
                     basals[branch_index].connect(basals[trunk_index], 1, 0) # connect branch to distal end of trunk
                     number_of_sections_in_basal_list+=1
@@ -499,7 +562,7 @@ def create_dendritic_cell(soma_cable,
         elif trunk_sec_type=='apic': # apical
           #trunk
           trunk_index=number_of_sections_in_apical_list
-          apply_params_to_section("apic"+"[" + str(trunk_index) + "]", "apical", "reduced_dendritic_cell",  #apply params to trunk
+          apply_params_to_section("apic"+"[" + str(trunk_index) + "]", "apical", reduced_dendritic_cell,  #apply params to trunk
                                 apicals[trunk_index], trunk_cable_params, trunk_nseg)
           apicals[trunk_index].connect(soma, subtrees_xs[i], 0) #connect trunk to soma where it was previously connected
           trunk_sec_type_list_indices.append(trunk_index) #get list of trunk indices for trunk's respective sec_type_list (apic or dend)
@@ -510,7 +573,7 @@ def create_dendritic_cell(soma_cable,
           branches_for_trunk = []
           for j in range(nbranch): #apply branch parameters to next nbranch sections
                     branch_index=number_of_sections_in_apical_list
-                    apply_params_to_section("apic"+"[" + str(branch_index) + "]", "apical", "reduced_dendritic_cell", #apply params to branch
+                    apply_params_to_section("apic"+"[" + str(branch_index) + "]", "apical", reduced_dendritic_cell, #apply params to branch
                                 apicals[branch_index], branch_cable_params, branch_nseg)
                     apicals[branch_index].connect(apicals[trunk_index], 1, 0) # connect branch to distal end of trunk
                     number_of_sections_in_apical_list+=1
@@ -523,15 +586,15 @@ def create_dendritic_cell(soma_cable,
     for i in range(len(sections_to_keep)): #add kept sections to the section lists
       if kept_sec_type_list[i]=='apic':
         sec_index=number_of_sections_in_apical_list
-        append_to_section_lists("apic"+"[" + str(sec_index) + "]", "apical", "reduced_dendritic_cell")
+        append_to_section_lists("apic"+"[" + str(sec_index) + "]", "apical", reduced_dendritic_cell)
         number_of_sections_in_apical_list+=1
       elif kept_sec_type_list[i]=='dend':
         sec_index=number_of_sections_in_basal_list
-        append_to_section_lists("dend"+"[" + str(sec_index) + "]", "basal", "reduced_dendritic_cell")
+        append_to_section_lists("dend"+"[" + str(sec_index) + "]", "basal", reduced_dendritic_cell)
         number_of_sections_in_basal_list+=1
       elif kept_sec_type_list[i]=='axon':
         sec_index=number_of_sections_in_axonal_list
-        append_to_section_lists("axon"+"[" + str(sec_index) + "]", "axonal", "reduced_dendritic_cell")
+        append_to_section_lists("axon"+"[" + str(sec_index) + "]", "axonal", reduced_dendritic_cell)
         number_of_sections_in_axonal_list+=1
       else:
         raise(kept_sec_type_list[i],'is not "apic" , "dend" , "axon"')
@@ -542,6 +605,7 @@ def create_dendritic_cell(soma_cable,
     # cell.apic = apic
     return cell, basals, apicals, trunk_sec_type_list_indices, trunks, branches, all_expanded_sections, number_of_sections_in_apical_list,number_of_sections_in_basal_list, number_of_sections_in_axonal_list
 
+@instrumentation.timed
 def find_and_disconnect_sections_to_keep(soma,sections_to_expand):
     '''Searching for sections to keep, they can be a child of the soma or a parent of the soma.'''
     sections_to_keep, is_section_to_keep_soma_parent, soma_sections_to_keep_x  = [], [], []
@@ -570,10 +634,11 @@ def find_and_disconnect_sections_to_keep(soma,sections_to_expand):
 
     return sections_to_keep, is_section_to_keep_soma_parent, soma_sections_to_keep_x
   
+@instrumentation.timed
 def gather_cell_subtrees(roots_of_subtrees):
-    # dict that maps section indexes to the subtree index they are in: keys are
-    # string tuples: ("apic"/"basal", orig_section_index) , values are ints:
-    # subtree_instance_index
+    # dict that maps the sections to the subtree they are in: keys are the
+    # sections, values are SubtreeSection("apic"/"basal", section type,
+    # orig_section_index, subtree_instance_index)
     sections_to_delete = []
     section_per_subtree_index = {}
     mapping_sections_to_subtree_index = {}
@@ -605,169 +670,95 @@ def find_synapse_loc(synapse_or_segment, mapping_sections_to_subtree_index):
     if not isinstance(synapse_or_segment, neuron.nrn.Segment):
         synapse_or_segment = synapse_or_segment.get_segment()
 
-    x = synapse_or_segment.x
-
-    with push_section(synapse_or_segment.sec):
-        # extracts the section type ("soma", "apic", "dend") and the section number
-        # out of the section name
-        full_sec_name = h.secname()
-        sec_name_as_list = full_sec_name.split(".")
-        short_sec_name = sec_name_as_list[len(sec_name_as_list) - 1]
-        section_type = short_sec_name.split("[")[0]
-        section_num = re.findall(r'\d+', short_sec_name)[0]
-        # print('section_num: ',section_num)
-
     # finds the index of the subtree that this synapse belongs to using the
     # given mapping_sections_to_subtree_index which maps sections to the
-    # subtree indexes that they belong to
-    if section_type == "apic":
-        subtree_index = mapping_sections_to_subtree_index[("apic", section_num)]
-    elif section_type == "dend":
-        subtree_index = mapping_sections_to_subtree_index[("basal", section_num)]
-    else:  # somatic synapse
-        subtree_index, section_num, x = SOMA_LABEL, 0, 0
-
-    return SynapseLocation(subtree_index, int(section_num), x, section_type)
-def expand_synapse(cell_instance,
-                   synapse_location,
-                   on_basal,
-                   imp_obj,
-                   root_input_impedance,
-                   trunk_properties,branch_properties,furcation_x,
-                   q_subtree):
+    # subtree indexes that they belong to (see mark_subtree_sections_with_subtree_index)
+    subtree_section = mapping_sections_to_subtree_index.get(synapse_or_segment.sec)
+    if subtree_section is not None and subtree_section.section_type in ("apic", "dend"):
+        return SynapseLocation(subtree_section.subtree_index, subtree_section.section_num,
+                               synapse_or_segment.x, subtree_section.section_type)
+    # somatic synapse
+    subtree_index, section_num, x = SOMA_LABEL, 0, 0
+    section_type = find_section_type(synapse_or_segment.sec)
+
+    return SynapseLocation(subtree_index, section_num, x, section_type)
+
+def expand_synapses(impedance_table,
+                    sections,
+                    xs,
+                    trunk_properties, branch_properties, furcation_x,
+                    q_subtree):
     '''
-    Receives an instance of a cell, the location (section + relative
-    location(x)) of a synapse to be reduced, a boolean on_basal that is True if
-    the synapse is on a basal subtree, the number of segments in the reduced
-    cable that this synapse is in, an Impedance calculating Hoc object, the
-    input impedance at the root of this subtree, and the electrotonic length of
-    the reduced cable that represents the current subtree
-    (as a real and as a complex number) -
-    and maps the given synapse to its new location on the reduced cable
-    according to the NeuroReduce algorithm.  Returns the new "post-merging"
-    relative location of the synapse on the reduced cable (x, 0<=x<=1), that
-    represents the middle of the segment that this synapse is located at in the
-    new reduced cable.
+    Maps synapses (or segments) that are all on the same section to expand
+    onto its trunk and branches according to the NeuroReduce algorithm: looks
+    up the original transfer impedance of every given (section, x) location in
+    the SubtreeImpedanceTable of the section and maps all of them at once (see
+    find_best_real_X_batch).
+
+    Returns a numpy array of the new relative locations (x, 0<=x<=1) on the
+    trunk or the branches, and a boolean array that is True for the locations on the trunk
     '''
-    # measures the original transfer impedance from the synapse to the
-    # somatic-proximal end in the subtree root section
-    if synapse_location.section_type=='apic':  # apical subtree
-        # print('not on_basal','|synapse_location.section_num: ',synapse_location.section_num)
-        try: section = cell_instance.apic[synapse_location.section_num]
-        except: 
-            if synapse_location.section_num==0:
-                    section=cell_instance.apic
-                    # print(section)
-            else:
-                raise(print('Exception led to error. Check cell_instance.apic'))
-    elif synapse_location.section_type=='dend':             # basal subtree
-        section = cell_instance.dend[synapse_location.section_num]
-    else:
-        raise(print('synapse_location.section_type not "apic" or "dend"'))
-    # print('section: ',section)
-
-    with push_section(section):
-        orig_transfer_imp = imp_obj.transfer(synapse_location.x) * 1000000  # ohms
-        orig_transfer_phase = imp_obj.transfer_phase(synapse_location.x)
-        # creates a complex Impedance value with the given polar coordinates
-        orig_synapse_transfer_impedance = cmath.rect(orig_transfer_imp, orig_transfer_phase)
-
-    # synapse location could be calculated using:
-    # X = L - (1/q) * arcosh( (Zx,0(f) / ZtreeIn(f)) * cosh(q*L) ),
-    # derived from Rall's cable theory for dendrites (Gal Eliraz)
-    # but we chose to find the X that will give the correct modulus. See comment about L values
-
-    elec_L_dend=trunk_properties.electrotonic_length+branch_properties.electrotonic_length
-
-
-    synapse_new_electrotonic_location = find_best_real_X(root_input_impedance,
-                                                         orig_synapse_transfer_impedance,
-                                                         q_subtree,
-                                                         elec_L_dend)
-                                                         
-    #relative location along entire dendrite                                                     
-    new_relative_loc_in_section = (float(synapse_new_electrotonic_location) /
-                                   elec_L_dend)
-    #determine x loc is  trunk or branch
-    if new_relative_loc_in_section<furcation_x: #trunk
-      on_trunk=True
-      new_relative_loc_in_section = new_relative_loc_in_section/furcation_x #adjust for section x loc
-    else: #branch case
-      on_trunk=False
-      branch_elec_L_for_synapse = synapse_new_electrotonic_location-trunk_properties.electrotonic_length
-      # solve branch_elec_L_for_synapse = branch_syn_L/branch_space_const for branch_syn_L (the length up the branch to the synapses electrotonic length)
-      branch_L_for_synapse = branch_elec_L_for_synapse*branch_properties.space_const
-      # find proportionate length for x doing L_syn/L_branch
-      new_relative_loc_in_section = branch_L_for_synapse/branch_properties.length
-
-    if new_relative_loc_in_section > 1:  # PATCH
-        new_relative_loc_in_section = 0.999999
-
-    return new_relative_loc_in_section, on_trunk
-
-def find_branch_synapse_X(cell_instance,
-                   synapse_location,
-                   on_basal,
-                   imp_obj,
-                   root_input_impedance,
-                   new_cable_electrotonic_length,
-                   q_subtree,
-                   trunk_properties, branch_properties):
+    orig_synapse_transfer_impedances = impedance_table.transfer_impedance(sections, xs)
+
+    elec_L_dend = trunk_properties.electrotonic_length + branch_properties.electrotonic_length
+    synapses_new_electrotonic_locations = find_best_real_X_batch(impedance_table.root_input_impedance,
+                                                                 orig_synapse_transfer_impedances,
+                                                                 q_subtree,
+                                                                 elec_L_dend)
+
+    #relative location along entire dendrite
+    new_relative_locs = synapses_new_electrotonic_locations / elec_L_dend
+    on_trunk = new_relative_locs < furcation_x
+    # on the branches, the length up the branch to the synapse's electrotonic
+    # length is branch_elec_L_for_synapse * branch_space_const
+    branch_L_for_synapses = ((synapses_new_electrotonic_locations - trunk_properties.electrotonic_length) *
+                             branch_properties.space_const)
+    new_relative_locs_in_section = np.where(on_trunk,
+                                            new_relative_locs / furcation_x,
+                                            branch_L_for_synapses / branch_properties.length)
+
+    new_relative_locs_in_section[new_relative_locs_in_section > 1] = 0.999999  # PATCH
+    return new_relative_locs_in_section, on_trunk
+
+def find_branch_synapse_Xs(impedance_table,
+                           sections,
+                           xs,
+                           new_cable_electrotonic_length,
+                           q_subtree,
+                           trunk_properties, branch_properties):
     '''
-    Receives an instance of a cell, the location (section + relative
-    location(x)) of a synapse to be reduced, a boolean on_basal that is True if
-    the synapse is on a basal subtree, the number of segments in the reduced
-    cable that this synapse is in, an Impedance calculating Hoc object, the
-    input impedance at the root of this subtree, and the electrotonic length of
-    the reduced cable that represents the current subtree
-    (as a real and as a complex number) -
-    and maps the given synapse to its new location on the reduced cable
-    according to the NeuroReduce algorithm.  Returns the new "post-merging"-
-    relative location of the synapse on the reduced cable (x, 0<=x<=1), that
-    represents the middle of the segment that this synapse is located at in the
-    new reduced cable.
+    Receives the SubtreeImpedanceTable of a section to expand, the locations
+    (sections and relative locations (x)) of synapses on it that are mapped
+    beyond the furcation point, the electrotonic length of the whole expanded
+    dendrite (trunk and branch), q of the subtree and the cable properties of
+    the trunk and branch - and maps all the synapses at once (see
+    find_best_real_X_batch) to their new location on the branch according to
+    the NeuroReduce algorithm. Returns a numpy array of the relative locations
+    on the branch (x, 0<=x<=1).
     '''
-    # measures the original transfer impedance from the synapse to the
+    # the original transfer impedances from the synapses to the
     # somatic-proximal end in the subtree root section
-    if not on_basal:  # apical subtree
-        # print('not on_basal')
-        try: section = cell_instance.apic[synapse_location.section_num]
-        except: 
-            if 0==synapse_location.section_num:
-                    section=cell_instance.apic
-                    # print(section)
-            else:
-                raise(print('Exception led to error. Check cell_instance.apic'))
-    else:             # basal subtree
-        section = cell_instance.dend[synapse_location.section_num]
-    # print('section: ',section)
-    with push_section(section):
-        orig_transfer_imp = imp_obj.transfer(synapse_location.x) * 1000000  # ohms
-        orig_transfer_phase = imp_obj.transfer_phase(synapse_location.x)
-        # creates a complex Impedance value with the given polar coordinates
-        orig_synapse_transfer_impedance = cmath.rect(orig_transfer_imp, orig_transfer_phase)
+    orig_synapse_transfer_impedances = impedance_table.transfer_impedance(sections, xs)
 
     # synapse location could be calculated using:
     # X = L - (1/q) * arcosh( (Zx,0(f) / ZtreeIn(f)) * cosh(q*L) ),
     # derived from Rall's cable theory for dendrites (Gal Eliraz)
     # but we chose to find the X that will give the correct modulus. See comment about L values
-
-    synapse_new_electrotonic_location = find_best_real_X(root_input_impedance,
-                                                         orig_synapse_transfer_impedance,
-                                                         q_subtree,
-                                                         new_cable_electrotonic_length)
-    #solve syn_elec_L=trunk_elec_L+branch_elec_L for branch_elec_L
-    branch_elec_L_for_synapse = synapse_new_electrotonic_location-trunk_properties.electrotonic_length
-    # solve branch_elec_L_for_synapse = branch_syn_L/branch_space_const for branch_syn_L (the length up the branch to the synapses electrotonic length)
-    branch_L_for_synapse = branch_elec_L_for_synapse*branch_properties.space_const
+    synapses_new_electrotonic_locations = find_best_real_X_batch(impedance_table.root_input_impedance,
+                                                                 orig_synapse_transfer_impedances,
+                                                                 q_subtree,
+                                                                 new_cable_electrotonic_length)
+    #solve syn_elec_L=trunk_elec_L+branch_elec_L for branch_elec_L, then
+    # branch_elec_L_for_synapse = branch_syn_L/branch_space_const for branch_syn_L (the length up the branch to the synapses electrotonic length)
+    branch_L_for_synapses = ((synapses_new_electrotonic_locations - trunk_properties.electrotonic_length) *
+                             branch_properties.space_const)
     # find proportionate length for x doing L_syn/L_branch
-    new_relative_loc_in_section = branch_L_for_synapse/branch_properties.length
-
-    if new_relative_loc_in_section > 1:  # PATCH
-        new_relative_loc_in_section = 0.999999
+    new_relative_locs_in_section = branch_L_for_synapses / branch_properties.length
 
-    return new_relative_loc_in_section
+    new_relative_locs_in_section[new_relative_locs_in_section > 1] = 0.999999  # PATCH
+    return new_relative_locs_in_section
   
+@instrumentation.timed
 def adjust_new_tree_synapses(num_of_subtrees, roots_of_subtrees,
                            num_sections_to_expand,
                            trunk_properties, branch_properties, nbranches, furcations_x, all_trunk_sec_type, trunk_sec_type_list_indices, #list of indices for dend[], apic[] of trunk sections
@@ -780,7 +771,11 @@ def adjust_new_tree_synapses(num_of_subtrees, roots_of_subtrees,
                            original_cell,
                            basals, apicals,
                            cell,
-                           reduction_frequency):
+                           reduction_frequency,
+                           impedance_cache=None):
+    if impedance_cache is None:
+        impedance_cache = ImpedanceCache()
+
     # dividing the original synapses into baskets, so that all synapses that are
     # on the same subtree will be together in the same basket
 
@@ -809,14 +804,29 @@ def adjust_new_tree_synapses(num_of_subtrees, roots_of_subtrees,
     # (the new location is the exact location of the middle of the segment they
     # were mapped to, in order to enable merging)
 #     print('trunk_sec_type_list_indices:',trunk_sec_type_list_indices)
+    num_of_merged, num_of_repointed = 0, 0
+    num_of_kept = len(new_synapses_list)  # synapses that are not on the expanded sections
+    merge_index = SynapseMergeIndex(PP_params_dict)
     for section_to_expand_index in range(len(sections_to_expand)):
-        imp_obj, subtree_input_impedance = measure_input_impedance_of_subtree(
-            sections_to_expand[section_to_expand_index], reduction_frequency)
+        impedance_table = impedance_cache.impedance_table(sections_to_expand[section_to_expand_index],
+                                                          reduction_frequency)
         subtree_ind_to_q[section_to_expand_index] = calculate_subtree_q(
             sections_to_expand[section_to_expand_index], reduction_frequency)
         
         trunk_index = trunk_sec_type_list_indices[section_to_expand_index]
         x_furcation = furcations_x[section_to_expand_index]
+        # the synapses distal to the furcation point are mapped onto the branch all at once, to the
+        # point on the branch that has the same electrotonic length as originally
+        branch_synapses = [(synapse, synapse_location) for synapse, synapse_location, _ in baskets[section_to_expand_index]
+                           if synapse_location.x >= x_furcation]
+        dend_elec_L=trunk_properties[section_to_expand_index].electrotonic_length+branch_properties[section_to_expand_index].electrotonic_length
+        branch_xs = iter(find_branch_synapse_Xs(impedance_table,
+                                                [synapse.get_segment().sec for synapse, _ in branch_synapses],
+                                                [synapse_location.x for _, synapse_location in branch_synapses],
+                                                dend_elec_L,
+                                                subtree_ind_to_q[section_to_expand_index],
+                                                trunk_properties=trunk_properties[section_to_expand_index],
+                                                branch_properties=branch_properties[section_to_expand_index]))
         # iterates over the synapses in the curr basket
         for synapse, synapse_location, syn_index in baskets[section_to_expand_index]:
             # get trunk synapses
@@ -841,63 +851,47 @@ def adjust_new_tree_synapses(num_of_subtrees, roots_of_subtrees,
                 raise(all_trunk_sec_type[section_to_expand_index],' is not "apic" or "dend"')
               
               #adjust x location to the point on the branch that has the same electrotonic length as originally
+              x = next(branch_xs)
 
-              dend_elec_L=trunk_properties[section_to_expand_index].electrotonic_length+branch_properties[section_to_expand_index].electrotonic_length
-              on_basal_subtree = not (has_apical and section_to_expand_index == 0)
-              x = find_branch_synapse_X(original_cell,
-                   synapse_location,
-                   on_basal_subtree,
-                   imp_obj,
-                   subtree_input_impedance,
-                   dend_elec_L,
-                   subtree_ind_to_q[section_to_expand_index],
-                   trunk_properties=trunk_properties[section_to_expand_index], branch_properties=branch_properties[section_to_expand_index])
-              
 
-            # go over all point processes in this segment and see whether one
-            # of them has the same proporties of this synapse
+            # look for a point process in this segment that has the same
+            # proporties of this synapse
             # If there's such a synapse link the original NetCon with this point processes
             # If not, move the synapse to this segment.
-            for PP in section_for_synapse(x).point_processes():
-                print(PP_params_dict)
-                if type_of_point_process(PP) not in PP_params_dict:
-                    print("adding",PP,"to PP_params_dict")
-                    add_PP_properties_to_dict(PP, PP_params_dict)
-
-                if synapse_properties_match(synapse, PP, PP_params_dict):
-                    #netcons_list[syn_index].setpost(PP) #this does not work because there is no loger 1:1 correspondence between netcon and synapse
-                    for netcon in syn_to_netcon[synapse]:
-                      netcon.setpost(PP)
-                    break
-            else:  # If for finish the loop -> first appearance of this synapse
-                ##########testing
-                if type_of_point_process(synapse) not in PP_params_dict:
-                    print("adding",synapse,"to PP_params_dict")
-                    add_PP_properties_to_dict(synapse, PP_params_dict)
-                #########
-                print("moving", synapse, "from",synapse_location,"to",section_for_synapse(x))
+            PP = merge_index.find(synapse, section_for_synapse, x)
+            if PP is not None:
+                #netcons_list[syn_index].setpost(PP) #this does not work because there is no loger 1:1 correspondence between netcon and synapse
+                netcons = syn_to_netcon[synapse]
+                for netcon in netcons:
+                  syn_to_netcon.setpost(netcon, PP)
+                num_of_merged += 1
+                num_of_repointed += len(netcons)
+            else:  # first appearance of this synapse
                 synapse.loc(x, sec=section_for_synapse)
+                merge_index.add(synapse, section_for_synapse, x)
                 new_synapses_list.append(synapse)
 
     # merging somatic and axonal synapses
-    synapses_per_seg = collections.defaultdict(list)
+    soma_merge_index = SynapseMergeIndex(PP_params_dict, seed_existing=False)
     for synapse in soma_synapses_syn_to_netcon:
         seg_pointer = synapse.get_segment()
 
-        for PP in synapses_per_seg[seg_pointer]:
-            if type_of_point_process(PP) not in PP_params_dict:
-                add_PP_properties_to_dict(PP, PP_params_dict)
-
-            if synapse_properties_match(synapse, PP, PP_params_dict):
-                soma_synapses_syn_to_netcon[synapse].setpost(PP)
-                break
-        else:  # If for finish the loop -> first appearance of this synapse
+        PP = soma_merge_index.find(synapse, seg_pointer.sec, seg_pointer.x)
+        if PP is not None:
+            syn_to_netcon.setpost(soma_synapses_syn_to_netcon[synapse], PP)
+            num_of_merged += 1
+            num_of_repointed += 1
+        else:  # first appearance of this synapse
             synapse.loc(seg_pointer.x, sec=seg_pointer.sec)
             new_synapses_list.append(synapse)
-            synapses_per_seg[seg_pointer].append(synapse)
+            soma_merge_index.add(synapse, seg_pointer.sec, seg_pointer.x)
 
+    instrumentation.count('synapses_moved', len(new_synapses_list) - num_of_kept)
+    instrumentation.count('synapses_merged', num_of_merged)
+    instrumentation.count('netcons_repointed', num_of_repointed)
     return new_synapses_list, subtree_ind_to_q
   
+@instrumentation.timed
 def create_seg_to_seg(original_cell,
                       section_per_subtree_index,
                       sections_to_expand,
@@ -909,220 +903,180 @@ def create_seg_to_seg(original_cell,
                       subtree_ind_to_q,
                       mapping_type,
                       reduction_frequency,
-                      trunks, branches):
+                      trunks, branches,
+                      all_expanded_sections,
+                      impedance_cache=None):
     '''create mapping between segments in the original model to segments in the reduced model
        if mapping_type == impedance the mapping will be a response to the
        transfer impedance of each segment to the soma (like the synapses)
        if mapping_type == distance  the mapping will be a response to the
        distance of each segment to the soma (like the synapses) NOT IMPLEMENTED
        YET
+       impedance_cache - an ImpedanceCache shared with adjust_new_tree_synapses
+
+       the impedance of every section to expand is looked up once, and all its
+       segments are mapped together (see expand_synapses). A segment mapped
+       to the branches is mapped to the same location on every branch.
+
+       Returns two parallel index arrays of (original segment, expanded segment)
+       pairs: original_index - the index of the original segment among the
+       segments of sections_to_expand (in order, as in create_segments_to_mech_vals),
+       expanded_index - the index of the expanded segment among the segments of
+       all_expanded_sections
        '''
 
     assert mapping_type == 'impedance', 'distance mapping not implemented yet'
-    # the keys are the segments of the original model, the values are the
-    # segments of the reduced model
-    original_seg_to_expanded_seg = collections.defaultdict(list) #originally these two dictionaires were flipped
-    expanded_seg_to_original_seg = collections.defaultdict(list)
-    subtree_index=0
-    for sec in sections_to_expand:
-            for seg in sec:
-#                 print('expanded_seg_to_original_seg:',expanded_seg_to_original_seg)
-#                 print('original_seg_to_expanded_seg:',original_seg_to_expanded_seg)
-#                 print(seg)
-                synapse_location = find_synapse_loc(seg, mapping_sections_to_subtree_index)
-                imp_obj, cable_input_impedance = measure_input_impedance_of_subtree(
-                    sec, reduction_frequency)
-
-                # if synapse is on the apical subtree
-                on_basal_cable = not (has_apical and subtree_index == 0)
-
-                mid_of_segment_loc, on_trunk = expand_synapse(
-                    original_cell,
-                    synapse_location,
-                    on_basal_cable,
-                    imp_obj,
-                    cable_input_impedance,
-                    all_trunk_properties[subtree_index], all_branch_properties[subtree_index],furcations_x[subtree_index],
-                    subtree_ind_to_q[subtree_index])
-#                 print('|mid_of_segment_loc:',mid_of_segment_loc,'|on_trunk',on_trunk,'|seg:',seg)
-                if on_trunk:
-                  new_section_for_synapse = trunks[subtree_index] # returns trunk section
-                else:
-                  new_section_for_synapse = branches[subtree_index] # returns list of branch sections for each trunk
-#                 print('new_section_for_synapse:',new_section_for_synapse)
-                if on_trunk == False: # case for mapping to branches
-                  expanded_seg = [None] * len(new_section_for_synapse) #initial array for branches
-                  for i in range(len(new_section_for_synapse)):
-                      new_section=new_section_for_synapse[i]
-                      # print('new_section: ',new_section)
-                      expanded_seg[i] = new_section(mid_of_segment_loc)
-                      # print('expanded_seg:',expanded_seg)
-                      original_seg_to_expanded_seg[seg].append(expanded_seg)
-                      # print('original_seg_to_expanded_seg:',original_seg_to_expanded_seg)
-                      expanded_seg_to_original_seg[expanded_seg[i]].append(seg)
-                      # print('expanded_seg_to_original_seg: ',expanded_seg_to_original_seg)
-                else: #normal case
-                  expanded_seg = new_section_for_synapse(mid_of_segment_loc)
-#                   print('expanded_seg: ',expanded_seg)
-                  # original_seg_to_expanded_seg[seg] = expanded_seg
-                  original_seg_to_expanded_seg[seg].append(expanded_seg) 
-                  # print('original_seg_to_expanded_seg: ',original_seg_to_expanded_seg)
-                  expanded_seg_to_original_seg[expanded_seg].append(seg)
-                  # print('expanded_seg_to_original_seg: ',expanded_seg_to_original_seg)
-                #original_seg_to_reduced_seg[seg] = reduced_seg
-                #reduced_seg_to_original_seg[reduced_seg].append(seg)
-                
-                # original_seg_to_reduced_seg[seg] = reduced_seg
-                # # original_seg_to_reduced_seg[seg].append(reduced_seg) possible implementation
-                # reduced_seg_to_original_seg[reduced_seg].append(seg)
-            subtree_index+=1
-    
-    return original_seg_to_expanded_seg, dict(expanded_seg_to_original_seg)
+    if impedance_cache is None:
+        impedance_cache = ImpedanceCache()
+
+    # the index of the first segment of every expanded section
+    first_segment_index = {}
+    num_of_segments = 0
+    for sec in all_expanded_sections:
+        first_segment_index[sec] = num_of_segments
+        num_of_segments += sec.nseg
+
+    def segment_indices(section, xs):
+        return first_segment_index[section] + np.minimum((xs * section.nseg).astype(int), section.nseg - 1)
+
+    original_index, expanded_index = [], []
+    num_of_original_segments = 0
+    for subtree_index, sec in enumerate(sections_to_expand):
+        xs = np.array([seg.x for seg in sec])
+        seg_indices = num_of_original_segments + np.arange(len(xs))
+        num_of_original_segments += len(xs)
+
+        impedance_table = impedance_cache.impedance_table(sec, reduction_frequency)
+        mid_of_segment_locs, on_trunk = expand_synapses(impedance_table,
+                                                        [sec] * len(xs),
+                                                        xs,
+                                                        all_trunk_properties[subtree_index],
+                                                        all_branch_properties[subtree_index],
+                                                        furcations_x[subtree_index],
+                                                        subtree_ind_to_q[subtree_index])
+
+        # every segment is mapped to its trunk segment, or to the segments at
+        # the same location on all the branches
+        pairs = [(seg_indices[on_trunk], segment_indices(trunks[subtree_index], mid_of_segment_locs[on_trunk]))]
+        pairs += [(seg_indices[~on_trunk], segment_indices(branch, mid_of_segment_locs[~on_trunk]))
+                  for branch in branches[subtree_index]]
+        original_indices = np.concatenate([original for original, _ in pairs])
+        expanded_indices = np.concatenate([expanded for _, expanded in pairs])
+        order = np.argsort(original_indices, kind='stable')  # keeps the pairs in the order of the original segments
+        original_index.append(original_indices[order])
+        expanded_index.append(expanded_indices[order])
+
+    if not original_index:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    return np.concatenate(original_index), np.concatenate(expanded_index)
+
+
+def seg_to_seg_dict(original_index, expanded_index, sections_to_expand, all_expanded_sections):
+    '''returns the mapping from create_seg_to_seg as a dict of original segment -> list of expanded segments'''
+    original_segments = [seg for sec in sections_to_expand for seg in sec]
+    expanded_segments = [seg for sec in all_expanded_sections for seg in sec]
+    original_seg_to_expanded_seg = collections.OrderedDict()
+    for original, expanded in zip(original_index, expanded_index):
+        original_seg_to_expanded_seg.setdefault(original_segments[original], []).append(expanded_segments[expanded])
+    return original_seg_to_expanded_seg
   
-def copy_dendritic_mech(original_seg_to_reduced_seg,
-                        reduced_seg_to_original_seg,
-                        apicals,
-                        basals,
+@instrumentation.timed
+def copy_dendritic_mech(original_index,
+                        expanded_index,
                         segment_to_mech_vals, all_expanded_sections,
                         mapping_type='impedance'):
-    ''' copies the mechanisms from the original model to the reduced model'''
-
-    # copy mechanisms
-    # this is needed for the case where some segements were not been mapped
-    mech_names_per_segment = collections.defaultdict(list)
-    vals_per_mech_per_segment = {}
-    for reduced_seg, original_segs in reduced_seg_to_original_seg.items():
-        vals_per_mech_per_segment[reduced_seg] = collections.defaultdict(list)
-
-        for original_seg in original_segs:
-#             print('original_seg: ',original_seg)
-            # print('segment_to_mech_vals[original_seg].items(): ',segment_to_mech_vals[original_seg].items())
-            for mech_name, mech_params in segment_to_mech_vals[original_seg].items():
-                for param_name, param_value in mech_params.items():
-                    vals_per_mech_per_segment[reduced_seg][param_name].append(param_value)
-
-                mech_names_per_segment[reduced_seg].append(mech_name)
-                reduced_seg.sec.insert(mech_name)
-
-        for param_name, param_values in vals_per_mech_per_segment[reduced_seg].items():
-            setattr(reduced_seg, param_name, np.mean(param_values))
+    ''' copies the mechanisms from the original model to the reduced model
 
+    original_index, expanded_index - the segment mapping, as returned by create_seg_to_seg
+    '''
     all_segments = []
     for sec in all_expanded_sections:
         for seg in sec:
             all_segments.append(seg)
-    
-#     print('all expanded segments:',all_segments)
-#     print('reduced_seg_to_original_seg: ',reduced_seg_to_original_seg)
-    if len(all_segments) != len(reduced_seg_to_original_seg):
+
+    reduced_mech_vals = segment_to_mech_vals.aggregate(original_index, expanded_index, all_segments)
+
+    mapped = np.bincount(expanded_index, minlength=len(all_segments)) > 0
+    if not np.all(mapped):
         logger.warning('There is no segment to segment copy, it means that some segments in the'
                     'reduced model did not receive channels from the original cell.'
                     'Trying to compensate by copying channels from neighboring segments')
-        handle_orphan_segments(original_seg_to_reduced_seg,
-                               all_segments,
-                               vals_per_mech_per_segment,
-                               mech_names_per_segment)
+        reduced_mech_vals = handle_orphan_segments(reduced_mech_vals, mapped)
+
+    with instrumentation.stage('apply_mechanisms'):
+        reduced_mech_vals.apply()
         
         
-def distribute_branch_synapses(branch_sets,netcons_list,synapses_list,PP_params_dict,syn_to_netcon):
+@instrumentation.timed
+def distribute_branch_synapses(branch_sets,netcons_list,synapses_list,PP_params_dict,syn_to_netcon,
+                               rng=None,stratified=False,netcon_assignment=None,replay=False):
   '''
   Works for after the synapses have been mapped to the first branch in the list.
   duplicates each synapse on the first branch onto each other branch then splits the original synapse's netcons among the synapses.
   branch_sets: list of subtree lists of branch sections (list of lists for the case where more than one section was expanded)
   netcons_list: list of netcon objects
   synapses_list: list of synapse objects
+  rng, stratified: see draw_netcon_choices
+  netcon_assignment: array with an item per netcon (in netcons_list order), the choice
+                     (see draw_netcon_choices) of every redistributed netcon is written
+                     into it, or, if replay, read from it instead of being drawn.
+                     The netcons of synapses that are not duplicated stay NOT_REDISTRIBUTED
   '''
+  if netcon_assignment is None:
+    netcon_assignment = np.full(len(netcons_list), NOT_REDISTRIBUTED, dtype=int)
+  pp_params = PointProcessParams(PP_params_dict) # compared parameters and their extractors, shared by all duplicates
+  num_of_synapses = len(synapses_list)
   for branch_set in branch_sets: #branch_sets variable is a list of lists of sections
-    print(branch_set)
     branch_with_synapses=branch_set[0] #branch with synapses is the first section within the list
-    for seg in branch_with_synapses:
-      print("branch's seg.point_processes:",seg.point_processes())
-      for synapse in seg.point_processes():
-        x=synapse.get_loc() # get loc of original synapse       
-        new_syns=[] #list for redistributing netcons #make original synapse an option for netcon
-        for i in range(len(branch_set)-1): # duplicate synapse onto each corresponding branch location
-          new_syn=duplicate_synapse(synapse,seg,PP_params_dict) #generate new identical synapse
-          print("duplicate new_syn:", new_syn)
-          new_syns.append(new_syn) # make new synapse an option for netcon to point to
-          synapses_list.append(new_syn) #update total synapses_list to include new synapse object
-          new_syn.loc(branch_set[i+1](x)) #place new synapse onto each branch
-        redistribute_netcons(synapse,new_syns,syn_to_netcon)
-    print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),"Finish YAY")
+    synapses = [synapse for seg in branch_with_synapses for synapse in seg.point_processes()]
+    xs = [synapse.get_segment().x for synapse in synapses] # loc of original synapses
+    # duplicate every synapse onto each corresponding branch location, in one batch
+    clones = clone_point_processes(synapses, [[branch(x) for branch in branch_set[1:]] for x in xs], pp_params)
+    synapses_list.extend(clones) #update total synapses_list to include the new synapse objects
+    for i, synapse in enumerate(synapses):
+      netcon_indices = syn_to_netcon.netcon_indices_of(synapse)
+      choices = netcon_assignment[netcon_indices] if replay else None
+      # the copies are the options for the netcons to point to
+      netcon_assignment[netcon_indices] = redistribute_netcons(synapse,clones.copies_of(i),syn_to_netcon,rng,stratified,choices)
+  instrumentation.count('synapses_duplicated', len(synapses_list) - num_of_synapses)
 
   return synapses_list
 
-def duplicate_synapse(synapse,seg,PP_params_dict):
-    '''
-    creates a new synapse object with the same parameters as the given synapse object
-    uses the dictionary for:
+def draw_netcon_choices(num_of_netcons,num_of_targets,rng=None,stratified=False):
+    '''draws, in one call, where each of the netcons of a synapse goes:
+    0 keeps it on the synapse, i>0 points it at the (i-1)th target synapse
+    rng: a np.random.Generator, or None for the global numpy RNG (the draws
+         of the original one randint call per netcon, reproduced by np.random.seed)
+    stratified: if True every choice gets an even share of the netcons (the
+                counts differ by at most one, the extra netcons go to random choices)
     '''
-    syn_type = synapse.hname().split('[')[0]  # Remove index from syn_type
-    new_synapse = getattr(h, syn_type)(seg)
-#     new_synapse = eval('h.'+syn_type)(seg) # trying to replace with above line.
-    #new_synapse = h.execute(syn_type)(seg) alternative may be more efficient but did not work
-            # extract the parameters using hoc instead of PyNeuronToolbox
-    params_were_same=[]
-    for param_name in PP_params_dict[syn_type]:
-            param_value = getattr(synapse, param_name)
-            if getattr(new_synapse, param_name) != param_value:
-              if param_name in params_were_same:
-                print("Keep",param_name)
-              try:setattr(new_synapse, param_name, param_value)
-              except: raise AttributeError('Cannot set',new_synapse,'attribute',param_name,'to',param_value,'may try including attribute in skipped_params for PP_params_dict')
-            else:
-              if param_name not in params_were_same:
-                params_were_same.append(param_name)
-                print("consider excluding PP_params:",param_name) #debugging for efficiency
-    return new_synapse
-           
-
-def get_syn_to_netcons(netcons_list):
-    syn_to_netcon = {} # dictionary mapping netcons to their synapse
-    for netcon in netcons_list: #fill in dictionary
-      syn = netcon.syn() # get the synapse that netcon points to
-      if syn in syn_to_netcon:
-          syn_to_netcon[syn].append(netcon) #add netcon to existing synapse key
-      else:
-          syn_to_netcon[syn] = [netcon] #create new synapse key using netcon as an item
-    return syn_to_netcon
-       
+    num_of_choices = num_of_targets + 1
+    if rng is None:
+      rng_integers, rng_permutation = np.random.randint, np.random.permutation
+    else:
+      rng_integers, rng_permutation = rng.integers, rng.permutation
+    if not stratified:
+      return rng_integers(0, num_of_choices, size=num_of_netcons)
+    return rng_permutation((np.arange(num_of_netcons) + rng_integers(0, num_of_choices)) % num_of_choices)
+            
             
-def redistribute_netcons(synapse,target_synapses,syn_to_netcon):
+def redistribute_netcons(synapse,target_synapses,syn_to_netcon,rng=None,stratified=False,choices=None):
     '''randomly chooses a new synapse among the original and new choices to point the netcon to
     target_synapses: list of new synapses
+    syn_to_netcon: the NetConRegistry of the netcons, kept up to date
+    rng, stratified: see draw_netcon_choices
+    choices: the choices of the netcons of the synapse (in netcons_list order) to replay instead of drawing them
+    returns the choices
     '''
-    for netcon in syn_to_netcon[synapse]: # redistribute netcons
-      rand_index = np.random.randint(0, len(target_synapses)+1) #choose random branch to move point netcon to
-      if rand_index==0: #if 0, keep netcon on original synapse
-        continue
-      else:
-        netcon.setpost(target_synapses[rand_index-1]) #find corresponding synapse #point netcon toward synapse
+    netcon_indices = syn_to_netcon.netcon_indices_of(synapse)
+    if choices is None:
+      choices = draw_netcon_choices(len(netcon_indices), len(target_synapses), rng, stratified) #choose random branch to move point netcon to
+    elif len(choices) and (np.min(choices) < 0 or np.max(choices) > len(target_synapses)):
+      raise ValueError('the netcon assignment of %s does not match its %d copies, was it recorded for another model?' % (synapse, len(target_synapses)))
+    for netcon_index, choice in zip(netcon_indices, choices): # redistribute netcons
+      if choice: #if 0, keep netcon on original synapse
+        syn_to_netcon.setpost(netcon_index, target_synapses[choice-1]) #find corresponding synapse #point netcon toward synapse
+    instrumentation.count('netcons_repointed', int(np.count_nonzero(choices)))
+    return choices
         
         
-def add_PP_properties_to_dict(PP, PP_params_dict):
-    """
-    add the properties of a point process to PP_params_dict.
-    The only properties added to the dictionary are those worth comparing
-    attributes not worth comparing are not synapse properties or do not differ in value.
-    """
-    skipped_params = {
-        "Section", "allsec", "baseattr", "cas", "g", "get_loc", "has_loc", "hname",
-        'hocobjptr', "i", "loc", "next", "ref", "same", "setpointer", "state",
-        "get_segment", "DA1", "eta", "omega", "DA2", "NEn", "NE2", "GAP1", "unirand", "randGen", "sfunc", "erand", 
-        "randObjPtr", "A_AMPA", "A_NMDA", "B_AMPA", "B_NMDA", "D1", "D2", "F", "P", "W_nmda", "facfactor", "g_AMPA", "g_NMDA", "iampa", "inmda", "on_ampa", "on_nmda", "random",  "thr_rp","AlphaTmax_gaba", "Beta_gaba", "Cainf", "Cdur_gaba", "Erev_gaba", "ICag", "Icatotal", "P0g", "W", "capoolcon", "destid", "fCag", "fmax", "fmin", "g_gaba", "gbar_gaba", "igaba", "limitW", "maxChange", "neuroM", "normW", "on_gaba", "pooldiam", "postgid", "pregid", "r_gaba", "r_nmda", "scaleW", "srcid", "tauCa", "type", "z",
-        "d1", "gbar_ampa", "gbar_nmda","tau_d_AMPA","tau_d_NMDA","tau_r_AMPA","tau_r_NMDA","Erev_ampa","Erev_nmda", "lambda1", "lambda2", "threshold1", "threshold2",
-    }
-
-    syn_params_list = {
-        "tau_r_AMPA", "tau_r_NMDA", "Use", "Dep", "Fac", "e", "u0", "initW", "taun1", "taun2", "gNMDAmax", "enmda", "taua1", "taua2", "gAMPAmax", "eampa", "AlphaTmax_ampa", "Beta_ampa", "Cdur_ampa", "AlphaTmax_nmda", "Beta_nmda", "Cdur_nmda", "initW_random", "Wmax", "Wmin", "tauD1", "tauD2", "f", "tauF", "P_0", "d2",
-    }
-
-    PP_params = [param for param in dir(PP) if not (param.startswith("__") or callable(getattr(PP, param)))]
-
-    PP_params = list(filter(lambda x: x not in skipped_params, PP_params))
-
-    syn_params = list(filter(lambda x: x in syn_params_list, PP_params))
-
-
-    PP_params_dict[type_of_point_process(PP)] = syn_params
-    print(PP_params_dict)
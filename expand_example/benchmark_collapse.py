@@ -0,0 +1,118 @@
+#speedup and error of the collapsed expansion (cable_expander(..., collapse_branches=True)), where
+#one representative branch stands for the nbranch identical branches, against the full expanded tree
+#
+#run from this directory, after compiling the mechanisms (nrnivmodl mod):
+#    python benchmark_collapse.py --nbranches 4 8 22 --synapses 10000 --output collapse.json
+#
+#every (cell, nbranch, full/collapsed) configuration runs in its own process, with the
+#same synapses and (seeded) inputs. The soma voltage of the collapsed model is compared
+#with that of the full one. A configuration whose process fails or dies is reported and
+#listed under "failed". The results are written as JSON:
+#    {"commit": ..., "runs": [{"cell": "L5PC", "synapses": 10000, "nbranch": 4,
+#      "full": {"nseg": n, "sections": n, "synapses": n, "expand": s, "simulate": s, "spikes": n},
+#      "collapsed": {...}, "speedup": x, "rmse": mV, "max_spike_shift": ms}, ...],
+#     "failed": [{"cell": "L5PC", "synapses": 10000, "nbranch": 22, "mode": "full", "error": ...}, ...]}
+
+from __future__ import division
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+import neuron
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmark_stages import CELL_BUILDERS, EXPANSIONS, add_synapses, git_commit, run_in_fresh_process
+
+
+def run_expansion(cell_name, n_synapses, nbranch, collapse, simulation):
+    '''builds, reduces and expands one cell (collapsed or not), returns its soma voltage and costs'''
+    from test_neuron_reduce.subtree_reductor_func import subtree_reductor
+    from test_neuron_reduce.segment_tuner import simulate_soma_voltage
+    from cable_expander_func import cable_expander
+
+    cell = CELL_BUILDERS[cell_name]()
+    synapses_list, netcons_list, keep_alive = add_synapses(cell, n_synapses)
+    reduced_cell, synapses_list, netcons_list = subtree_reductor(cell, synapses_list, netcons_list,
+                                                                 reduction_frequency=0)
+    furcation_x = EXPANSIONS[cell_name][0]
+    start = time.perf_counter()
+    expanded_cell, synapses_list, netcons_list = cable_expander(reduced_cell, [reduced_cell.hoc_model.apic[0]],
+                                                                [furcation_x], [nbranch],
+                                                                synapses_list, netcons_list, reduction_frequency=0,
+                                                                netcon_rng=0, collapse_branches=collapse)
+    expand_seconds = time.perf_counter() - start
+    soma = expanded_cell.soma if isinstance(expanded_cell.soma, neuron.nrn.Section) else expanded_cell.soma[0]
+    sections = list(soma.wholetree())
+    t, v, simulate_seconds = simulate_soma_voltage(expanded_cell, simulation)
+    return {'t': t, 'v': v,
+            'nseg': sum(sec.nseg for sec in sections),
+            'sections': len(sections),
+            'synapses': len(synapses_list),
+            'expand': expand_seconds,
+            'simulate': simulate_seconds}
+
+
+def run_benchmark(cell_names, synapse_counts, nbranches, simulation):
+    from test_neuron_reduce.segment_tuner import find_spike_times, compare_traces
+
+    runs, failed = [], []
+    for cell_name in cell_names:
+        for n_synapses in synapse_counts:
+            for nbranch in nbranches:
+                results = {}
+                for mode, collapse in (('full', False), ('collapsed', True)):
+                    result, error = run_in_fresh_process(run_expansion, cell_name, n_synapses, nbranch, collapse,
+                                                         simulation)
+                    if error is not None:
+                        print('{} {} synapses, {} branches, {}: FAILED, {}'.format(cell_name, n_synapses, nbranch,
+                                                                                   mode, error))
+                        failed.append({'cell': cell_name, 'synapses': n_synapses, 'nbranch': nbranch,
+                                       'mode': mode, 'error': error})
+                        break
+                    result['spike_times'] = find_spike_times(result['t'], result['v'])
+                    results[mode] = result
+                if len(results) < 2:
+                    continue
+                full, collapsed = results['full'], results['collapsed']
+                rmse, max_spike_shift = compare_traces(full['v'], collapsed['v'],
+                                                       full['spike_times'], collapsed['spike_times'])
+                run = collections.OrderedDict([('cell', cell_name), ('synapses', n_synapses), ('nbranch', nbranch)])
+                for mode in ('full', 'collapsed'):
+                    run[mode] = collections.OrderedDict((key, results[mode][key]) for key in
+                                                        ('nseg', 'sections', 'synapses', 'expand', 'simulate'))
+                    run[mode]['spikes'] = len(results[mode]['spike_times'])
+                run['speedup'] = full['simulate'] / collapsed['simulate']
+                run['rmse'] = rmse
+                run['max_spike_shift'] = max_spike_shift
+                print('{cell} {synapses} synapses, {nbranch} branches: '
+                      'nseg {full[nseg]} -> {collapsed[nseg]}, synapses {full[synapses]} -> {collapsed[synapses]}, '
+                      'simulation {full[simulate]:.3f}s -> {collapsed[simulate]:.3f}s ({speedup:.2f}x), '
+                      'spikes {full[spikes]} / {collapsed[spikes]}, '
+                      'RMSE {rmse:.3f} mV, spike shift {max_spike_shift:.3f} ms'.format(**run))
+                runs.append(run)
+    return {'commit': git_commit(),
+            'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'simulation': simulation._asdict(),
+            'runs': runs,
+            'failed': failed}
+
+
+if __name__ == '__main__':
+    from test_neuron_reduce.segment_tuner import SimulationParams
+
+    parser = argparse.ArgumentParser(description='compares the collapsed expansion with the full expanded tree')
+    parser.add_argument('--cells', nargs='+', default=['L5PC'], choices=sorted(CELL_BUILDERS))
+    parser.add_argument('--synapses', nargs='+', type=int, default=[10000])
+    parser.add_argument('--nbranches', nargs='+', type=int, default=[4, 8, 22])
+    parser.add_argument('--tstop', type=float, default=1000.)
+    parser.add_argument('--output', default='benchmark_collapse.json')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.cells, args.synapses, args.nbranches, SimulationParams(tstop=args.tstop))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('results written to %s' % args.output)
@@ -0,0 +1,279 @@
+#stage-level benchmark of the reduction (subtree_reductor) and expansion (cable_expander) of
+#the L5_PC model of this directory and of a stylized cell
+#
+#run from this directory, after compiling the mechanisms (nrnivmodl mod):
+#    python benchmark_stages.py --synapses 1000 10000 100000 --output bench.json
+#and compare two runs (e.g. of two commits) stage by stage:
+#    python benchmark_stages.py --compare old_bench.json bench.json
+#
+#every (cell, number of synapses) configuration runs in its own process, so
+#the runs do not share NEURON state. A configuration whose process fails or
+#dies (e.g. NEURON aborts when the mechanisms are not compiled here) is
+#reported and listed under "failed". The results are written as JSON:
+#    {"commit": ..., "neuron": ..., "runs": [{"cell": "L5PC", "synapses": 1000,
+#      "totals": {"build": s, "reduce": s, "expand": s},
+#      "stages": {"reduce/reduce_subtree": {"seconds": s, "calls": n}, ...},
+#      "counters": {"reduce": {"impedance_computes": n, ...}, "expand": {...}}}, ...],
+#     "failed": [{"cell": "L5PC", "synapses": 100000, "error": ...}, ...]}
+
+from __future__ import division
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import neuron
+from neuron import h
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# (pipeline, module, function) of every timed stage, a function is timed
+# wherever the module calls it through its own global name
+STAGES = [('reduce', 'test_neuron_reduce.subtree_reductor_func', 'gather_subtrees'),
+          ('reduce', 'test_neuron_reduce.subtree_reductor_func', 'create_segments_to_mech_vals'),
+          ('reduce', 'test_neuron_reduce.subtree_reductor_func', 'reduce_subtree'),
+          ('reduce', 'test_neuron_reduce.subtree_reductor_func', 'create_reduced_cell'),
+          ('reduce', 'test_neuron_reduce.subtree_reductor_func', 'merge_and_add_synapses'),
+          ('reduce', 'test_neuron_reduce.subtree_reductor_func', 'create_seg_to_seg'),
+          ('reduce', 'test_neuron_reduce.subtree_reductor_func', 'copy_dendritic_mech'),
+          ('expand', 'cable_expander_func', 'gather_subtrees'),
+          ('expand', 'cable_expander_func', 'create_segments_to_mech_vals'),
+          ('expand', 'cable_expander_func', 'expand_cable'),
+          ('expand', 'cable_expander_func', 'create_dendritic_cell'),
+          ('expand', 'cable_expander_func', 'adjust_new_tree_synapses'),
+          ('expand', 'cable_expander_func', 'create_seg_to_seg'),
+          ('expand', 'cable_expander_func', 'copy_dendritic_mech'),
+          ('expand', 'cable_expander_func', 'distribute_branch_synapses'),
+          ]
+
+# apical trunk expanded into nbranch branches at furcation_x, per cell
+EXPANSIONS = {'L5PC': (0.289004, 4),
+              'stylized': (0.5, 4)}
+
+
+class StageTimer(object):
+    '''accumulates the wall clock time and the number of calls of every stage'''
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+
+    def wrap(self, stage, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+                self.calls[stage] += 1
+        return timed
+
+    def results(self):
+        return collections.OrderedDict((stage, {'seconds': self.seconds[stage], 'calls': self.calls[stage]})
+                                       for stage in self.seconds)
+
+
+@contextlib.contextmanager
+def timed_stages(timer, stages=STAGES):
+    '''replaces the stage functions by timed versions for the duration of the block'''
+    originals = []
+    for pipeline, module_name, function_name in stages:
+        module = sys.modules[module_name]
+        function = getattr(module, function_name)
+        originals.append((module, function_name, function))
+        setattr(module, function_name, timer.wrap(pipeline + '/' + function_name, function))
+    try:
+        yield timer
+    finally:
+        for module, function_name, function in reversed(originals):
+            setattr(module, function_name, function)
+
+
+def build_L5PC():
+    h.load_file('L5PCbiophys3.hoc')
+    h.load_file("import3d.hoc")
+    h.load_file('L5PCtemplate.hoc')
+    return h.L5PCtemplate('cell1.asc')
+
+
+def build_stylized():
+    '''a passive ball and stick cell with an apical trunk, a tuft and basal dendrites'''
+    import pandas as pd
+    from stylized_module.stylized_cell import Stylized_Cell
+
+    geometry = pd.DataFrame([
+        {'name': 'soma', 'type': 1, 'axial': False, 'nbranch': 1, 'L': 0., 'R': 10., 'ang': 0., 'pid': 0},
+        {'name': 'proxtrunk', 'type': 4, 'axial': True, 'nbranch': 1, 'L': 400., 'R': 1.5, 'ang': math.pi / 2, 'pid': 0},
+        {'name': 'midtrunk', 'type': 4, 'axial': True, 'nbranch': 1, 'L': 400., 'R': 1.0, 'ang': math.pi / 2, 'pid': 1},
+        {'name': 'tuft', 'type': 4, 'axial': False, 'nbranch': 4, 'L': 300., 'R': 0.6, 'ang': math.pi / 4, 'pid': 2},
+        {'name': 'basal', 'type': 3, 'axial': False, 'nbranch': 4, 'L': 200., 'R': 0.7, 'ang': -math.pi / 4, 'pid': 0},
+    ])
+    with contextlib.redirect_stdout(io.StringIO()):  # Stylized_Cell prints every section it creates
+        cell = Stylized_Cell(geometry, dL=20)
+    cell.set_all_passive()
+    for sec in cell.all:
+        sec.Ra = 100
+    return cell
+
+
+CELL_BUILDERS = {'L5PC': build_L5PC,
+                 'stylized': build_stylized}
+
+
+def add_synapses(cell, n_synapses, seed=10):
+    '''adds the synapses of example_expand.py, placed by segment length'''
+    synapses_list, netstims_list, netcons_list, randoms_list = [], [], [], []
+    all_segments = [seg for sec in cell.apical for seg in sec] + [seg for sec in cell.basal for seg in sec]
+    len_per_segment = np.array([seg.sec.L / seg.sec.nseg for seg in all_segments])
+    rnd = np.random.RandomState(seed)
+    segment_indices = rnd.choice(len(all_segments), n_synapses, p=len_per_segment / sum(len_per_segment))
+    for i, segment_index in enumerate(segment_indices):
+        synapse = h.Exp2Syn(all_segments[segment_index])
+        if rnd.uniform() < 0.85:
+            synapse.e, synapse.tau1, synapse.tau2, interval, weight = 0, 0.3, 1.8, 1000 / 2.5, 0.0016
+        else:
+            synapse.e, synapse.tau1, synapse.tau2, interval, weight = -86, 1, 8, 1000 / 15.0, 0.0008
+
+        netstim = h.NetStim()
+        netstim.interval, netstim.number, netstim.start, netstim.noise = interval, 9e9, 100, 1
+        random = h.Random()
+        random.Random123(i)
+        random.negexp(1)
+        netstim.noiseFromRandom(random)
+
+        netcon = h.NetCon(netstim, synapse)
+        netcon.delay, netcon.weight[0] = 0, weight
+        synapses_list.append(synapse)
+        netstims_list.append(netstim)
+        netcons_list.append(netcon)
+        randoms_list.append(random)
+    return synapses_list, netcons_list, (netstims_list, randoms_list)
+
+
+def run_configuration(cell_name, n_synapses, expand=True):
+    '''builds, reduces and expands one cell, returns the timings of every stage'''
+    from test_neuron_reduce.subtree_reductor_func import subtree_reductor
+    from cable_expander_func import cable_expander
+    from test_neuron_reduce import instrumentation
+
+    totals = collections.OrderedDict()
+    start = time.perf_counter()
+    cell = CELL_BUILDERS[cell_name]()
+    synapses_list, netcons_list, keep_alive = add_synapses(cell, n_synapses)
+    totals['build'] = time.perf_counter() - start
+
+    timer = StageTimer()
+    counters = collections.OrderedDict()
+    instrumentation.enable()
+    with timed_stages(timer):
+        start = time.perf_counter()
+        reduced_cell, synapses_list, netcons_list = subtree_reductor(cell, synapses_list, netcons_list,
+                                                                     reduction_frequency=0)
+        totals['reduce'] = time.perf_counter() - start
+        counters['reduce'] = instrumentation.last_profile().counters
+
+        if expand:
+            furcation_x, nbranch = EXPANSIONS[cell_name]
+            np.random.seed(0)
+            start = time.perf_counter()
+            cable_expander(reduced_cell, [reduced_cell.hoc_model.apic[0]], [furcation_x], [nbranch],
+                           synapses_list, netcons_list, reduction_frequency=0)
+            totals['expand'] = time.perf_counter() - start
+            counters['expand'] = instrumentation.last_profile().counters
+    instrumentation.disable()
+
+    return {'cell': cell_name,
+            'synapses': n_synapses,
+            'totals': totals,
+            'stages': timer.results(),
+            'counters': counters}
+
+
+def run_in_fresh_process(function, *args):
+    '''calls function(*args) in a new process, returns (result, None), or (None, error) if
+    it raised or the process died (instead of waiting forever for a dead worker)'''
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(function, *args).result(), None
+        except concurrent.futures.process.BrokenProcessPool as error:
+            return None, 'the worker process died (%s)' % error
+        except Exception as error:
+            return None, '%s: %s' % (type(error).__name__, error)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(cell_names, synapse_counts, expand=True):
+    runs, failed = [], []
+    for cell_name in cell_names:
+        for n_synapses in synapse_counts:
+            run, error = run_in_fresh_process(run_configuration, cell_name, n_synapses, expand)
+            if error is not None:
+                print('{} {} synapses: FAILED, {}'.format(cell_name, n_synapses, error))
+                failed.append({'cell': cell_name, 'synapses': n_synapses, 'error': error})
+                continue
+            print('{cell} {synapses} synapses: '.format(**run) +
+                  ', '.join('{} {:.3f}s'.format(name, seconds) for name, seconds in run['totals'].items()))
+            runs.append(run)
+    return {'commit': git_commit(),
+            'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'python': platform.python_version(),
+            'neuron': neuron.__version__,
+            'runs': runs,
+            'failed': failed}
+
+
+def compare(old, new):
+    '''prints the time of every stage in the new results relative to the old'''
+    old_runs = {(run['cell'], run['synapses']): run for run in old['runs']}
+    print('{:<10} {:>8} {:<42} {:>10} {:>10} {:>7}'.format('cell', 'synapses', 'stage', 'old (s)', 'new (s)', 'ratio'))
+    for run in new['runs']:
+        old_run = old_runs.get((run['cell'], run['synapses']))
+        if old_run is None:
+            continue
+        rows = [(name, old_run['totals'].get(name), seconds) for name, seconds in run['totals'].items()]
+        rows += [(stage, old_run['stages'].get(stage, {}).get('seconds'), values['seconds'])
+                 for stage, values in run['stages'].items()]
+        for name, old_seconds, new_seconds in rows:
+            if old_seconds is None:
+                continue
+            print('{:<10} {:>8} {:<42} {:>10.4f} {:>10.4f} {:>7.2f}'.format(
+                run['cell'], run['synapses'], name, old_seconds, new_seconds,
+                new_seconds / old_seconds if old_seconds else float('nan')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='times every stage of the reduction and expansion')
+    parser.add_argument('--cells', nargs='+', default=['L5PC', 'stylized'], choices=sorted(CELL_BUILDERS))
+    parser.add_argument('--synapses', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--no-expand', action='store_true', help='only time the reduction')
+    parser.add_argument('--output', default='benchmark_stages.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            compare(json.load(f_old), json.load(f_new))
+    else:
+        results = run_benchmark(args.cells, args.synapses, expand=not args.no_expand)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('results written to %s' % args.output)
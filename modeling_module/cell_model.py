@@ -15,6 +15,7 @@ import matplotlib.pyplot as plt
 
 from stylized_module.recorder import Recorder
 from modeling_module.synapses import CurrentInjection, Synapse, Listed_Synapse
+from test_neuron_reduce.netcon_registry import NetConRegistry
 
 class cell_model():
   '''expanded cell model class for ECP calculation
@@ -187,30 +188,22 @@ class cell_model():
     '''
     store and record synapses from the list from model reduction algorithm
     '''
-    temp_list=[] # generate temp list that has each netcon's synapse obj
-    for netcon in self.netcons_list:
-      syn=netcon.syn()
-      if syn in self.synapses_list:
-        syn_seg_id=self.segments.index(netcon.syn().get_segment())
-        if syn in self.segments[syn_seg_id].point_processes():
-          temp_list.append(syn)
-        else:
-          temp_list.append(None)
-          print("Warning: synapse not in designated segment's point processes")
-
-      else:
-        temp_list.append(None)
-        print("Warning: potentially deleted synapse:","|NetCon obj:",netcon,"|Synapse obj:",syn,"the NetCon's synapse is not in synapses_list. Check corresponding original cell's NetCon for location, etc.")
-    # now use temp list to assign each synapse its netcons
+    registry=NetConRegistry(self.netcons_list,self.synapses_list) # each synapse's netcons, in one pass over the netcons
+    listed=np.zeros(len(registry)+1,dtype=bool) # the extra last item stands for NO_SYNAPSE (-1), which is never listed
+    listed[registry.add_synapses(self.synapses_list)]=True
+    post=registry.post
+    for netcon_id in np.flatnonzero(~listed[post]):
+      netcon=self.netcons_list[netcon_id]
+      print("Warning: potentially deleted synapse:","|NetCon obj:",netcon,"|Synapse obj:",netcon.syn(),"the NetCon's synapse is not in synapses_list. Check corresponding original cell's NetCon for location, etc.")
+    # now use the registry to assign each synapse its netcons
+    indptr,netcon_ids=registry.grouped_netcon_indices()
     for synapse in self.synapses_list:
-      synapse_netcons=[]
-      if synapse in temp_list:
-        num_netcons=temp_list.count(synapse)
-        START=0
-        for i in range(num_netcons):
-          netcon_id=temp_list.index(synapse,START) #get all the netcon indices that are pointed toward this synapse # use np.where() instead of index() to return multiple indices.
-          START=netcon_id+1
-          synapse_netcons.append(self.netcons_list[netcon_id])
+      synapse_index=registry.index_of(synapse)
+      synapse_netcons=[self.netcons_list[netcon_id] for netcon_id in netcon_ids[indptr[synapse_index]:indptr[synapse_index+1]]]
+      if synapse_netcons and synapse not in synapse.get_segment().point_processes():
+        print("Warning: synapse not in designated segment's point processes")
+        synapse_netcons=[]
+      if synapse_netcons:
         self.synapse.append(Listed_Synapse(synapse,synapse_netcons)) #record synapse and add to the list
       else:
         print('Warning: ', synapse, 'does not have any netcons pointing at it. if synapse is None then deleted synapse may be stored in synapses_list')
@@ -0,0 +1,198 @@
+'''
+NEURON-free frequency-domain solver for the impedances of passive dendritic trees
+
+The morphology and passive parameters of a subtree are exported once from
+NEURON into plain arrays (export_subtree_morphology), using NEURON's own
+discretization: a node at the center of every segment, a zero-area node at the
+distal (x=1) end of every section and one at the proximal end of the subtree
+root, connected by the axial resistances NEURON reports (seg.ri()).
+From there on the complex admittance matrix of the tree is assembled with
+scipy.sparse and solved directly, so the impedances needed by the reduction
+can be computed in worker processes, for many frequencies, without h.Impedance.
+
+The membrane of every node is treated as a conductance (g_pas by default) in
+parallel with its capacitance. For passive models the results agree with
+h.Impedance().compute(frequency, 0); for models with active mechanisms
+h.Impedance also includes their di/dv at the current membrane potential.
+'''
+import collections
+import logging
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+from .reducing_methods import (SubtreeImpedanceTable,
+                               subtree_sections,
+                               compute_q,
+                               reduce_subtree_impedances)
+
+logger = logging.getLogger(__name__)
+
+# node 0 is always the soma-proximal (x=0) end of the subtree root section,
+# the origin of the impedance calculations of the reduction.
+# sections are kept as names so the morphology can be pickled to other processes
+SubtreeMorphology = collections.namedtuple('SubtreeMorphology',
+                                           'sections, node_section_index, node_x, parent, '
+                                           'area, ri, cm, g_m, '
+                                           'table_section_index, table_x, table_node, '
+                                           'root_cm, root_rm, root_ra, root_e_pas')
+ROOT_NODE = 0
+
+
+def export_subtree_morphology(subtree_root_section, conductance='g_pas'):
+    '''exports the passive cable of the subtree with the given root section into arrays
+
+    conductance - the name of the range variable holding the membrane
+    conductance of every segment (in S/cm2), or a function of the segment that
+    returns it. The subtree is exported as if it was disconnected from its
+    parent (as done by the reduction before the subtrees are reduced), so it
+    does not have to be disconnected.
+    '''
+    if isinstance(conductance, str):
+        range_var = conductance
+        conductance = lambda seg: getattr(seg, range_var)
+
+    sections = subtree_sections(subtree_root_section)
+
+    # per node: section index, x, parent node, area (um2), resistance to the
+    # parent node (Mohms), cm (uF/cm2), membrane conductance (S/cm2)
+    node_section_index, node_x, parent, area, ri, cm, g_m = [0], [0.0], [-1], [0.0], [np.inf], [0.0], [0.0]
+    # the node of every (section, x) in the SubtreeImpedanceTable layout
+    table_section_index, table_x, table_node = [], [], []
+    center_nodes = {}
+    distal_node = {}
+
+    def add_node(sec_index, x, parent_node, node_area, node_ri, node_cm, node_g):
+        node_section_index.append(sec_index)
+        node_x.append(x)
+        parent.append(parent_node)
+        area.append(node_area)
+        ri.append(node_ri)
+        cm.append(node_cm)
+        g_m.append(node_g)
+        return len(node_x) - 1
+
+    def node_of(sec, x):
+        '''the node NEURON uses for the location x of the (already exported) section'''
+        if x >= 1:
+            return distal_node[sec]
+        if x <= 0:
+            if sec == subtree_root_section:
+                return ROOT_NODE
+            return node_of(sec.parentseg().sec, sec.parentseg().x)
+        return center_nodes[sec][min(int(x * sec.nseg), sec.nseg - 1)]
+
+    # subtree_sections lists every parent before its children
+    for sec_index, sec in enumerate(sections):
+        prev_node = ROOT_NODE if sec == subtree_root_section else node_of(sec.parentseg().sec,
+                                                                          sec.parentseg().x)
+        center_nodes[sec] = []
+        for seg in sec:
+            prev_node = add_node(sec_index, seg.x, prev_node, seg.area(), seg.ri(), seg.cm, conductance(seg))
+            center_nodes[sec].append(prev_node)
+        distal_node[sec] = add_node(sec_index, 1.0, prev_node, 0.0, sec(1).ri(), 0.0, 0.0)
+
+        sec_xs = [0.0] + [seg.x for seg in sec] + [1.0]
+        table_section_index.extend([sec_index] * len(sec_xs))
+        table_x.extend(sec_xs)
+        table_node.extend(node_of(sec, x) for x in sec_xs)
+
+    return SubtreeMorphology(sections=[sec.name() for sec in sections],
+                             node_section_index=np.array(node_section_index),
+                             node_x=np.array(node_x),
+                             parent=np.array(parent),
+                             area=np.array(area),
+                             ri=np.array(ri),
+                             cm=np.array(cm),
+                             g_m=np.array(g_m),
+                             table_section_index=np.array(table_section_index),
+                             table_x=np.array(table_x),
+                             table_node=np.array(table_node),
+                             root_cm=subtree_root_section.cm,
+                             root_rm=1.0 / subtree_root_section.g_pas,
+                             root_ra=subtree_root_section.Ra,
+                             root_e_pas=subtree_root_section.e_pas)
+
+
+def admittance_matrix(morphology, frequency):
+    '''returns the complex admittance matrix (in Siemens) of the tree at the given frequency'''
+    n_nodes = len(morphology.node_x)
+    children = np.flatnonzero(morphology.parent >= 0)
+    parents = morphology.parent[children]
+    axial_g = 1.0 / (morphology.ri[children] * 1000000)  # Mohms -> S
+
+    area_in_cm2 = morphology.area * 1e-8
+    membrane_y = area_in_cm2 * (morphology.g_m + 2j * np.pi * frequency * morphology.cm * 1e-6)
+
+    diagonal = membrane_y.astype(complex)
+    np.add.at(diagonal, children, axial_g)
+    np.add.at(diagonal, parents, axial_g)
+
+    rows = np.concatenate([np.arange(n_nodes), children, parents])
+    cols = np.concatenate([np.arange(n_nodes), parents, children])
+    values = np.concatenate([diagonal, -axial_g, -axial_g]).astype(complex)
+    return scipy.sparse.csc_matrix((values, (rows, cols)), shape=(n_nodes, n_nodes))
+
+
+def solve_transfer_impedances(morphology, frequencies, origin=ROOT_NODE):
+    '''returns the complex transfer impedances (in Ohms) between the origin node and every node
+
+    frequencies - a frequency or a sequence of frequencies (Hz). Returns an
+    array of shape (len(frequencies), nodes), or (nodes,) for a single
+    frequency. The input impedance at the origin is the value of the origin node.
+    '''
+    single_frequency = np.ndim(frequencies) == 0
+    frequencies = np.atleast_1d(frequencies)
+
+    current = np.zeros(len(morphology.node_x), dtype=complex)
+    current[origin] = 1  # injecting 1A at the origin, the voltage is the transfer impedance
+    impedances = np.empty((len(frequencies), len(morphology.node_x)), dtype=complex)
+    for i, frequency in enumerate(frequencies):
+        impedances[i] = scipy.sparse.linalg.splu(admittance_matrix(morphology, frequency)).solve(current)
+
+    return impedances[0] if single_frequency else impedances
+
+
+def impedance_table(morphology, frequency, impedances=None):
+    '''returns the SubtreeImpedanceTable of the subtree at the given frequency
+
+    the sections of the table are the section names of the morphology
+    '''
+    if impedances is None:
+        impedances = solve_transfer_impedances(morphology, frequency)
+    table_impedances = impedances[morphology.table_node]
+    return SubtreeImpedanceTable(morphology.sections,
+                                 morphology.table_section_index,
+                                 morphology.table_x,
+                                 np.abs(table_impedances),
+                                 np.angle(table_impedances),
+                                 root_input_impedance=complex(impedances[ROOT_NODE]))
+
+
+def reduce_subtree_from_impedances(morphology, frequency, impedances):
+    '''returns the CableParams of the reduced cable, given the solved transfer impedances of the subtree'''
+    q = compute_q(morphology.root_rm, morphology.root_cm, frequency)
+    lowest_impedance = impedances[np.argmin(np.abs(impedances))]
+    return reduce_subtree_impedances(complex(impedances[ROOT_NODE]),
+                                     complex(lowest_impedance),
+                                     morphology.root_cm,
+                                     morphology.root_rm,
+                                     morphology.root_ra,
+                                     morphology.root_e_pas,
+                                     q)
+
+
+def reduce_subtree_from_morphology(morphology, frequencies):
+    '''the NEURON-free version of reducing_methods.reduce_subtree
+
+    returns the CableParams of the reduced cable for the given frequency, or a
+    list of CableParams for a sequence of frequencies
+    '''
+    single_frequency = np.ndim(frequencies) == 0
+    frequencies = np.atleast_1d(frequencies)
+    all_impedances = solve_transfer_impedances(morphology, frequencies)
+
+    cables = [reduce_subtree_from_impedances(morphology, frequency, impedances)
+              for frequency, impedances in zip(frequencies, all_impedances)]
+    return cables[0] if single_frequency else cables
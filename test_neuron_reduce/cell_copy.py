@@ -0,0 +1,197 @@
+'''
+Copying a cell, with its synapses and NetCons, so it can be reduced (or
+expanded) without destroying the original
+
+subtree_reductor and cable_expander work in place: they strip the active
+mechanisms of the original dendrites, move the synapses onto the new cables and
+delete the original sections. With in_place=False they first copy the cell
+here, work on the copy, and the original cell, synapses and NetCons stay as
+they were, so both models can be simulated, even together in one h.run().
+
+The copy is made of Python sections, named like the originals
+(CellCopy[0].apic[3]), with the same 3d points (or L and diam), nseg, Ra, cm,
+topology and density mechanisms (see mechanism_snapshot). Every synapse is
+replaced by a new point process of the same type with the same PARAMETER
+values, and every NetCon by a NetCon from the same source with the same
+weights, delay and threshold. Other point processes (e.g. stimulating
+electrodes) are not copied.
+'''
+import itertools
+import logging
+import re
+
+import neuron
+from neuron import h
+
+from .mechanism_snapshot import MechanismSnapshot
+from .point_process_params import type_of_point_process, point_process_mechanism_names
+
+logger = logging.getLogger(__name__)
+
+SECTION_LISTS = ('all', 'somatic', 'basal', 'apical', 'axonal', )
+SECTION_ARRAYS = ('soma', 'dend', 'apic', 'axon', )
+PARAMETERS = 1  # MechanismStandard vartype of PARAMETER variables
+
+
+class CellCopy(object):
+    '''a copy of a cell, with the section lists and section arrays of a hoc cell template'''
+    _copies = itertools.count()
+
+    def __init__(self):
+        self.name = 'CellCopy[%d]' % next(self._copies)
+        for list_name in SECTION_LISTS:
+            setattr(self, list_name, h.SectionList())
+        for array_name in SECTION_ARRAYS:
+            setattr(self, array_name, [])
+        self.sections = []  # keeps the Python sections alive
+
+    def __str__(self):
+        return self.name
+
+
+def _relative_name(section):
+    return section.name().split('.')[-1]
+
+
+def copy_section(section, cell_copy):
+    '''creates a disconnected copy of the geometry, passive properties and mechanisms of the section'''
+    new_section = h.Section(name=_relative_name(section), cell=cell_copy)
+    if section.n3d() > 0:
+        for i in range(section.n3d()):
+            h.pt3dadd(section.x3d(i), section.y3d(i), section.z3d(i), section.diam3d(i), sec=new_section)
+    else:
+        new_section.L = section.L
+    new_section.Ra = section.Ra
+    new_section.nseg = section.nseg
+    for seg, new_seg in zip(section, new_section):
+        if section.n3d() == 0:
+            new_seg.diam = seg.diam
+        new_seg.cm = seg.cm
+    return new_section
+
+
+def copy_sections(sections, cell_copy):
+    '''copies the sections and the topology between them, returns a dict of section -> copy'''
+    section_map = {}
+    for section in sections:
+        section_map[section] = copy_section(section, cell_copy)
+        cell_copy.sections.append(section_map[section])
+
+    # NEURON orders the children of a section by their x on it, and puts a newly
+    # connected child first among those at the same x, so connecting the
+    # children of every parent in reverse keeps their order (gather_subtrees
+    # numbers the subtrees in the order of the children of the soma)
+    for section in sections:
+        children = [child for child in h.SectionRef(sec=section).child if child in section_map]
+        for child in reversed(children):
+            section_map[child].connect(section_map[section](child.parentseg().x), child.orientation())
+
+    MechanismSnapshot.from_sections(sections).apply(
+        [seg for section in sections for seg in section_map[section]])
+    return section_map
+
+
+def copy_point_process(point_process, segment):
+    '''creates a point process of the same type at the segment, with the same PARAMETER values'''
+    pp_type = type_of_point_process(point_process)
+    new_point_process = getattr(h, pp_type)(segment)
+    if pp_type in point_process_mechanism_names():
+        mechanism_standard = h.MechanismStandard(pp_type, PARAMETERS)
+        getattr(mechanism_standard, 'in')(point_process)
+        mechanism_standard.out(new_point_process)
+    else:  # e.g. a hoc template, copies what can be copied
+        for param in dir(point_process):
+            if param.startswith('__'):
+                continue
+            value = getattr(point_process, param)
+            if isinstance(value, (int, float)):
+                try:
+                    setattr(new_point_process, param, value)
+                except (LookupError, TypeError, ValueError, RuntimeError):
+                    pass
+    return new_point_process
+
+
+def copy_netcon(netcon, target):
+    '''creates a NetCon from the source of the given one to target, with the same weights, delay and threshold'''
+    source_seg = netcon.preseg()
+    if source_seg is not None:
+        new_netcon = h.NetCon(source_seg._ref_v, target, sec=source_seg.sec)
+    else:
+        new_netcon = h.NetCon(netcon.pre(), target)
+    new_netcon.threshold = netcon.threshold
+    new_netcon.delay = netcon.delay
+    for i in range(int(netcon.wcnt())):
+        new_netcon.weight[i] = netcon.weight[i]
+    return new_netcon
+
+
+def _copy_attribute(value, section_map):
+    if value is None:
+        return None
+    if isinstance(value, neuron.nrn.Section):
+        return section_map.get(value)
+    return [section_map[section] for section in value if section in section_map]
+
+
+def _section_array_index(section):
+    numbers = re.findall(r'\[(\d+)\]', _relative_name(section))
+    return int(numbers[-1]) if numbers else 0
+
+
+def copy_cell(original_cell, synapses_list, netcons_list):
+    '''copies the cell, the synapses and the NetCons
+
+    original_cell - a hoc cell (with soma and the all, somatic, basal, apical
+    and axonal section lists) or a Neuron wrapper of one (as returned by
+    subtree_reductor), the whole tree connected to its soma is copied
+
+    Returns the copy of the cell (of the same kind as original_cell), the
+    copied synapses and NetCons (in the order of the given lists) and the dict
+    of original section -> copied section
+    '''
+    hoc_cell = getattr(original_cell, 'hoc_model', original_cell)
+    soma = original_cell.soma
+    if not isinstance(soma, neuron.nrn.Section):
+        soma = soma[0]
+
+    cell_copy = CellCopy()
+    sections = list(soma.wholetree())
+    section_map = copy_sections(sections, cell_copy)
+
+    for list_name in SECTION_LISTS:
+        section_list = getattr(hoc_cell, list_name, None)
+        if section_list is None:
+            continue
+        for section in section_list:
+            if section in section_map:
+                getattr(cell_copy, list_name).append(section_map[section])
+
+    for section in sorted(sections, key=_section_array_index):
+        array_name = _relative_name(section).split('[')[0]
+        if array_name in SECTION_ARRAYS:
+            getattr(cell_copy, array_name).append(section_map[section])
+
+    if hoc_cell is not original_cell:  # a Neuron wrapper
+        new_cell = type(original_cell)(cell_copy)
+        for array_name in SECTION_ARRAYS:
+            setattr(new_cell, array_name, _copy_attribute(getattr(original_cell, array_name, None), section_map))
+    else:
+        new_cell = cell_copy
+
+    synapse_map = {}
+
+    def copied_synapse(synapse):
+        if synapse not in synapse_map:
+            seg = synapse.get_segment()
+            if seg.sec not in section_map:
+                raise ValueError('the synapse %s is not on the cell %s' % (synapse.hname(), soma.name()))
+            synapse_map[synapse] = copy_point_process(synapse, section_map[seg.sec](seg.x))
+        return synapse_map[synapse]
+
+    new_synapses_list = [copied_synapse(synapse) for synapse in synapses_list]
+    new_netcons_list = [copy_netcon(netcon, copied_synapse(netcon.syn())) for netcon in netcons_list]
+    logger.debug('copied %d sections, %d synapses and %d netcons' % (len(sections),
+                                                                      len(synapse_map),
+                                                                      len(new_netcons_list)))
+    return new_cell, new_synapses_list, new_netcons_list, section_map
@@ -0,0 +1,168 @@
+'''
+Sweeping the reduction over several reduction frequencies
+
+subtree_reductor destroys the original cell (or, with in_place=False, copies
+it first), so trying several values of reduction_frequency means rebuilding or
+copying the full model for every run. The
+functions here compute the reduction plan - the CableParams and nseg of every
+reduced cable and the new location of every synapse - without touching the
+original cell: the subtrees are walked and exported once (cable_solver), and
+only the impedance solve and the cable math are repeated per frequency.
+
+usage:
+    def build_cell():
+        h.load_file('L5PCbiophys3.hoc')
+        h.load_file('import3d.hoc')
+        h.load_file('L5PCtemplate.hoc')
+        cell = h.L5PCtemplate('cell1.asc')
+        synapses_list = ...
+        return cell, synapses_list
+
+    plans = reduction_frequency_sweep(build_cell, [0, 10, 50, 100], processes=4)
+
+build_cell runs once in every worker process, so it must be a module level
+(picklable) function.
+'''
+import collections
+import logging
+import multiprocessing
+
+import numpy as np
+from neuron import h
+
+from .reducing_methods import reduce_synapses, find_merged_loc, compute_q
+from .subtree_reductor_func import (find_and_disconnect_axon,
+                                    gather_subtrees,
+                                    gather_cell_subtrees,
+                                    find_synapse_locs,
+                                    calculate_nsegs)
+from . import cable_solver
+
+logger = logging.getLogger(__name__)
+
+# the frequency independent part of the reduction of a cell
+CellSubtrees = collections.namedtuple('CellSubtrees',
+                                      'morphologies, original_cell_seg_n, '
+                                      'synapse_subtree_index, synapse_section, synapse_x')
+
+# synapse_subtree_index is -1 for somatic synapses, which stay where they are.
+# synapse_x is the new location of the synapse on the cable of its subtree
+# (index i of the cables is subtree i, the apical, if it exists, is the first)
+# and synapse_segment the index of the cable segment it is merged into
+ReductionPlan = collections.namedtuple('ReductionPlan',
+                                       'frequency, cable_params, nsegs, '
+                                       'synapse_subtree_index, synapse_x, synapse_segment')
+
+_worker_state = {}
+
+
+def gather_reduction_inputs(original_cell, synapses_list):
+    '''walks the morphology of the cell once and exports its subtrees, leaves the cell as it was'''
+    soma = original_cell.soma[0]
+    soma_ref = h.SectionRef(sec=soma)
+    axon_section, axon_is_parent, soma_axon_x = find_and_disconnect_axon(soma_ref)
+    try:
+        roots_of_subtrees, _ = gather_subtrees(soma_ref)
+        _, _, mapping_sections_to_subtree_index = gather_cell_subtrees(roots_of_subtrees)
+    finally:
+        # Connect axon back to the soma
+        if len(axon_section) > 0:
+            if axon_is_parent:
+                soma.connect(axon_section[0])
+            else:
+                axon_section[0].connect(soma, soma_axon_x)
+
+    morphologies = [cable_solver.export_subtree_morphology(root) for root in roots_of_subtrees]
+
+    synapse_segments = [synapse.get_segment() for synapse in synapses_list]
+    synapse_subtree_index, _, _ = find_synapse_locs(synapse_segments, mapping_sections_to_subtree_index)
+
+    original_cell_seg_n = (sum(i.nseg for i in list(original_cell.basal)) +
+                           sum(i.nseg for i in list(original_cell.apical)))
+
+    return CellSubtrees(morphologies=morphologies,
+                        original_cell_seg_n=original_cell_seg_n,
+                        synapse_subtree_index=synapse_subtree_index,
+                        synapse_section=[seg.sec.name() for seg in synapse_segments],
+                        synapse_x=np.array([seg.x for seg in synapse_segments]))
+
+
+def plan_reduction(cell_subtrees, reduction_frequency, total_segments_manual=-1, nseg_policy=None):
+    '''returns the ReductionPlan of the cell (given as CellSubtrees) at the given frequency'''
+    all_impedances = [cable_solver.solve_transfer_impedances(morphology, reduction_frequency)
+                      for morphology in cell_subtrees.morphologies]
+    cable_params = [cable_solver.reduce_subtree_from_impedances(morphology, reduction_frequency, impedances)
+                    for morphology, impedances in zip(cell_subtrees.morphologies, all_impedances)]
+    nsegs = calculate_nsegs(cable_params, total_segments_manual, cell_subtrees.original_cell_seg_n, nseg_policy)
+
+    synapse_x = cell_subtrees.synapse_x.copy()
+    synapse_segment = np.zeros(len(synapse_x), dtype=int)
+    for subtree_index, morphology in enumerate(cell_subtrees.morphologies):
+        synapse_indices = np.flatnonzero(cell_subtrees.synapse_subtree_index == subtree_index)
+        if len(synapse_indices) == 0:
+            continue
+        new_xs = reduce_synapses(cable_solver.impedance_table(morphology,
+                                                              reduction_frequency,
+                                                              all_impedances[subtree_index]),
+                                 [cell_subtrees.synapse_section[i] for i in synapse_indices],
+                                 cell_subtrees.synapse_x[synapse_indices],
+                                 cable_params[subtree_index].electrotonic_length,
+                                 compute_q(morphology.root_rm, morphology.root_cm, reduction_frequency))
+        synapse_x[synapse_indices] = new_xs
+        merged_xs = np.array([find_merged_loc(nsegs[subtree_index], x) for x in new_xs])
+        synapse_segment[synapse_indices] = np.minimum((merged_xs * nsegs[subtree_index]).astype(int),
+                                                      nsegs[subtree_index] - 1)
+
+    return ReductionPlan(frequency=reduction_frequency,
+                         cable_params=cable_params,
+                         nsegs=nsegs,
+                         synapse_subtree_index=cell_subtrees.synapse_subtree_index,
+                         synapse_x=synapse_x,
+                         synapse_segment=synapse_segment)
+
+
+def plan_reductions(original_cell, synapses_list, reduction_frequencies, total_segments_manual=-1,
+                    nseg_policy=None):
+    '''returns the ReductionPlans of the cell for all the given frequencies, in this process'''
+    cell_subtrees = gather_reduction_inputs(original_cell, synapses_list)
+    return [plan_reduction(cell_subtrees, frequency, total_segments_manual, nseg_policy)
+            for frequency in reduction_frequencies]
+
+
+def predict_nsegs(original_cell, reduction_frequency, total_segments_manual=-1, nseg_policy=None):
+    '''returns the number of segments of every reduced cable that subtree_reductor
+    would create with the same arguments, leaves the cell as it was'''
+    return plan_reductions(original_cell, [], [reduction_frequency], total_segments_manual, nseg_policy)[0].nsegs
+
+
+def _initialize_worker(cell_builder):
+    '''builds the cell once per worker process and keeps its exported subtrees'''
+    original_cell, synapses_list = cell_builder()
+    _worker_state['cell'] = (original_cell, synapses_list)  # keeps the hoc objects alive
+    _worker_state['cell_subtrees'] = gather_reduction_inputs(original_cell, synapses_list)
+
+
+def _plan_reduction_in_worker(args):
+    reduction_frequency, total_segments_manual, nseg_policy = args
+    return plan_reduction(_worker_state['cell_subtrees'], reduction_frequency, total_segments_manual, nseg_policy)
+
+
+def reduction_frequency_sweep(cell_builder, reduction_frequencies, total_segments_manual=-1, processes=None,
+                              nseg_policy=None):
+    '''computes the ReductionPlan of a cell for every given frequency in a pool of worker processes
+
+    cell_builder - a picklable function with no arguments that returns
+                   (cell, synapses_list), called once in every worker
+    processes - the number of workers (None = number of CPUs)
+
+    Returns a dict of frequency -> ReductionPlan
+    '''
+    reduction_frequencies = list(reduction_frequencies)
+    pool = multiprocessing.Pool(processes, initializer=_initialize_worker, initargs=(cell_builder,))
+    try:
+        plans = pool.map(_plan_reduction_in_worker,
+                         [(frequency, total_segments_manual, nseg_policy) for frequency in reduction_frequencies])
+    finally:
+        pool.close()
+        pool.join()
+    return collections.OrderedDict(zip(reduction_frequencies, plans))
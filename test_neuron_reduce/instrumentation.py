@@ -0,0 +1,174 @@
+'''
+Per-stage durations and counters of the reduction and the expansion
+
+Disabled by default, in which case every hook is a global lookup and a
+comparison. Once enabled, every call of subtree_reductor (or cable_expander)
+records a Profile: the wall clock time and number of calls of its stages, and
+counters of the work done (impedance computes, synapses merged and moved,
+NetCons re-pointed, mechanisms inserted, orphan segments filled, ...).
+
+usage:
+    from test_neuron_reduce import instrumentation
+    instrumentation.enable(dump=print)  # prints the summary after every call
+    subtree_reductor(...)
+    profile = instrumentation.last_profile()
+    profile.counters['synapses_merged'], profile.as_dict()
+
+    instrumentation.disable()
+
+the code under a profile reports through stage() (or the timed decorator) and count().
+'''
+import collections
+import functools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_dump = None
+_active = None  # the Profile of the call in progress
+_last = None
+
+
+class Profile(object):
+    '''the durations of the stages and the counters of one profiled call'''
+    def __init__(self, name):
+        self.name = name
+        self.total = 0.
+        self.seconds = collections.OrderedDict()
+        self.calls = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def as_dict(self):
+        return {'name': self.name,
+                'total': self.total,
+                'stages': collections.OrderedDict((stage, {'seconds': self.seconds[stage],
+                                                           'calls': self.calls[stage]})
+                                                  for stage in self.seconds),
+                'counters': dict(self.counters)}
+
+    def summary(self):
+        lines = ['%s: %.3fs' % (self.name, self.total)]
+        for stage, seconds in self.seconds.items():
+            lines.append('  %-40s %9.4fs %6d calls' % (stage, seconds, self.calls[stage]))
+        for counter, n in self.counters.items():
+            lines.append('  %-40s %9d' % (counter, n))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.summary()
+
+
+def enable(dump=None):
+    '''starts profiling, dump (e.g. print or logger.info) is called with every finished Profile'''
+    global _enabled, _dump
+    _enabled = True
+    _dump = dump
+
+
+def disable():
+    global _enabled, _dump
+    _enabled = False
+    _dump = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def last_profile():
+    '''the Profile of the last finished call, None if nothing was profiled'''
+    return _last
+
+
+def count(counter, n=1):
+    '''adds n to the counter of the call in progress, if it is profiled'''
+    if _active is not None:
+        _active.count(counter, n)
+
+
+class _Stage(object):
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    '''context manager timing a stage of the call in progress, if it is profiled'''
+    if _active is None:
+        return _NULL_STAGE
+    return _Stage(_active, name)
+
+
+def timed(function):
+    '''decorator timing every call of the function as a stage (named after the function)'''
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return function(*args, **kwargs)
+        with _Stage(_active, name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def profiled(function):
+    '''decorator recording a Profile for every (outermost) call of the function
+
+    a profiled function called within another profiled call is one of its stages
+    '''
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        global _active, _last
+        if not _enabled:
+            return function(*args, **kwargs)
+        if _active is not None:
+            with _Stage(_active, name):
+                return function(*args, **kwargs)
+
+        profile = _active = Profile(name)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.total = time.perf_counter() - start
+            _active = None
+            _last = profile
+            logger.debug(profile.summary())
+            if _dump is not None:
+                _dump(profile)
+    return wrapper
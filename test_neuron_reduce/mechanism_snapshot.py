@@ -0,0 +1,237 @@
+'''
+Columnar snapshot of the density mechanisms of a set of sections
+
+Instead of a dict of dicts of values per segment, every mechanism is kept as
+a 2D array of values (segments that have the mechanism x parameters) plus the
+index of those segments in the snapshot. The parameters of a mechanism are
+listed once per mechanism type, not once per segment.
+
+The snapshot can be saved to and loaded from a .npz file, and reapplied to
+sections with the same layout. For the code that expects the old
+segment -> {mechanism name: {parameter name: value}} dict, a snapshot taken
+from live sections is also a read-only mapping with that layout.
+'''
+import collections
+import logging
+
+import numpy as np
+
+from . import instrumentation
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+
+logger = logging.getLogger(__name__)
+
+SKIPPED_MECHANISMS = ('extracellular', )
+_SKIPPED_ATTRIBUTES = ('next', 'name', 'is_ion', 'segment', )
+
+# params - the full hoc names of the parameters of the mechanism (e.g. gbar_Ih)
+# segment_index - the index (in the snapshot) of every segment that has the mechanism
+# values - array of shape (len(segment_index), len(params))
+MechanismColumns = collections.namedtuple('MechanismColumns', 'params, segment_index, values')
+
+
+def mechanism_param_names(mech):
+    '''returns the hoc names of the range variables of the given mechanism of a segment'''
+    mech_name = mech.name()
+    names = []
+    for n in dir(mech):
+        if n.startswith('__') or n in _SKIPPED_ATTRIBUTES:
+            continue
+
+        if not n.endswith('_' + mech_name) and not mech_name.endswith('_ion'):
+            n += '_' + mech_name
+        names.append(n)
+    return names
+
+
+def _grouped_sum(values, groups, n_groups):
+    sums = np.zeros((n_groups, values.shape[1]))
+    np.add.at(sums, groups, values)
+    return sums
+
+
+def mean_reducer(values, groups, n_groups, areas):
+    '''the mean of the values in every group'''
+    counts = np.bincount(groups, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _grouped_sum(values, groups, n_groups) / counts[:, None]
+
+
+def area_weighted_mean_reducer(values, groups, n_groups, areas):
+    '''the mean of the values in every group, weighted by the area of their segments'''
+    total_areas = np.bincount(groups, weights=areas, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _grouped_sum(values * areas[:, None], groups, n_groups) / total_areas[:, None]
+
+
+def max_reducer(values, groups, n_groups, areas):
+    '''the maximal value in every group'''
+    maxima = np.full((n_groups, values.shape[1]), -np.inf)
+    np.maximum.at(maxima, groups, values)
+    return maxima
+
+
+# reducer(values (pairs x params), group of every pair, number of groups, area of the segment of every pair)
+#  -> (groups x params) array
+REDUCERS = {'mean': mean_reducer,
+            'area_weighted_mean': area_weighted_mean_reducer,
+            'max': max_reducer}
+
+
+class MechanismSnapshot(Mapping):
+    '''the values of the density mechanisms of a list of segments, per mechanism'''
+
+    def __init__(self, section_names, segment_x, segment_area, mechanisms, segments=None):
+        self.section_names = np.asarray(section_names)
+        self.segment_x = np.asarray(segment_x, dtype=float)
+        self.segment_area = np.asarray(segment_area, dtype=float)
+        self.mechanisms = collections.OrderedDict(mechanisms)
+        self.segments = segments
+        self._segment_to_index = None
+        self._rows = None
+
+    @classmethod
+    def from_sections(cls, sections, skipped_mechanisms=SKIPPED_MECHANISMS):
+        '''reads the mechanisms of all the segments of the given sections'''
+        segments = [seg for sec in sections for seg in sec]
+        params_of_mechanism = collections.OrderedDict()
+        rows = collections.defaultdict(list)
+        values = collections.defaultdict(list)
+        for i, seg in enumerate(segments):
+            for mech in seg:
+                mech_name = mech.name()
+                if mech_name in skipped_mechanisms:
+                    continue
+                if mech_name not in params_of_mechanism:
+                    params_of_mechanism[mech_name] = mechanism_param_names(mech)
+                rows[mech_name].append(i)
+                values[mech_name].append([getattr(seg, n) for n in params_of_mechanism[mech_name]])
+
+        mechanisms = collections.OrderedDict(
+            (mech_name, MechanismColumns(params=list(params),
+                                         segment_index=np.array(rows[mech_name], dtype=int),
+                                         values=np.array(values[mech_name], dtype=float).reshape(
+                                             len(rows[mech_name]), len(params))))
+            for mech_name, params in params_of_mechanism.items())
+
+        return cls(section_names=[seg.sec.name() for seg in segments],
+                   segment_x=[seg.x for seg in segments],
+                   segment_area=[seg.area() for seg in segments],
+                   mechanisms=mechanisms,
+                   segments=segments)
+
+    @property
+    def mechanism_names(self):
+        return list(self.mechanisms)
+
+    def save(self, path):
+        '''saves the snapshot (without the live segments) to a .npz file'''
+        arrays = {'section_names': self.section_names,
+                  'segment_x': self.segment_x,
+                  'segment_area': self.segment_area,
+                  'mechanism_names': np.array(self.mechanism_names)}
+        for i, (mech_name, columns) in enumerate(self.mechanisms.items()):
+            arrays['params_%d' % i] = np.array(columns.params)
+            arrays['segment_index_%d' % i] = columns.segment_index
+            arrays['values_%d' % i] = columns.values
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path, segments=None):
+        '''loads a snapshot saved with save(), optionally attaching it to live segments'''
+        with np.load(path, allow_pickle=False) as arrays:
+            mechanisms = collections.OrderedDict(
+                (str(mech_name), MechanismColumns(params=[str(p) for p in arrays['params_%d' % i]],
+                                                  segment_index=arrays['segment_index_%d' % i],
+                                                  values=arrays['values_%d' % i]))
+                for i, mech_name in enumerate(arrays['mechanism_names']))
+            return cls(section_names=arrays['section_names'],
+                       segment_x=arrays['segment_x'],
+                       segment_area=arrays['segment_area'],
+                       mechanisms=mechanisms,
+                       segments=segments)
+
+    def apply(self, segments=None):
+        '''inserts the mechanisms (once per section) and sets their values on
+        the given segments, which correspond one to one to the snapshot segments'''
+        segments = self.segments if segments is None else list(segments)
+        assert len(segments) == len(self.segment_x), 'the segments do not match the snapshot'
+        for mech_name, columns in self.mechanisms.items():
+            sections = {segments[i].sec for i in columns.segment_index}
+            for sec in sections:
+                sec.insert(mech_name)
+            instrumentation.count('mechanisms_inserted', len(sections))
+            for i, row in zip(columns.segment_index, columns.values):
+                for n, value in zip(columns.params, row):
+                    setattr(segments[i], n, value)
+
+    def aggregate(self, original_index, group_index, segments, reducer='mean'):
+        '''aggregates the values of groups of snapshot segments into a snapshot of the given segments
+
+        original_index, group_index - parallel arrays of pairs (index of a
+        segment in this snapshot, index of the segment in segments it is
+        grouped into), a segment may be in several groups
+        reducer - the name of a reducer in REDUCERS or a function with the same signature
+
+        the aggregated snapshot has, for every mechanism, the segments that
+        received at least one segment with that mechanism
+        '''
+        reducer = REDUCERS[reducer] if isinstance(reducer, str) else reducer
+        original_index = np.asarray(original_index, dtype=int)
+        group_index = np.asarray(group_index, dtype=int)
+        n_groups = len(segments)
+
+        mechanisms = collections.OrderedDict()
+        for mech_name, columns in self.mechanisms.items():
+            row_of_segment = np.full(len(self.segment_x), -1)
+            row_of_segment[columns.segment_index] = np.arange(len(columns.segment_index))
+            rows = row_of_segment[original_index]
+            has_mech = rows >= 0
+            groups = group_index[has_mech]
+            if len(groups) == 0:
+                continue
+            aggregated = reducer(columns.values[rows[has_mech]],
+                                 groups,
+                                 n_groups,
+                                 self.segment_area[original_index[has_mech]])
+            groups_with_mech = np.flatnonzero(np.bincount(groups, minlength=n_groups))
+            mechanisms[mech_name] = MechanismColumns(params=columns.params,
+                                                     segment_index=groups_with_mech,
+                                                     values=aggregated[groups_with_mech])
+
+        return MechanismSnapshot(section_names=[seg.sec.name() for seg in segments],
+                                 segment_x=[seg.x for seg in segments],
+                                 segment_area=[seg.area() for seg in segments],
+                                 mechanisms=mechanisms,
+                                 segments=list(segments))
+
+    def segment_index(self, seg):
+        '''the index of the live segment in the snapshot'''
+        return self._index()[seg]
+
+    # Mapping of segment -> {mech name: {param name: value}}, for live snapshots
+    def _index(self):
+        if self._segment_to_index is None:
+            if self.segments is None:
+                raise KeyError('the snapshot is not attached to live segments')
+            self._segment_to_index = {seg: i for i, seg in enumerate(self.segments)}
+            self._rows = [[] for _ in self.segments]
+            for mech_name, columns in self.mechanisms.items():
+                for row, i in enumerate(columns.segment_index):
+                    self._rows[i].append((mech_name, row))
+        return self._segment_to_index
+
+    def __getitem__(self, seg):
+        i = self._index()[seg]
+        return {mech_name: dict(zip(self.mechanisms[mech_name].params, self.mechanisms[mech_name].values[row]))
+                for mech_name, row in self._rows[i]}
+
+    def __iter__(self):
+        return iter(self.segments or [])
+
+    def __len__(self):
+        return len(self.segment_x)
@@ -0,0 +1,112 @@
+'''
+The synapse <-> NetCon relation of a list of NetCons, kept up to date as they are re-pointed
+
+NEURON only knows the synapse of a NetCon (netcon.syn()), finding the NetCons
+of a synapse means scanning all of them. NetConRegistry scans them once and
+keeps both directions: synapse -> NetCons and NetCon -> synapse index, the
+latter as an integer array for vectorized use. The code that re-points NetCons
+(netcon.setpost) does it through NetConRegistry.setpost, which updates both maps.
+
+usage:
+    registry = NetConRegistry(netcons_list, synapses_list)
+    for netcon in registry[synapse]:  # the NetCons of the synapse, in netcons_list order
+        registry.setpost(netcon, other_synapse)
+    registry.post  # synapse index of every NetCon (-1 if it has no synapse)
+    indptr, netcon_indices = registry.grouped_netcon_indices()
+'''
+import numpy as np
+
+NO_SYNAPSE = -1
+
+
+class NetConRegistry(object):
+    '''forward (synapse -> NetCons) and reverse (NetCon -> synapse index) maps of a list of NetCons
+
+    synapses are numbered in the order they become known: the given
+    synapses_list first, then the synapses of the NetCons that are not on it,
+    then the synapses the NetCons are re-pointed to
+    '''
+    def __init__(self, netcons_list, synapses_list=()):
+        self.netcons = list(netcons_list)
+        self.synapses = []
+        self._synapse_index = {}
+        self._netcon_index = {netcon: i for i, netcon in enumerate(self.netcons)}
+        self._netcons_of = []  # the set of NetCon indices of every synapse
+        self.add_synapses(synapses_list)
+        self._post = np.empty(len(self.netcons), dtype=int)
+        for i, netcon in enumerate(self.netcons):
+            synapse = netcon.syn()
+            if synapse is None:
+                self._post[i] = NO_SYNAPSE
+            else:
+                self._post[i] = self.add_synapse(synapse)
+                self._netcons_of[self._post[i]].add(i)
+
+    def add_synapse(self, synapse):
+        '''returns the index of the synapse, numbering it if it is new'''
+        index = self._synapse_index.get(synapse)
+        if index is None:
+            index = self._synapse_index[synapse] = len(self.synapses)
+            self.synapses.append(synapse)
+            self._netcons_of.append(set())
+        return index
+
+    def add_synapses(self, synapses):
+        return np.array([self.add_synapse(synapse) for synapse in synapses], dtype=int)
+
+    def index_of(self, synapse):
+        '''returns the index of the synapse, NO_SYNAPSE if it is not known'''
+        return self._synapse_index.get(synapse, NO_SYNAPSE)
+
+    def netcon_indices_of(self, synapse):
+        '''returns the (sorted) indices of the NetCons of the synapse'''
+        return sorted(self._netcons_of[self._synapse_index[synapse]])
+
+    def netcons_of(self, synapse):
+        '''returns the NetCons of the synapse, in the order of the netcons list'''
+        return [self.netcons[i] for i in self.netcon_indices_of(synapse)]
+
+    def __getitem__(self, synapse):
+        return self.netcons_of(synapse)
+
+    def __contains__(self, synapse):
+        return synapse in self._synapse_index
+
+    def __len__(self):
+        return len(self.synapses)
+
+    def setpost(self, netcon, synapse):
+        '''points the NetCon (or the NetCon of the given index) at the synapse and updates the maps'''
+        if isinstance(netcon, (int, np.integer)):
+            netcon_index = int(netcon)
+            netcon = self.netcons[netcon_index]
+        else:
+            netcon_index = self._netcon_index[netcon]
+        netcon.setpost(synapse)
+        old = self._post[netcon_index]
+        if old != NO_SYNAPSE:
+            self._netcons_of[old].discard(netcon_index)
+        new = self.add_synapse(synapse)
+        self._netcons_of[new].add(netcon_index)
+        self._post[netcon_index] = new
+
+    @property
+    def post(self):
+        '''the synapse index of every NetCon (NO_SYNAPSE for a NetCon without one), a copy'''
+        return self._post.copy()
+
+    def netcon_counts(self):
+        '''the number of NetCons of every synapse'''
+        return np.bincount(self._post[self._post != NO_SYNAPSE], minlength=len(self.synapses))
+
+    def grouped_netcon_indices(self):
+        '''the NetCons grouped by synapse (in the CSR layout): the NetCons of synapse i
+        are netcon_indices[indptr[i]:indptr[i+1]], in the order of the netcons list
+
+        Returns indptr, netcon_indices
+        '''
+        has_synapse = np.flatnonzero(self._post != NO_SYNAPSE)
+        netcon_indices = has_synapse[np.argsort(self._post[has_synapse], kind='stable')]
+        indptr = np.zeros(len(self.synapses) + 1, dtype=int)
+        np.cumsum(self.netcon_counts(), out=indptr[1:])
+        return indptr, netcon_indices
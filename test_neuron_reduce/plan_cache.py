@@ -0,0 +1,179 @@
+'''
+Persistent, content-addressed cache of reduction plans
+
+A reduction plan is everything subtree_reductor computes before it touches the
+reduced cell: the CableParams and nseg of every reduced cable, the new
+location of every synapse and the synapse it was merged into, and the
+segment-to-segment mapping used to copy the mechanisms. Plans are stored as
+json files named by the sha256 of the geometry, the passive parameters and
+mechanism densities of the dendrites, the synapses and the reduction
+arguments, so a cache hit only replays the section creation and the synapse
+relocation.
+'''
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from .reducing_methods import CableParams
+from .mechanism_snapshot import MechanismSnapshot
+from . import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# bump when the reduction algorithm or the plan format changes
+PLAN_CACHE_VERSION = 2
+
+
+def _relative_name(section):
+    '''the name of the section without the name of its cell instance ("apic[3]")'''
+    return section.name().split('.')[-1]
+
+
+def _section_signature(section):
+    parent_seg = section.parentseg()
+    return (_relative_name(section),
+            section.L,
+            section.Ra,
+            section.nseg,
+            (_relative_name(parent_seg.sec), parent_seg.x) if parent_seg is not None else None,
+            [(seg.x, seg.diam, seg.area(), seg.ri(), seg.cm) for seg in section])
+
+
+def reduction_plan_key(soma,
+                       sections_to_delete,
+                       segment_to_mech_vals,
+                       synapses_list,
+                       PP_params_dict,
+                       reduction_frequency,
+                       total_segments_manual,
+                       mapping_type,
+                       nseg_policy=None,
+                       netcons_list=None):
+    '''returns the sha256 hex digest identifying the reduction of the given cell
+
+    segment_to_mech_vals - the mechanism values of the dendritic segments, as
+    returned by create_segments_to_mech_vals (taken before the active
+    mechanisms are removed), a MechanismSnapshot or a segment -> dict mapping
+    netcons_list - the synapse (index in synapses_list) of every NetCon is part
+    of the key, in list order, since a replayed plan re-points the NetCons by position
+    '''
+    digest = hashlib.sha256()
+
+    def update(item):
+        digest.update(repr(item).encode())
+        digest.update(b'\0')
+
+    update(('version', PLAN_CACHE_VERSION, reduction_frequency, total_segments_manual, mapping_type))
+    if nseg_policy is not None:
+        update(('nseg_policy', tuple(nseg_policy)))
+    update(('soma', soma.L, soma.diam, soma.cm, soma.g_pas, soma.Ra, soma.e_pas))
+    for section in sections_to_delete:
+        update(_section_signature(section))
+    if isinstance(segment_to_mech_vals, MechanismSnapshot):
+        for mech_name, columns in segment_to_mech_vals.mechanisms.items():
+            update((mech_name, columns.params))
+            digest.update(columns.segment_index.tobytes())
+            digest.update(columns.values.tobytes())
+    else:
+        for section in sections_to_delete:
+            for seg in section:
+                update(sorted((mech_name, sorted(values.items()))
+                              for mech_name, values in segment_to_mech_vals[seg].items()))
+
+    for synapse in synapses_list:
+        seg = synapse.get_segment()
+        synapse_type = synapse.hname()[:synapse.hname().rindex('[')]
+        params = PP_params_dict.get(synapse_type, [])
+        update((_relative_name(seg.sec), seg.x, synapse_type,
+                [(param, getattr(synapse, param)) for param in params
+                 if isinstance(getattr(synapse, param), (int, float))]))
+    if netcons_list is not None:
+        synapse_index = {synapse: i for i, synapse in enumerate(synapses_list)}
+        update(('netcons', [synapse_index.get(netcon.syn(), -1) for netcon in netcons_list]))
+    return digest.hexdigest()
+
+
+def _plan_path(cache_dir, key):
+    return os.path.join(cache_dir, key + '.json')
+
+
+def load_reduction_plan(cache_dir, key):
+    '''returns the cached plan with the given key, or None'''
+    path = _plan_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except (IOError, ValueError):
+        logger.warning("ignoring unreadable reduction plan %s" % path)
+        return None
+    plan['cable_params'] = [CableParams(*params) for params in plan['cable_params']]
+    return plan
+
+
+def save_reduction_plan(cache_dir, key, plan):
+    '''writes the plan atomically, so concurrent reductions never read half a file'''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(plan, f)
+    os.replace(tmp_path, _plan_path(cache_dir, key))
+
+
+def record_synapses(synapses_list, netcons_list, new_synapses_list, cables):
+    '''records where every synapse went and which synapse its NetCon now targets
+
+    cables - the reduced cables, in subtree order (the apical, if it exists, first)
+    '''
+    synapse_index = {synapse: i for i, synapse in enumerate(synapses_list)}
+    cable_index = {cable: i for i, cable in enumerate(cables)}
+    subtree, x = [], []
+    for synapse in synapses_list:
+        seg = synapse.get_segment()
+        subtree.append(cable_index.get(seg.sec, -1))  # -1: not moved (somatic)
+        x.append(seg.x)
+    return {'synapse_subtree': subtree,
+            'synapse_x': x,
+            'synapse_target': [synapse_index[netcon.syn()] for netcon in netcons_list],
+            'new_synapses': [synapse_index[synapse] for synapse in new_synapses_list]}
+
+
+def plan_matches(plan, synapses_list, netcons_list):
+    '''whether the plan was recorded for as many synapses and NetCons as given'''
+    return (len(plan['synapse_subtree']) == len(synapses_list) and
+            len(plan['synapse_target']) == len(netcons_list))
+
+
+def replay_synapses(plan, synapses_list, netcons_list, cables):
+    '''moves and merges the synapses as recorded in the plan, returns the new synapses list'''
+    for synapse, subtree, x in zip(synapses_list, plan['synapse_subtree'], plan['synapse_x']):
+        if subtree >= 0:
+            synapse.loc(x, sec=cables[subtree])
+    for netcon, target in zip(netcons_list, plan['synapse_target']):
+        netcon.setpost(synapses_list[target])
+    instrumentation.count('synapses_moved', len(plan['new_synapses']))
+    instrumentation.count('synapses_merged', len(synapses_list) - len(plan['new_synapses']))
+    instrumentation.count('netcons_repointed', len(netcons_list))
+    return [synapses_list[i] for i in plan['new_synapses']]
+
+
+def record_seg_to_seg(section_per_subtree_index, original_seg_to_reduced_seg):
+    '''records the reduced x of every original segment, per subtree'''
+    return {str(subtree_index): [original_seg_to_reduced_seg[seg].x for sec in sections for seg in sec]
+            for subtree_index, sections in section_per_subtree_index.items()}
+
+
+def replay_seg_to_seg(plan, section_per_subtree_index, cables):
+    '''rebuilds the segment mappings of create_seg_to_seg out of the plan'''
+    original_seg_to_reduced_seg, reduced_seg_to_original_seg = {}, {}
+    for subtree_index, sections in section_per_subtree_index.items():
+        segments = [seg for sec in sections for seg in sec]
+        for seg, x in zip(segments, plan['seg_to_seg'][str(subtree_index)]):
+            reduced_seg = cables[subtree_index](x)
+            original_seg_to_reduced_seg[seg] = reduced_seg
+            reduced_seg_to_original_seg.setdefault(reduced_seg, []).append(seg)
+    return original_seg_to_reduced_seg, reduced_seg_to_original_seg
@@ -0,0 +1,201 @@
+'''
+Registry of the point process parameters compared when merging synapses
+
+Two synapses are merged only if they are point processes of the same type
+whose comparable parameters (see SYN_PARAMS) have the same values. The list of
+comparable parameters of a type is derived once per process from NEURON's
+MechanismStandard metadata (falling back to dir() of a live point process for
+types NEURON does not know as point process mechanisms, such as hoc templates),
+and every type gets a precompiled attrgetter that reads all the values in one
+call.
+
+clone_point_processes copies point processes in bulk through the same
+parameter lists (used to duplicate the synapses of expanded branches).
+'''
+import collections
+import operator
+
+import numpy as np
+from neuron import h
+
+SKIPPED_PARAMS = frozenset({
+    "Section", "allsec", "baseattr", "cas", "g", "get_loc", "has_loc", "hname",
+    'hocobjptr', "i", "loc", "next", "ref", "same", "setpointer", "state",
+    "get_segment", "DA1", "eta", "omega", "DA2", "NEn", "NE2", "GAP1", "unirand", "randGen", "sfunc", "erand",
+    "randObjPtr", "A_AMPA", "A_NMDA", "B_AMPA", "B_NMDA", "D1", "D2", "F", "P", "W_nmda", "facfactor", "g_AMPA", "g_NMDA", "iampa", "inmda", "on_ampa", "on_nmda", "random",  "thr_rp","AlphaTmax_gaba", "Beta_gaba", "Cainf", "Cdur_gaba", "Erev_gaba", "ICag", "Icatotal", "P0g", "W", "capoolcon", "destid", "fCag", "fmax", "fmin", "g_gaba", "gbar_gaba", "igaba", "limitW", "maxChange", "neuroM", "normW", "on_gaba", "pooldiam", "postgid", "pregid", "r_gaba", "r_nmda", "scaleW", "srcid", "tauCa", "type", "z",
+    "d1", "gbar_ampa", "gbar_nmda","tau_d_AMPA","tau_d_NMDA","tau_r_AMPA","tau_r_NMDA","Erev_ampa","Erev_nmda", "lambda1", "lambda2", "threshold1", "threshold2",
+})
+
+SYN_PARAMS = frozenset({
+    "tau_r_AMPA", "tau_r_NMDA", "Use", "Dep", "Fac", "e", "u0", "initW", "taun1", "taun2", "gNMDAmax", "enmda", "taua1", "taua2", "gAMPAmax", "eampa", "AlphaTmax_ampa", "Beta_ampa", "Cdur_ampa", "AlphaTmax_nmda", "Beta_nmda", "Cdur_nmda", "initW_random", "Wmax", "Wmin", "tauD1", "tauD2", "f", "tauF", "P_0", "d2",
+})
+
+# parameters that are never compared https://github.com/neuronsimulator/nrn/issues/136
+UNCOMPARABLE_PARAMS = frozenset({'rng'})
+
+ALL_VARIABLES = 0  # MechanismStandard vartype of PARAMETER, ASSIGNED and STATE variables
+POINT_PROCESS_MECHANISMS = 1  # MechanismType of point processes
+
+_point_process_names = None
+_params_of_type = {}
+
+
+def type_of_point_process(PP):
+    s = PP.hname()
+    ix = PP.hname().find("[")
+    return s[:ix]
+
+
+def point_process_mechanism_names():
+    '''returns the names of all the point process mechanisms known to NEURON'''
+    global _point_process_names
+    if _point_process_names is None:
+        mechanism_type = h.MechanismType(POINT_PROCESS_MECHANISMS)
+        name = h.ref('')
+        _point_process_names = set()
+        for i in range(int(mechanism_type.count())):
+            mechanism_type.select(i)
+            mechanism_type.selected(name)
+            _point_process_names.add(name[0])
+    return _point_process_names
+
+
+def _variable_names(pp_type, PP):
+    if pp_type in point_process_mechanism_names():
+        mechanism_standard = h.MechanismStandard(pp_type, ALL_VARIABLES)
+        name = h.ref('')
+        names = []
+        for i in range(int(mechanism_standard.count())):
+            mechanism_standard.name(name, i)
+            names.append(name[0])
+        return sorted(names)
+    return [param for param in dir(PP) if not (param.startswith("__") or callable(getattr(PP, param)))]
+
+
+def comparable_params(PP):
+    '''returns the parameters of the point process type of PP that are worth comparing
+
+    (derived once per type) - the parameters that are not in SKIPPED_PARAMS and are in SYN_PARAMS
+    '''
+    pp_type = type_of_point_process(PP)
+    if pp_type not in _params_of_type:
+        _params_of_type[pp_type] = tuple(param for param in _variable_names(pp_type, PP)
+                                         if param not in SKIPPED_PARAMS and param in SYN_PARAMS)
+    return list(_params_of_type[pp_type])
+
+
+def _make_extractor(params):
+    if not params:
+        return lambda PP: ()
+    if len(params) == 1:
+        getter = operator.attrgetter(params[0])
+        return lambda PP: (getter(PP),)
+    return operator.attrgetter(*params)
+
+
+class PointProcessParams(object):
+    '''the compared parameters of every point process type, backed by a PP_params_dict
+
+    PP_params_dict (point process type -> list of parameter names) can be given
+    by the user to choose the compared parameters, missing types are filled in
+    with comparable_params.
+    '''
+    def __init__(self, PP_params_dict=None):
+        self.PP_params_dict = {} if PP_params_dict is None else PP_params_dict
+        self._extractors = {}
+
+    def params(self, PP):
+        '''returns the compared parameter names of the type of PP'''
+        pp_type = type_of_point_process(PP)
+        if pp_type not in self.PP_params_dict:
+            self.PP_params_dict[pp_type] = comparable_params(PP)
+        return self.PP_params_dict[pp_type]
+
+    def value_params(self, PP):
+        '''returns the names of the values returned by the extractor of the type of PP'''
+        return tuple(param for param in self.params(PP) if param not in UNCOMPARABLE_PARAMS)
+
+    def extractor(self, PP):
+        '''returns a function that reads the compared parameter values of a point process of the type of PP as a tuple'''
+        params = self.value_params(PP)
+        pp_type = type_of_point_process(PP)
+        extractor_params, extractor = self._extractors.get(pp_type, (None, None))
+        if extractor_params != params:  # the user may change PP_params_dict
+            extractor = _make_extractor(params)
+            self._extractors[pp_type] = (params, extractor)
+        return extractor
+
+    def values(self, PP):
+        '''returns the compared parameter values of the point process, as a tuple'''
+        return self.extractor(PP)(PP)
+
+
+class PointProcessClones(object):
+    '''the copies made by clone_point_processes, backed by a 2d object array
+
+    clones[i, j] is copy j of originals[i], iterating goes over the copies of
+    the first original, then of the second one and so on (the order they were created in)
+    '''
+    def __init__(self, originals, clones):
+        self.originals = originals
+        self.clones = clones
+
+    def copies_of(self, i):
+        '''returns the copies of originals[i] as a list'''
+        return list(self.clones[i])
+
+    def __len__(self):
+        return self.clones.size
+
+    def __iter__(self):
+        return iter(self.clones.ravel())
+
+
+def clone_point_processes(point_processes, target_segments, pp_params=None):
+    '''creates a copy of every point process in each of its target segments
+
+    point_processes - list of n point processes
+    target_segments - n lists of the same length (the number of copies), the
+                      segments of the copies of each point process
+    pp_params - the PointProcessParams choosing the copied parameters
+
+    The parameters of every type are looked up once, the values of every point
+    process are read once (as a row of a values array), and a parameter is set
+    only on the copies of the point processes whose value differs from the
+    default of the type, which is read from its first copy.
+    Returns a PointProcessClones
+    '''
+    if pp_params is None:
+        pp_params = PointProcessParams()
+    n_copies = len(target_segments[0]) if len(target_segments) > 0 else 0
+    clones = np.empty((len(point_processes), n_copies), dtype=object)
+    rows_of_type = collections.OrderedDict()
+    for i, (point_process, segments) in enumerate(zip(point_processes, target_segments)):
+        pp_type = type_of_point_process(point_process)
+        rows_of_type.setdefault(pp_type, []).append(i)
+        constructor = getattr(h, pp_type)
+        for j, segment in enumerate(segments):
+            clones[i, j] = constructor(segment)
+
+    if n_copies == 0:
+        return PointProcessClones(point_processes, clones)
+
+    for pp_type, rows in rows_of_type.items():
+        first = point_processes[rows[0]]
+        params = pp_params.value_params(first)
+        if not params:
+            continue
+        extractor = pp_params.extractor(first)
+        values = np.array([extractor(point_processes[i]) for i in rows], dtype=object).reshape(len(rows), len(params))
+        defaults = extractor(clones[rows[0], 0])
+        for k, (param_name, default) in enumerate(zip(params, defaults)):
+            for row in np.flatnonzero(values[:, k] != default):
+                param_value = values[row, k]
+                for new_point_process in clones[rows[row]]:
+                    try:
+                        setattr(new_point_process, param_name, param_value)
+                    except Exception:
+                        raise AttributeError('Cannot set', new_point_process, 'attribute', param_name,
+                                             'to', param_value,
+                                             'may try including attribute in skipped_params for PP_params_dict')
+    return PointProcessClones(point_processes, clones)
@@ -0,0 +1,140 @@
+'''
+Reducing populations of cells that share their morphology
+
+Cells that differ only in their synapses (placement, weights, parameters) have
+the same reduced cables: the CableParams and nseg of every cable, the mapping
+of the original segments onto the cables and the impedances of the subtrees
+that the synapses are mapped with. reduce_population computes those once per
+morphology, biophysics and reduction arguments (see the geometry_cache argument
+of subtree_reductor), and every other cell of the population only maps and
+merges its own synapses.
+
+usage:
+    results = reduce_population(cells, [(synapses, netcons) for every cell], 0)
+
+The work can also be sharded across worker processes. Hoc objects cannot be
+sent between processes, so every worker loads the templates once
+(template_loader), rebuilds the cells it was given (cell_builder(i) must build
+the same cell as cells[i]) and writes their reduction plans to plan_cache_dir.
+The cells of this process are then reduced by replaying those plans:
+
+    def load_templates():
+        h.load_file('L5PCbiophys3.hoc')
+        h.load_file('import3d.hoc')
+        h.load_file('L5PCtemplate.hoc')
+
+    def build_cell(i):
+        cell = h.L5PCtemplate('cell1.asc')
+        ...
+        return cell, synapses_list, netcons_list
+
+    results = reduce_population(cells, synapse_sets, 0, plan_cache_dir='plans',
+                                cell_builder=build_cell, template_loader=load_templates,
+                                processes=4)
+
+load_templates and build_cell must be module level (picklable) functions.
+'''
+import logging
+import multiprocessing
+
+from .subtree_reductor_func import subtree_reductor
+
+logger = logging.getLogger(__name__)
+
+_worker_state = {}
+
+
+def reduce_population(cells,
+                      synapse_sets,
+                      reduction_frequency,
+                      model_filename='model.hoc',
+                      total_segments_manual=-1,
+                      PP_params_dict=None,
+                      mapping_type='impedance',
+                      plan_cache_dir=None,
+                      cell_builder=None,
+                      template_loader=None,
+                      processes=None,
+                      **reductor_kwargs):
+    '''reduces every cell with its (synapses_list, netcons_list) from synapse_sets
+
+    the arguments are those of subtree_reductor, which is called once per cell
+    (extra keyword arguments are passed on to it). If cell_builder is given,
+    the plans are first computed in a pool of processes (None = number of
+    CPUs), see the module documentation.
+
+    Returns the list of the results of subtree_reductor, in the order of the cells
+    '''
+    if PP_params_dict is None:
+        PP_params_dict = {}
+    reductor_kwargs.update(model_filename=model_filename,
+                           total_segments_manual=total_segments_manual,
+                           PP_params_dict=PP_params_dict,
+                           mapping_type=mapping_type)
+
+    if cell_builder is not None:
+        if plan_cache_dir is None:
+            raise ValueError('the worker processes hand the reduction plans over through plan_cache_dir')
+        plan_population(cell_builder, len(cells), reduction_frequency, plan_cache_dir,
+                        template_loader, processes, **reductor_kwargs)
+
+    geometry_cache = {}
+    results = []
+    for cell, (synapses_list, netcons_list) in zip(cells, synapse_sets):
+        results.append(subtree_reductor(cell,
+                                        synapses_list,
+                                        netcons_list,
+                                        reduction_frequency,
+                                        plan_cache_dir=plan_cache_dir,
+                                        geometry_cache=geometry_cache,
+                                        **reductor_kwargs))
+    logger.debug("reduced %d cells with %d distinct geometries" % (len(results), len(geometry_cache)))
+    return results
+
+
+def _initialize_worker(cell_builder, template_loader):
+    '''loads the templates once per worker process'''
+    if template_loader is not None:
+        template_loader()
+    _worker_state['cell_builder'] = cell_builder
+    _worker_state['geometry_cache'] = {}
+
+
+def _plan_cell_in_worker(args):
+    cell_index, reduction_frequency, plan_cache_dir, reductor_kwargs = args
+    cell, synapses_list, netcons_list = _worker_state['cell_builder'](cell_index)
+    subtree_reductor(cell,
+                     synapses_list,
+                     netcons_list,
+                     reduction_frequency,
+                     plan_cache_dir=plan_cache_dir,
+                     geometry_cache=_worker_state['geometry_cache'],
+                     **reductor_kwargs)
+    return cell_index
+
+
+def plan_population(cell_builder,
+                    num_of_cells,
+                    reduction_frequency,
+                    plan_cache_dir,
+                    template_loader=None,
+                    processes=None,
+                    **reductor_kwargs):
+    '''writes the reduction plans of cells 0..num_of_cells-1 (as built by cell_builder) to plan_cache_dir
+
+    the cells are split into one contiguous shard per worker, so each worker
+    computes the shared geometry once
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    chunksize = max(1, -(-num_of_cells // processes))
+    pool = multiprocessing.Pool(processes, initializer=_initialize_worker,
+                                initargs=(cell_builder, template_loader))
+    try:
+        pool.map(_plan_cell_in_worker,
+                 [(cell_index, reduction_frequency, plan_cache_dir, reductor_kwargs)
+                  for cell_index in range(num_of_cells)],
+                 chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
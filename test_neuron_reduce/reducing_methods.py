@@ -8,39 +8,17 @@ import logging
 import math
 import cmath
 
+import numpy as np
 from neuron import h
 
+from . import instrumentation
+
 logger = logging.getLogger(__name__)
 CableParams = collections.namedtuple('CableParams',
                                      'length, diam, space_const,'
                                      'cm, rm, ra, e_pas, electrotonic_length')
 SynapseLocation = collections.namedtuple('SynapseLocation', 'subtree_index, section_num, x')
 
-h('''obfunc lowest_impedance_recursive() { local lowest_impedance, lowest_phase, i   localobj curr_subtree_root, sref1, lowest_imp_vec, lowest_child_subtree_impedance, imp_obj
-    curr_subtree_root = $o1  // in the first call to the function, this is a root section of a dendritic trunk
-    imp_obj = $o2
-    curr_subtree_root.sec {
-        lowest_impedance = imp_obj.transfer(1) // farthest tip of the the curr root section
-        lowest_phase = imp_obj.transfer_phase(1)
-    }
-
-    if (curr_subtree_root.nchild != 0) { // if the curr section has child sections
-        for i=0, curr_subtree_root.nchild-1 curr_subtree_root.child[i] {  // for each child of the root, finds the lowest impedance within the subtree whose root is the curr child (in relation to the proximal tip in the curr root child)
-            curr_subtree_root.child[i] sref1 = new SectionRef()
-            lowest_child_subtree_impedance = lowest_impedance_recursive(sref1, imp_obj) // recursively returns the lowest transfer impedance and transfer phase within the curr subtree as a vector
-            if (lowest_child_subtree_impedance.x[0] < lowest_impedance) {
-                lowest_impedance = lowest_child_subtree_impedance.x[0]
-                lowest_phase = lowest_child_subtree_impedance.x[1]
-            }
-        }
-    }
-    lowest_imp_vec = new Vector(2)
-    lowest_imp_vec.x[0] = lowest_impedance
-    lowest_imp_vec.x[1] = lowest_phase
-    return lowest_imp_vec
-}''')
-
-
 @contextlib.contextmanager
 def push_section(section):
     '''push a section onto the top of the NEURON stack, pop it when leaving the context'''
@@ -57,34 +35,67 @@ def _get_subtree_biophysical_properties(subtree_root_ref, frequency):
     section = subtree_root_ref.sec
 
     rm = 1.0 / section.g_pas  # in ohm * cm^2
+    q = compute_q(rm, section.cm, frequency)
+
+    return (section.cm,
+            rm,
+            section.Ra,  # in ohm * cm
+            section.e_pas,
+            q)
+
+
+def compute_q(rm, cm, frequency):
+    '''returns q = sqrt(1+iwRC) of a membrane with the given rm (ohm * cm^2) and cm (uF/cm2)'''
     # in secs, with conversion of the capacitance from uF/cm2 to F/cm2
-    RC = rm * (float(section.cm) / 1000000)
+    RC = rm * (float(cm) / 1000000)
 
     # defining q=sqrt(1+iwRC))
     angular_freq = 2 * math.pi * frequency   # = w
     q_imaginary = angular_freq * RC
     q = complex(1, q_imaginary)   # q=1+iwRC
     q = cmath.sqrt(q)		# q = sqrt(1+iwRC)
+    return q
 
-    return (section.cm,
-            rm,
-            section.Ra,  # in ohm * cm
-            section.e_pas,
-            q)
+
+def subtree_sections(subtree_root_section):
+    '''returns the sections of the subtree of the given root section, in the
+    order of a depth first (pre-order) traversal, without recursion'''
+    sections, stack = [], [subtree_root_section]
+    while stack:
+        section = stack.pop()
+        sections.append(section)
+        stack.extend(reversed(section.children()))
+    return sections
+
+
+def find_lowest_subtree_impedance_location(subtree_root_ref, imp_obj, impedance_table=None):
+    '''
+    finds the location in the subtree with the lowest transfer impedance in
+    relation to the proximal-to-soma end of the given subtree root section.
+
+    The transfer impedances of all the segments in the subtree are read into
+    a SubtreeImpedanceTable (unless one is given) and searched with a single
+    argmin.
+
+    returns (the lowest impedance in Ohms, (section, x))
+    '''
+    if impedance_table is None:
+        impedance_table = SubtreeImpedanceTable.from_impedance_object(imp_obj,
+                                                                      subtree_sections(subtree_root_ref.sec))
+    return impedance_table.lowest_transfer_impedance()
 
 
-def find_lowest_subtree_impedance(subtree_root_ref, imp_obj):
+def find_lowest_subtree_impedance(subtree_root_ref, imp_obj, impedance_table=None):
     '''
     finds the segment in the subtree with the lowest transfer impedance in
-    relation to the proximal-to-soma end of the given subtree root section,
-    using a recursive hoc function,
+    relation to the proximal-to-soma end of the given subtree root section
+    (see find_lowest_subtree_impedance_location)
 
     returns the lowest impedance in Ohms
     '''
-    # returns [lowest subtree transfer impedance in Mohms, transfer phase]
-    lowest_impedance = h.lowest_impedance_recursive(subtree_root_ref, imp_obj)
-    # impedance saved as a complex number after converting Mohms to ohms
-    curr_lowest_subtree_imp = cmath.rect(lowest_impedance.x[0] * 1000000, lowest_impedance.x[1])
+    curr_lowest_subtree_imp, _ = find_lowest_subtree_impedance_location(subtree_root_ref,
+                                                                        imp_obj,
+                                                                        impedance_table)
     return curr_lowest_subtree_imp
 
 
@@ -154,6 +165,67 @@ def find_best_real_X(Z0, ZX_goal, q, L, max_depth=50):
     return current_x
 
 
+def find_best_real_X_batch(Z0, ZX_goals, q, L, max_depth=50):
+    '''finds the best locations (X) of a batch of synapses on the same cable
+
+    vectorized version of find_best_real_X: all the goal transfer impedances
+    share the same Z0, q and L (i.e. they belong to the same subtree), s.t. the
+    modulus part of the impedance of ZX in eq 2.8 will be correct for each of them.
+    The closed-form solution X = L - (1/q) * arcosh( (Zx,0(f) / Z0) * cosh(q*L) )
+    is used as a first guess, and is then refined on the modulus using a
+    bracketed Newton iteration (falling back to bisection when a Newton step
+    leaves the bracket). Returns a numpy array of electrotonic locations.
+    '''
+    ZX_goals = np.asarray(ZX_goals, dtype=complex)
+    ZX_goals_A = np.abs(ZX_goals)
+    x = np.empty(ZX_goals_A.shape)
+    if x.size == 0:
+        return x
+
+    def zx_modulus_and_slope(current_x):
+        '''modulus of Zx (eq 2.8) and its derivative with respect to x'''
+        ZX = Z0 * np.cosh(q * (L - current_x)) / cmath.cosh(q * L)
+        dZX = -Z0 * q * np.sinh(q * (L - current_x)) / cmath.cosh(q * L)
+        ZX_A = np.abs(ZX)
+        return ZX_A, (ZX.real * dZX.real + ZX.imag * dZX.imag) / ZX_A
+
+    # the modulus is a decreasing function of X, so goals outside of
+    # [|ZX(L)|, |ZX(0)|] are mapped to the tips of the cable
+    at_proximal_tip = ZX_goals_A >= abs(Z0)
+    at_distal_tip = ZX_goals_A <= abs(Z0 / cmath.cosh(q * L))
+    x[at_proximal_tip] = 0.0
+    x[at_distal_tip & ~at_proximal_tip] = L
+    to_solve = ~(at_proximal_tip | at_distal_tip)
+
+    with np.errstate(invalid='ignore'):
+        first_guess = (L - np.arccosh(ZX_goals[to_solve] / Z0 * cmath.cosh(q * L)) / q).real
+    current_x = np.clip(np.nan_to_num(first_guess, nan=L / 2.0), 0.0, L)
+    goal_A = ZX_goals_A[to_solve]
+    min_x, max_x = np.zeros(current_x.shape), np.full(current_x.shape, float(L))
+
+    for _ in range(max_depth):
+        Z_current_X_A, slope = zx_modulus_and_slope(current_x)
+        error = Z_current_X_A - goal_A
+        if np.all(np.abs(error) <= 0.001):  # Z are in Ohms , normal values are >10^6
+            break
+
+        # the modulus is too large -> the synapse should move distally
+        min_x = np.where(error > 0, current_x, min_x)
+        max_x = np.where(error > 0, max_x, current_x)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton_x = current_x - error / slope
+        outside_bracket = ~((newton_x > min_x) & (newton_x < max_x))
+        newton_x[outside_bracket] = (min_x[outside_bracket] + max_x[outside_bracket]) / 2.0
+
+        current_x = np.where(np.abs(error) <= 0.001, current_x, newton_x)
+    else:
+        logger.info("The difference between X and the goal X is larger than 0.001")
+
+    x[to_solve] = current_x
+    return x
+
+
 def find_subtree_new_electrotonic_length(root_input_impedance, lowest_subtree_impedance, q):
     ''' finds the subtree's reduced cable's electrotonic length
 
@@ -215,7 +287,17 @@ def find_space_const_in_cm(diameter, rm, ra):
     return space_const
 
 
-def reduce_subtree(subtree_root, frequency):
+def find_ac_length_constant_in_micron(diameter, ra, cm, frequency):
+    '''returns the AC length constant (lambda_f, in microns) of a cable at the given frequency (Hz)
+
+    lambda_f = 1e5 * sqrt(diam / (4 * PI * f * Ra * cm)), diam in microns, Ra in
+    ohm * cm and cm in uF/cm^2, as in NEURON's d_lambda rule (the membrane
+    resistance is neglected, the capacitive current dominates at high frequencies)
+    '''
+    return 1e5 * math.sqrt(float(diameter) / (4 * math.pi * frequency * ra * cm))
+
+
+def reduce_subtree(subtree_root, frequency, impedance_cache=None):
     '''Reduces the subtree  from the original_cell into one single section (cable).
 
     The reduction is done by finding the length and diameter of the cable (a
@@ -230,11 +312,22 @@ def reduce_subtree(subtree_root, frequency):
     # finds the subtree's input impedance (at the somatic-proximal end of the
     # subtree root section) and the lowest transfer impedance in the subtree in
     # relation to the somatic-proximal end (see more in Readme on NeuroReduce)
-    imp_obj, root_input_impedance = measure_input_impedance_of_subtree(subtree_root, frequency)
+    if impedance_cache is None:
+        impedance_cache = ImpedanceCache()
+    impedance_table = impedance_cache.impedance_table(subtree_root, frequency)
+    root_input_impedance = impedance_table.root_input_impedance
 
     # in Ohms (a complex number)
-    curr_lowest_subtree_imp = find_lowest_subtree_impedance(subtree_root_ref, imp_obj)
+    curr_lowest_subtree_imp = find_lowest_subtree_impedance(subtree_root_ref, None, impedance_table)
+
+    return reduce_subtree_impedances(root_input_impedance, curr_lowest_subtree_imp,
+                                     cm, rm, ra, e_pas, q)
+
 
+def reduce_subtree_impedances(root_input_impedance, curr_lowest_subtree_imp, cm, rm, ra, e_pas, q):
+    '''finds the cable (CableParams) that preserves the given input impedance
+    and lowest transfer impedance (both complex, in Ohms) of a subtree with the
+    given membrane and axial properties'''
     # reducing the whole subtree into one section:
     # L = 1/q * arcosh(ZtreeIn(f)/min(ZtreeX,0(f)),
     # d = ( (2/pi * (sqrt(Rm*Ra)/q*ZtreeIn(f)) * coth(qL) )^(2/3) - from Gal Eliraz's thesis 1999
@@ -305,6 +398,7 @@ def measure_input_impedance_of_subtree(subtree_root_section, frequency):
     # computes transfer impedance from every segment in the model in relation
     # to the origin location above
     imp_obj.compute(frequency + 1 / 9e9, 0)
+    instrumentation.count('impedance_computes')
 
     # in Ohms (impedance measured at soma-proximal end of root section)
     root_input_impedance = imp_obj.input(CLOSE_TO_SOMA_EDGE, sec=subtree_root_section) * 1000000
@@ -314,6 +408,169 @@ def measure_input_impedance_of_subtree(subtree_root_section, frequency):
     return imp_obj, root_input_impedance
 
 
+class SubtreeImpedanceTable(object):
+    '''transfer impedances of every segment of a subtree, extracted in one pass
+
+    Built once per (subtree, frequency), out of a computed Impedance object
+    (from_impedance_object) or out of the solution of the cable_solver. Holds
+    contiguous arrays of the section index, x, modulus (in ohms) and phase of the
+    transfer impedance to the impedance origin (the soma-proximal end of the
+    subtree root) at the tips and the center of every segment of the given
+    sections, and optionally at their 3D points (where NEURON reports the value
+    of the segment the point is in).
+    Queries for arbitrary (section, x) locations are answered by vectorized
+    linear interpolation along the section, so consumers do not need to go
+    through the hoc stack once per location.
+    '''
+    def __init__(self, sections, section_index, x, modulus, phase, root_input_impedance=None):
+        self.sections = list(sections)
+        self.root_input_impedance = root_input_impedance
+        self._section_to_index = {sec: i for i, sec in enumerate(self.sections)}
+
+        self.section_index = np.asarray(section_index, dtype=int)
+        self.x = np.asarray(x, dtype=float)
+        self.modulus = np.asarray(modulus, dtype=float)
+        self.phase = np.asarray(phase, dtype=float)
+        # every section occupies its own [2 * index, 2 * index + 1] range, so a
+        # single interpolation never mixes the values of two sections
+        self._keys = 2 * self.section_index + self.x
+
+    def with_sections(self, sections):
+        '''the same table for another tree with the same layout (e.g. another instance of the same morphology)'''
+        return SubtreeImpedanceTable(sections, self.section_index, self.x, self.modulus, self.phase,
+                                     self.root_input_impedance)
+
+    @classmethod
+    def from_impedance_object(cls, imp_obj, sections, root_input_impedance=None, include_3d_points=False):
+        '''reads the table out of a computed Impedance hoc object'''
+        sections = list(sections)
+        section_index, x, modulus, phase = [], [], [], []
+        for i, sec in enumerate(sections):
+            sec_xs = [0.0] + [seg.x for seg in sec] + [1.0]
+            if include_3d_points and sec.n3d() > 1:
+                sec_xs.extend(sec.arc3d(j) / sec.L for j in range(sec.n3d()))
+            sec_xs = np.unique(np.clip(sec_xs, 0.0, 1.0))
+
+            with push_section(sec):
+                modulus.extend(imp_obj.transfer(sec_x) * 1000000 for sec_x in sec_xs)  # ohms
+                phase.extend(imp_obj.transfer_phase(sec_x) for sec_x in sec_xs)
+            section_index.append(np.full(len(sec_xs), i))
+            x.append(sec_xs)
+
+        return cls(sections,
+                   np.concatenate(section_index) if section_index else np.zeros(0, int),
+                   np.concatenate(x) if x else np.zeros(0),
+                   modulus,
+                   phase,
+                   root_input_impedance)
+
+    def __len__(self):
+        return len(self.x)
+
+    def section_indices(self, sections):
+        '''returns the indices of the given sections in the table'''
+        return np.array([self._section_to_index[sec] for sec in sections], dtype=int)
+
+    def transfer_impedance_by_index(self, section_indices, xs):
+        '''returns the complex transfer impedances (in ohms) at the given (section index, x) locations'''
+        keys = 2 * np.asarray(section_indices) + np.asarray(xs, dtype=float)
+        modulus = np.interp(keys, self._keys, self.modulus)
+        phase = np.interp(keys, self._keys, self.phase)
+        return modulus * np.exp(1j * phase)
+
+    def transfer_impedance(self, sections, xs):
+        '''returns the complex transfer impedances (in ohms) at the given (section, x) locations'''
+        return self.transfer_impedance_by_index(self.section_indices(sections), xs)
+
+    def segments_transfer_impedance(self, segments):
+        '''returns the complex transfer impedances (in ohms) at the given segments'''
+        return self.transfer_impedance([seg.sec for seg in segments], [seg.x for seg in segments])
+
+    def lowest_transfer_impedance(self):
+        '''returns (the lowest complex transfer impedance in the table (in ohms), (section, x))'''
+        i = np.argmin(self.modulus)
+        return (cmath.rect(self.modulus[i], self.phase[i]),
+                (self.sections[self.section_index[i]], float(self.x[i])))
+
+
+def passive_fingerprint(section):
+    '''returns a hashable fingerprint of the tree that the given section belongs to
+
+    made of the topology, geometry and passive parameters of every section in
+    the tree, which is everything a (passive) impedance computation depends on
+    '''
+    fingerprint = []
+    for sec in section.wholetree():
+        parent_seg = sec.parentseg()
+        has_pas = sec.has_membrane('pas')
+        fingerprint.append((sec.name(),
+                            sec.L,
+                            sec.Ra,
+                            None if parent_seg is None else (parent_seg.sec.name(), parent_seg.x),
+                            tuple((seg.diam, seg.cm, seg.g_pas if has_pas else None) for seg in sec)))
+    return hash(tuple(fingerprint))
+
+
+class ImpedanceCache(object):
+    '''memoizes the Impedance hoc objects of subtrees
+
+    entries are keyed by (subtree root section, frequency, passive fingerprint),
+    so an entry is only reused as long as the tree it was computed on was not
+    changed. Since an Impedance object is indexed by the nodes of the whole
+    model, an entry is also dropped when NEURON rebuilds its structure (e.g.
+    after new sections are created anywhere in the model).
+    Call invalidate() when the tree is mutated (sections are disconnected or
+    deleted) to drop the entries of the old tree.
+    '''
+    def __init__(self):
+        self._entries = {}
+        self._tables = {}
+        self._cvode = h.CVode()
+
+    def measure_input_impedance_of_subtree(self, subtree_root_section, frequency):
+        '''memoized version of measure_input_impedance_of_subtree'''
+        key = (subtree_root_section, frequency, passive_fingerprint(subtree_root_section))
+        if key in self._entries:
+            imp_obj, root_input_impedance, structure_change_count = self._entries[key]
+            # querying the Impedance object makes NEURON apply any pending structure change
+            imp_obj.transfer(0, sec=subtree_root_section)
+            if structure_change_count == self._cvode.structure_change_count():
+                return imp_obj, root_input_impedance
+
+        # drops the entries that were computed on an older version of the tree
+        self.invalidate(subtree_root_section, frequency)
+        imp_obj, root_input_impedance = measure_input_impedance_of_subtree(subtree_root_section,
+                                                                           frequency)
+        self._entries[key] = (imp_obj, root_input_impedance, self._cvode.structure_change_count())
+        return imp_obj, root_input_impedance
+
+    def impedance_table(self, subtree_root_section, frequency):
+        '''returns the (memoized) SubtreeImpedanceTable of the subtree with the given root section
+
+        the values in the table are extracted once, so unlike the Impedance
+        object they stay valid when NEURON rebuilds its structure
+        '''
+        key = (subtree_root_section, frequency, passive_fingerprint(subtree_root_section))
+        if key not in self._tables:
+            imp_obj, root_input_impedance = self.measure_input_impedance_of_subtree(subtree_root_section,
+                                                                                    frequency)
+            self._tables[key] = SubtreeImpedanceTable.from_impedance_object(
+                imp_obj, subtree_sections(subtree_root_section), root_input_impedance)
+        return self._tables[key]
+
+    def add_table(self, subtree_root_section, frequency, table):
+        '''uses the given SubtreeImpedanceTable for the subtree as it is now (e.g. one computed on another instance)'''
+        self._tables[(subtree_root_section, frequency, passive_fingerprint(subtree_root_section))] = table
+
+    def invalidate(self, subtree_root_section=None, frequency=None):
+        '''drops the entries of the given subtree root section (and frequency), or all of them'''
+        for entries in (self._entries, self._tables):
+            for key in list(entries):
+                if ((subtree_root_section is None or key[0] == subtree_root_section) and
+                        (frequency is None or key[1] == frequency)):
+                    del entries[key]
+
+
 def reduce_synapse(cell_instance,
                    synapse_location,
                    on_basal,
@@ -364,3 +621,35 @@ def reduce_synapse(cell_instance,
         new_relative_loc_in_section = 0.999999
 
     return new_relative_loc_in_section
+
+
+def reduce_synapses(impedance_table,
+                    sections,
+                    xs,
+                    new_cable_electrotonic_length,
+                    q_subtree):
+    '''
+    Batch version of reduce_synapse for synapses (or segments) that are all on
+    the same subtree: looks up the original transfer impedance of every given
+    (section, x) location in the subtree's SubtreeImpedanceTable and maps all of
+    them to their new locations on the reduced cable at once (see
+    find_best_real_X_batch).
+
+    Returns a numpy array of the new relative locations (x, 0<=x<=1) on the
+    reduced cable, in the order of the given locations.
+    '''
+    orig_synapse_transfer_impedances = impedance_table.transfer_impedance(sections, xs)
+
+    synapses_new_electrotonic_locations = find_best_real_X_batch(impedance_table.root_input_impedance,
+                                                                 orig_synapse_transfer_impedances,
+                                                                 q_subtree,
+                                                                 new_cable_electrotonic_length)
+    new_relative_locs_in_section = (synapses_new_electrotonic_locations /
+                                    new_cable_electrotonic_length)
+
+    # PATCH - synapses whose goal impedance is out of the cable's range are
+    # mapped exactly to its tips, keep them inside the first/last segment
+    new_relative_locs_in_section[new_relative_locs_in_section >= 1] = 0.999999
+    new_relative_locs_in_section[new_relative_locs_in_section <= 0] = 0.000001
+
+    return new_relative_locs_in_section
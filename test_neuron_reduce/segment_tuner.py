@@ -0,0 +1,224 @@
+'''
+Tuning total_segments_manual (and the reduction frequency) for accuracy vs cost
+
+Every candidate configuration is reduced and simulated in its own worker
+process, in parallel, and its soma voltage is compared with the trace of the
+full model, which is simulated once and can be cached in a .npz file. The
+cheapest candidate (the fewest segments in the reduced model, then the fastest
+simulation) whose soma voltage RMSE and/or spike timing is within the given
+tolerances is returned, together with the accuracy and the wall clock cost of
+every candidate.
+
+usage:
+    def build_cell():
+        h.load_file('L5PCbiophys3.hoc')
+        h.load_file('import3d.hoc')
+        h.load_file('L5PCtemplate.hoc')
+        cell = h.L5PCtemplate('cell1.asc')
+        ...
+        return cell, synapses_list, netcons_list, netstims_list
+
+    best, results = tune_segments(build_cell, [-1, 20, 50, 100, 200],
+                                  reduction_frequencies=[0, 10],
+                                  rmse_tolerance=1.0, spike_time_tolerance=2.0,
+                                  simulation=SimulationParams(tstop=1000),
+                                  reference_path='reference.npz', processes=4)
+    for result in results:
+        print(result)
+
+build_cell must be a module level (picklable) function that builds the same
+cell, synapses and inputs every time it is called (seeded random inputs), the
+items it returns after the netcons are only kept alive for the simulation.
+'''
+import collections
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import neuron
+from neuron import h
+
+from .subtree_reductor_func import subtree_reductor
+
+logger = logging.getLogger(__name__)
+
+# tstop, dt - in ms; v_init - in mV, None for the v_init of stdrun.hoc; celsius - in degrees
+SimulationParams = collections.namedtuple('SimulationParams', 'tstop, dt, v_init, celsius')
+SimulationParams.__new__.__defaults__ = (500., 0.025, None, 37.)
+
+# total_segments_manual, reduction_frequency - the candidate configuration
+# nseg - the number of segments in the reduced model (soma included)
+# rmse - of the soma voltage (mV), max_spike_shift - the largest difference (ms)
+#        between the matching spike times (inf if the number of spikes differs)
+# reduce_seconds, simulate_seconds - the wall clock cost of the candidate
+TunerResult = collections.namedtuple('TunerResult',
+                                     'total_segments_manual, reduction_frequency, nseg, rmse, '
+                                     'max_spike_shift, num_of_spikes, reduce_seconds, simulate_seconds, passed')
+
+SPIKE_THRESHOLD = -20.  # mV
+
+
+def _soma(cell):
+    soma = cell.soma
+    if not isinstance(soma, neuron.nrn.Section):
+        soma = soma[0]
+    return soma
+
+
+def simulate_soma_voltage(cell, simulation):
+    '''runs the model and returns the times, the soma voltage and the wall clock time of the run'''
+    h.load_file('stdrun.hoc')
+    t = h.Vector().record(h._ref_t)
+    v = h.Vector().record(_soma(cell)(0.5)._ref_v)
+    h.tstop = simulation.tstop
+    h.dt = simulation.dt
+    h.celsius = simulation.celsius
+    if simulation.v_init is not None:
+        h.v_init = simulation.v_init
+    start = time.perf_counter()
+    h.run()
+    return t.as_numpy().copy(), v.as_numpy().copy(), time.perf_counter() - start
+
+
+def find_spike_times(t, v, threshold=SPIKE_THRESHOLD):
+    '''returns the times at which v crosses the threshold upwards'''
+    crossings = np.flatnonzero((v[:-1] < threshold) & (v[1:] >= threshold)) + 1
+    return t[crossings]
+
+
+def compare_traces(reference_v, v, reference_spike_times, spike_times):
+    '''returns the RMSE of the voltage and the largest shift between the matching spike times'''
+    n = min(len(reference_v), len(v))
+    rmse = float(np.sqrt(np.mean((reference_v[:n] - v[:n]) ** 2)))
+    if len(reference_spike_times) != len(spike_times):
+        max_spike_shift = np.inf
+    elif len(spike_times) == 0:
+        max_spike_shift = 0.
+    else:
+        max_spike_shift = float(np.max(np.abs(reference_spike_times - spike_times)))
+    return rmse, max_spike_shift
+
+
+def _run_candidate(args):
+    '''reduces (unless the candidate is None) and simulates the cell, in a worker process'''
+    cell_builder, candidate, simulation, reductor_kwargs = args
+    built = cell_builder()
+    cell, synapses_list, netcons_list = built[:3]
+    reduce_seconds = 0.
+    if candidate is not None:
+        total_segments_manual, reduction_frequency = candidate
+        start = time.perf_counter()
+        cell, synapses_list, netcons_list = subtree_reductor(cell,
+                                                             synapses_list,
+                                                             netcons_list,
+                                                             reduction_frequency,
+                                                             total_segments_manual=total_segments_manual,
+                                                             **reductor_kwargs)
+        reduce_seconds = time.perf_counter() - start
+    nseg = sum(sec.nseg for sec in _soma(cell).wholetree())
+    t, v, simulate_seconds = simulate_soma_voltage(cell, simulation)
+    return {'t': t, 'v': v, 'nseg': nseg,
+            'reduce_seconds': reduce_seconds, 'simulate_seconds': simulate_seconds}
+
+
+def _simulation_array(simulation):
+    return np.array([np.nan if value is None else value for value in simulation], dtype=float)
+
+
+def _load_reference(reference_path, simulation):
+    if reference_path is None or not os.path.exists(reference_path):
+        return None
+    with np.load(reference_path) as arrays:
+        if not np.array_equal(arrays['simulation'], _simulation_array(simulation), equal_nan=True):
+            logger.info('the reference trace in %s was simulated with other parameters' % reference_path)
+            return None
+        return {'t': arrays['t'], 'v': arrays['v'], 'nseg': int(arrays['nseg']),
+                'reduce_seconds': 0., 'simulate_seconds': float(arrays['simulate_seconds'])}
+
+
+def _save_reference(reference_path, simulation, reference):
+    np.savez(reference_path,
+             simulation=_simulation_array(simulation),
+             t=reference['t'], v=reference['v'], nseg=reference['nseg'],
+             simulate_seconds=reference['simulate_seconds'])
+
+
+def tune_segments(cell_builder,
+                  total_segments_candidates=(-1, 20, 50, 100, 200, 400),
+                  reduction_frequencies=(0, ),
+                  rmse_tolerance=None,
+                  spike_time_tolerance=None,
+                  simulation=SimulationParams(),
+                  reference_path=None,
+                  processes=None,
+                  spike_threshold=SPIKE_THRESHOLD,
+                  **reductor_kwargs):
+    '''finds the cheapest (total_segments_manual, reduction_frequency) that meets the tolerances
+
+    cell_builder - a picklable function with no arguments that returns
+                   (cell, synapses_list, netcons_list, ...), see the module documentation
+    total_segments_candidates, reduction_frequencies - every combination is a candidate
+    rmse_tolerance - the largest soma voltage RMSE (mV) allowed
+    spike_time_tolerance - the largest shift (ms) allowed between the spikes of
+                           the full and the reduced model, which must have the same number of spikes
+    reference_path - a .npz file caching the trace of the full model, it is
+                     simulated (and saved there) only if the file is missing
+                     or was simulated with other SimulationParams (the file
+                     is not keyed by the cell, use one file per cell_builder)
+    processes - the number of workers (None = number of CPUs), every
+                candidate runs in a fresh process
+    extra keyword arguments are passed on to subtree_reductor
+
+    Returns the best TunerResult (None if no candidate meets the tolerances)
+    and the TunerResults of all the candidates
+    '''
+    if rmse_tolerance is None and spike_time_tolerance is None:
+        raise ValueError('at least one of rmse_tolerance and spike_time_tolerance is needed')
+
+    candidates = list(itertools.product(total_segments_candidates, reduction_frequencies))
+    reference = _load_reference(reference_path, simulation)
+    tasks = [(cell_builder, candidate, simulation, reductor_kwargs) for candidate in candidates]
+    if reference is None:
+        tasks.append((cell_builder, None, simulation, reductor_kwargs))
+
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        runs = pool.map(_run_candidate, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    if reference is None:
+        reference = runs.pop()
+        if reference_path is not None:
+            _save_reference(reference_path, simulation, reference)
+    logger.info('full model: %d segments, simulated in %.3fs' % (reference['nseg'],
+                                                                 reference['simulate_seconds']))
+
+    reference_spike_times = find_spike_times(reference['t'], reference['v'], spike_threshold)
+    results = []
+    for (total_segments_manual, reduction_frequency), run in zip(candidates, runs):
+        spike_times = find_spike_times(run['t'], run['v'], spike_threshold)
+        rmse, max_spike_shift = compare_traces(reference['v'], run['v'], reference_spike_times, spike_times)
+        passed = ((rmse_tolerance is None or rmse <= rmse_tolerance) and
+                  (spike_time_tolerance is None or max_spike_shift <= spike_time_tolerance))
+        results.append(TunerResult(total_segments_manual=total_segments_manual,
+                                   reduction_frequency=reduction_frequency,
+                                   nseg=run['nseg'],
+                                   rmse=rmse,
+                                   max_spike_shift=max_spike_shift,
+                                   num_of_spikes=len(spike_times),
+                                   reduce_seconds=run['reduce_seconds'],
+                                   simulate_seconds=run['simulate_seconds'],
+                                   passed=passed))
+        logger.info('total_segments_manual=%s, reduction_frequency=%s: %d segments, RMSE %.3f mV, '
+                    'spike shift %.3f ms, reduced in %.3fs, simulated in %.3fs%s' % (
+                        total_segments_manual, reduction_frequency, run['nseg'], rmse, max_spike_shift,
+                        run['reduce_seconds'], run['simulate_seconds'], '' if passed else ' (failed)'))
+
+    passed = [result for result in results if result.passed]
+    best = min(passed, key=lambda result: (result.nseg, result.simulate_seconds)) if passed else None
+    return best, results
@@ -33,39 +33,111 @@ from neuron import h
 h.load_file("stdrun.hoc")
 
 from .reducing_methods import (reduce_subtree,
-                               reduce_synapse,
-                               measure_input_impedance_of_subtree,
+                               reduce_synapses,
+                               ImpedanceCache,
                                CableParams,
                                SynapseLocation,
                                push_section,
+                               subtree_sections,
+                               find_ac_length_constant_in_micron,
                                )
+from .point_process_params import (type_of_point_process,
+                                   comparable_params,
+                                   PointProcessParams,
+                                   )
+from .mechanism_snapshot import MechanismSnapshot
+from . import instrumentation
+from .cell_copy import copy_cell
+from .plan_cache import (reduction_plan_key,
+                         load_reduction_plan,
+                         save_reduction_plan,
+                         record_synapses,
+                         replay_synapses,
+                         plan_matches,
+                         record_seg_to_seg,
+                         replay_seg_to_seg,
+                         )
 
 logger = logging.getLogger(__name__)
 SOMA_LABEL = "soma"
 EXCLUDE_MECHANISMS = ('pas', 'na_ion', 'k_ion', 'ca_ion', 'h_ion', 'ttx_ion', )
 
+# where a section of a subtree is: subtree_type - "apic" or "basal", the kind
+# of subtree it was marked with; section_type and section_num - the section
+# array and index in its name (e.g. "dend", 3 for cell.dend[3]);
+# subtree_index - the index of its subtree
+SubtreeSection = collections.namedtuple('SubtreeSection', 'subtree_type, section_type, section_num, subtree_index')
+
+# segmentation of the reduced cables by the AC length constant (see calculate_nsegs_from_d_lambda):
+# frequency - in Hz, d_lambda - the maximal length of a segment in AC length constants,
+# error_budget - None, or the tolerated relative error of the discretized length
+#                constant of every cable (a float, or one per cable), replaces d_lambda
+DLambdaPolicy = collections.namedtuple('DLambdaPolicy', 'frequency, d_lambda, error_budget')
+DLambdaPolicy.__new__.__defaults__ = (100, 0.1, None)
+
+
+def _hoc_instance(instance):
+    '''the hoc object, given as itself or as the name of the hoc variable holding it'''
+    return getattr(h, instance) if isinstance(instance, str) else instance
+
 
-def create_sections_in_hoc(type_of_section, num, instance_as_str):
+def _section_of_instance(instance, section):
+    '''the section, given as itself or by its name in the instance ("dend[3]")'''
+    if isinstance(section, str):
+        array_name, index = re.match(r'(\w+)\[(\d+)\]', section).groups()
+        return getattr(instance, array_name)[int(index)]
+    return section
+
+
+def create_sections_in_hoc(type_of_section, num, instance):
     '''creates sections in the hoc world according to the given section type and number of sections
 
-    in the instance whose name is given as a string
+    in the given instance (a hoc object or the name of the hoc variable holding
+    it), returns the new sections
     '''
-    h("strdef string")
-    h.string = type_of_section
-    h('{sprint(string, "create %s[%d]", string, ' + str(num) + ') }')
-    h("{execute(string, " + instance_as_str + ")}")
+    instance = _hoc_instance(instance)
+    h.execute('create %s[%d]' % (type_of_section, num), instance)
+    return [getattr(instance, type_of_section)[i] for i in range(num)]
 
 
-def append_to_section_lists(section, type_of_sectionlist, instance_as_str):
+def append_to_section_lists(section, type_of_sectionlist, instance):
     ''' appends given section to the sectionlist of the given type and to the "all" sectionlist
 
-    in the hoc world in the instance whose name is given as a string
+    in the hoc world in the given instance (a hoc object or the name of the hoc
+    variable holding it), the section is a section or its name in the instance
     '''
-    h("strdef string")
-    h.string = section + " " + type_of_sectionlist + ".append()"
-    h("{execute(string, " + instance_as_str + ")}")
-    h.string = section + " all.append()"
-    h("{execute(string, " + instance_as_str + ")}")
+    instance = _hoc_instance(instance)
+    section = _section_of_instance(instance, section)
+    getattr(instance, type_of_sectionlist).append(sec=section)
+    instance.all.append(sec=section)
+
+
+def set_cable_params(section, cable_params, nseg):
+    '''sets the dimensions and the passive properties of the section to those of the cable'''
+    section.L = cable_params.length
+    section.diam = cable_params.diam
+    section.nseg = nseg
+
+    section.insert('pas')
+    section.cm = cable_params.cm
+    section.g_pas = 1.0 / cable_params.rm
+    section.Ra = cable_params.ra
+    section.e_pas = cable_params.e_pas
+
+
+def build_cables(instance, type_of_section, type_of_sectionlist, cables_params, nsegs):
+    '''creates a section array of passive cables in the instance in one go
+
+    and adds them to the sectionlist of the given type and to "all", returns the new sections
+    '''
+    instance = _hoc_instance(instance)
+    sections = create_sections_in_hoc(type_of_section, len(cables_params), instance)
+    section_list = getattr(instance, type_of_sectionlist)
+    for section, cable_params, nseg in zip(sections, cables_params, nsegs):
+        set_cable_params(section, cable_params, nseg)
+        section_list.append(sec=section)
+        instance.all.append(sec=section)
+    return sections
 
 
 def find_section_number(section):
@@ -76,6 +148,11 @@ def find_section_number(section):
     return sec_num
 
 
+def find_section_type(section):
+    ''' extracts and returns the section type ("soma", "apic", "dend", ...) from the given section object '''
+    return section.name().split(".")[-1].split("[")[0]
+
+
 def calculate_nsegs_from_manual_arg(new_cable_properties, total_segments_wanted):
     '''Calculates the number of segments for each section in the reduced model
 
@@ -122,6 +199,77 @@ def calculate_nsegs_from_lambda(new_cable_properties):
     return dends_nsegs
 
 
+def d_lambda_from_error_budget(error_budget):
+    '''returns the longest segment (in length constants) whose discretization error is within the budget
+
+    a cable split into segments of length h (in length constants) decays
+    between neighbouring segments as a continuous cable with the length constant
+    h / arccosh(1 + h^2 / 2) ~= 1 + h^2 / 24 (relative to the true one), so
+    a relative error of error_budget allows h = sqrt(24 * error_budget)
+    (d_lambda = 0.1 is a relative error of ~4e-4)
+    '''
+    return math.sqrt(24 * error_budget)
+
+
+def calculate_nsegs_from_d_lambda(new_cable_properties, frequency=100, d_lambda=0.1, error_budget=None):
+    '''calculates the number of segments for each section in the reduced model
+
+    by NEURON's d_lambda rule: every segment is at most d_lambda AC length
+    constants (at the given frequency, see find_ac_length_constant_in_micron)
+    long, rounded up to an odd number. If error_budget is given (a float or
+    one per cable) d_lambda of every cable is set by its budget (see
+    d_lambda_from_error_budget)
+    '''
+    if frequency <= 0:
+        raise ValueError('the d_lambda rule needs a positive frequency, got %s' % frequency)
+    if error_budget is None:
+        d_lambdas = [d_lambda] * len(new_cable_properties)
+    elif isinstance(error_budget, (int, float)):
+        d_lambdas = [d_lambda_from_error_budget(error_budget)] * len(new_cable_properties)
+    else:
+        d_lambdas = [d_lambda_from_error_budget(budget) for budget in error_budget]
+        if len(d_lambdas) != len(new_cable_properties):
+            raise ValueError('one error budget per cable is needed, got %d for %d cables' % (
+                len(d_lambdas), len(new_cable_properties)))
+
+    dends_nsegs = []
+    for cable, cable_d_lambda in zip(new_cable_properties, d_lambdas):
+        lambda_f = find_ac_length_constant_in_micron(cable.diam, cable.ra, cable.cm, frequency)
+        dends_nsegs.append(int((float(cable.length) / (cable_d_lambda * lambda_f) + 0.9) / 2) * 2 + 1)
+    return dends_nsegs
+
+
+def calculate_nsegs(new_cable_properties, total_segments_manual, original_cell_seg_n, nseg_policy=None):
+    '''calculates the number of segments for each section in the reduced model
+
+    according to the total_segments_manual argument of subtree_reductor (see
+    there), original_cell_seg_n is the number of dendritic segments in the
+    original cell. With a DLambdaPolicy as nseg_policy the automatic
+    segmentation uses the AC length constant (calculate_nsegs_from_d_lambda)
+    instead of 0.1 DC length constants
+    '''
+    if total_segments_manual > 1:
+        return calculate_nsegs_from_manual_arg(new_cable_properties, total_segments_manual)
+
+    if nseg_policy is None:
+        new_cables_nsegs = calculate_nsegs_from_lambda(new_cable_properties)
+    else:
+        new_cables_nsegs = calculate_nsegs_from_d_lambda(new_cable_properties, *nseg_policy)
+    if total_segments_manual > 0:
+        min_reduced_seg_n = int(round((total_segments_manual * original_cell_seg_n)))
+        if sum(new_cables_nsegs) < min_reduced_seg_n:
+            logger.debug("number of segments calculated using lambda is {}, "
+                  "the original cell had {} segments.  "
+                  "The min reduced segments is set to {}% of reduced cell segments".format(
+                      sum(new_cables_nsegs),
+                      original_cell_seg_n,
+                      total_segments_manual * 100))
+            logger.debug("the reduced cell nseg is set to %s" % min_reduced_seg_n)
+            new_cables_nsegs = calculate_nsegs_from_manual_arg(new_cable_properties,
+                                                               min_reduced_seg_n)
+    return new_cables_nsegs
+
+
 def mark_subtree_sections_with_subtree_index(sections_to_delete,
                                              section_per_subtree_index,
                                              root_sec_of_subtree,
@@ -131,7 +279,9 @@ def mark_subtree_sections_with_subtree_index(sections_to_delete,
     '''Recursively marks all sections in the subtree as belonging to the given subtree_index
 
     using the given dict mapping_sections_to_subtree_index, as follows:
-    mapping_sections_to_subtree_index[(<section_type>, <section_number>)] = given subtree_index
+    mapping_sections_to_subtree_index[<section>] = SubtreeSection(<section_type>, <type in the section name>,
+                                                                  <section_number>, given subtree_index)
+    so the names of the sections are parsed once, here, and not for every synapse
     '''
     sections_to_delete.append(root_sec_of_subtree)
     section_per_subtree_index.setdefault(subtree_index, [])
@@ -146,7 +296,10 @@ def mark_subtree_sections_with_subtree_index(sections_to_delete,
                                                  mapping_sections_to_subtree_index,
                                                  section_type,
                                                  subtree_index)
-    mapping_sections_to_subtree_index[(section_type, section_num)] = subtree_index
+    mapping_sections_to_subtree_index[root_sec_of_subtree] = SubtreeSection(section_type,
+                                                                            find_section_type(root_sec_of_subtree),
+                                                                            int(section_num),
+                                                                            subtree_index)
 
 
 def find_synapse_loc(synapse_or_segment, mapping_sections_to_subtree_index):
@@ -155,28 +308,26 @@ def find_synapse_loc(synapse_or_segment, mapping_sections_to_subtree_index):
     if not isinstance(synapse_or_segment, neuron.nrn.Segment):
         synapse_or_segment = synapse_or_segment.get_segment()
 
-    x = synapse_or_segment.x
-
-    with push_section(synapse_or_segment.sec):
-        # extracts the section type ("soma", "apic", "dend") and the section number
-        # out of the section name
-        full_sec_name = h.secname()
-        sec_name_as_list = full_sec_name.split(".")
-        short_sec_name = sec_name_as_list[len(sec_name_as_list) - 1]
-        section_type = short_sec_name.split("[")[0]
-        section_num = re.findall(r'\d+', short_sec_name)[0]
-
     # finds the index of the subtree that this synapse belongs to using the
     # given mapping_sections_to_subtree_index which maps sections to the
     # subtree indexes that they belong to
-    if section_type == "apic":
-        subtree_index = mapping_sections_to_subtree_index[("apic", section_num)]
-    elif section_type == "dend":
-        subtree_index = mapping_sections_to_subtree_index[("basal", section_num)]
-    else:  # somatic synapse
-        subtree_index, section_num, x = SOMA_LABEL, 0, 0
+    subtree_section = mapping_sections_to_subtree_index.get(synapse_or_segment.sec)
+    if subtree_section is None or subtree_section.section_type not in ("apic", "dend"):  # somatic synapse
+        return SynapseLocation(SOMA_LABEL, 0, 0)
+
+    return SynapseLocation(subtree_section.subtree_index, subtree_section.section_num, synapse_or_segment.x)
 
-    return SynapseLocation(subtree_index, int(section_num), x)
+
+def find_synapse_locs(synapses_or_segments, mapping_sections_to_subtree_index):
+    ''' Returns the locations of the given synapse objects (or segments) as
+    arrays: the subtree index (-1 for somatic synapses), the section number and x'''
+    locations = [find_synapse_loc(synapse_or_segment, mapping_sections_to_subtree_index)
+                 for synapse_or_segment in synapses_or_segments]
+    subtree_index = np.array([-1 if location.subtree_index == SOMA_LABEL else location.subtree_index
+                              for location in locations], dtype=int)
+    section_num = np.array([location.section_num for location in locations], dtype=int)
+    x = np.array([location.x for location in locations], dtype=float)
+    return subtree_index, section_num, x
 
 
 def find_and_disconnect_axon(soma_ref):
@@ -210,6 +361,7 @@ def find_and_disconnect_axon(soma_ref):
     return axon_section, axon_parent, soma_axon_x
 
 
+@instrumentation.timed
 def create_segments_to_mech_vals(sections_to_delete,
                                  remove_mechs=True,
                                  exclude=EXCLUDE_MECHANISMS):
@@ -217,33 +369,17 @@ def create_segments_to_mech_vals(sections_to_delete,
        plus the values of those mechanisms. It also remove the mechanisms from the model in order to
        create a passive model
 
+       The mapping is a MechanismSnapshot, which keeps the values per
+       mechanism in arrays and can also be used as the segment ->
+       {mechanism: {parameter: value}} dict
+
        Arguments:
            remove_mechs - False|True
                if True remove the mechs after creating the mapping, False - keep the mechs
            exclude - List of all the mechs name that should not be removed
        '''
-    exclude = set(exclude)
-    segment_to_mech_vals, mech_names = {}, set()
-
-    for seg in it.chain.from_iterable(sections_to_delete):
-        segment_to_mech_vals[seg] = {}
-        for mech in seg:
-            mech_name = mech.name()
-            if mech_name=='extracellular':
-              continue
-            segment_to_mech_vals[seg][mech_name] = {}
-            for n in dir(mech):
-                if n.startswith('__') or n in ('next', 'name', 'is_ion', 'segment', ):
-                    continue
-
-                if not n.endswith('_' + mech_name) and not mech_name.endswith('_ion'):
-                    n += '_' + mech_name
-                    
-                segment_to_mech_vals[seg][mech_name][n] = getattr(seg, n)
-                mech_names.add(mech_name)
-                
-#    print(segment_to_mech_vals)
-    mech_names -= exclude
+    segment_to_mech_vals = MechanismSnapshot.from_sections(sections_to_delete)
+    mech_names = set(segment_to_mech_vals.mechanism_names) - set(exclude)
 
     if remove_mechs:  # Remove all the mechs from the sections
         for sec in sections_to_delete:
@@ -254,6 +390,7 @@ def create_segments_to_mech_vals(sections_to_delete,
     return segment_to_mech_vals
 
 
+@instrumentation.timed
 def create_seg_to_seg(original_cell,
                       section_per_subtree_index,
                       roots_of_subtrees,
@@ -264,7 +401,8 @@ def create_seg_to_seg(original_cell,
                       basals,
                       subtree_ind_to_q,
                       mapping_type,
-                      reduction_frequency):
+                      reduction_frequency,
+                      impedance_cache=None):
     '''create mapping between segments in the original model to segments in the reduced model
 
        if mapping_type == impedance the mapping will be a response to the
@@ -274,73 +412,75 @@ def create_seg_to_seg(original_cell,
        distance of each segment to the soma (like the synapses) NOT IMPLEMENTED
        YET
 
+       impedance_cache - an ImpedanceCache shared with merge_and_add_synapses,
+       so the impedance of each subtree is computed only once
+
        '''
 
     assert mapping_type == 'impedance', 'distance mapping not implemented yet'
+    if impedance_cache is None:
+        impedance_cache = ImpedanceCache()
     # the keys are the segments of the original model, the values are the
     # segments of the reduced model
     original_seg_to_reduced_seg = {}
     reduced_seg_to_original_seg = collections.defaultdict(list)
     for subtree_index in section_per_subtree_index:
-        for sec in section_per_subtree_index[subtree_index]:
-            for seg in sec:
-                synapse_location = find_synapse_loc(seg, mapping_sections_to_subtree_index)
-                imp_obj, subtree_input_impedance = measure_input_impedance_of_subtree(
-                    roots_of_subtrees[subtree_index], reduction_frequency)
-
-                # if synapse is on the apical subtree
-                on_basal_subtree = not (has_apical and subtree_index == 0)
-
-                mid_of_segment_loc = reduce_synapse(
-                    original_cell,
-                    synapse_location,
-                    on_basal_subtree,
-                    imp_obj,
-                    subtree_input_impedance,
-                    new_cable_properties[subtree_index].electrotonic_length,
-                    subtree_ind_to_q[subtree_index])
-
-                if on_basal_subtree:
-                    if has_apical:
-                        new_section_for_synapse = basals[subtree_index - 1]
-                    else:
-                        new_section_for_synapse = basals[subtree_index]
-                else:
-                    new_section_for_synapse = apic
-
-                reduced_seg = new_section_for_synapse(mid_of_segment_loc)
-                original_seg_to_reduced_seg[seg] = reduced_seg
-                reduced_seg_to_original_seg[reduced_seg].append(seg)
+        impedance_table = impedance_cache.impedance_table(roots_of_subtrees[subtree_index],
+                                                          reduction_frequency)
+
+        # if synapse is on the apical subtree
+        on_basal_subtree = not (has_apical and subtree_index == 0)
+
+        if on_basal_subtree:
+            if has_apical:
+                new_section_for_synapse = basals[subtree_index - 1]
+            else:
+                new_section_for_synapse = basals[subtree_index]
+        else:
+            new_section_for_synapse = apic
+
+        segments = [seg for sec in section_per_subtree_index[subtree_index] for seg in sec]
+        mid_of_segment_locs = reduce_synapses(
+            impedance_table,
+            [seg.sec for seg in segments],
+            [seg.x for seg in segments],
+            new_cable_properties[subtree_index].electrotonic_length,
+            subtree_ind_to_q[subtree_index])
+
+        for seg, mid_of_segment_loc in zip(segments, mid_of_segment_locs):
+            reduced_seg = new_section_for_synapse(mid_of_segment_loc)
+            original_seg_to_reduced_seg[seg] = reduced_seg
+            reduced_seg_to_original_seg[reduced_seg].append(seg)
 
     return original_seg_to_reduced_seg, dict(reduced_seg_to_original_seg)
 
 
-def copy_dendritic_mech(original_seg_to_reduced_seg,
-                        reduced_seg_to_original_seg,
-                        apic,
-                        basals,
-                        segment_to_mech_vals,
-                        mapping_type='impedance'):
-    ''' copies the mechanisms from the original model to the reduced model'''
+def aggregate_dendritic_mech(reduced_seg_to_original_seg, all_segments, segment_to_mech_vals, reducer='mean'):
+    '''returns a MechanismSnapshot of all_segments with the mechanisms of the
+    original segments mapped to every one of them, aggregated with the given reducer
 
-    # copy mechanisms
-    # this is needed for the case where some segements were not been mapped
-    mech_names_per_segment = collections.defaultdict(list)
-    vals_per_mech_per_segment = {}
+    (see mechanism_snapshot.REDUCERS, the default averages every parameter over
+    the original segments that have its mechanism)
+    '''
+    reduced_index = {seg: i for i, seg in enumerate(all_segments)}
+    original_index, group_index = [], []
     for reduced_seg, original_segs in reduced_seg_to_original_seg.items():
-        vals_per_mech_per_segment[reduced_seg] = collections.defaultdict(list)
-
         for original_seg in original_segs:
-            for mech_name, mech_params in segment_to_mech_vals[original_seg].items():
-                for param_name, param_value in mech_params.items():
-                    vals_per_mech_per_segment[reduced_seg][param_name].append(param_value)
+            original_index.append(segment_to_mech_vals.segment_index(original_seg))
+            group_index.append(reduced_index[reduced_seg])
 
-                mech_names_per_segment[reduced_seg].append(mech_name)
-                reduced_seg.sec.insert(mech_name)
+    return segment_to_mech_vals.aggregate(original_index, group_index, all_segments, reducer)
 
-        for param_name, param_values in vals_per_mech_per_segment[reduced_seg].items():
-            setattr(reduced_seg, param_name, np.mean(param_values))
 
+@instrumentation.timed
+def copy_dendritic_mech(original_seg_to_reduced_seg,
+                        reduced_seg_to_original_seg,
+                        apic,
+                        basals,
+                        segment_to_mech_vals,
+                        mapping_type='impedance',
+                        reducer='mean'):
+    ''' copies the mechanisms from the original model to the reduced model'''
     all_segments = []
     if apic is not None:
         all_segments.extend(list(apic))
@@ -348,84 +488,88 @@ def copy_dendritic_mech(original_seg_to_reduced_seg,
     for bas in basals:
         all_segments.extend(list(bas))
 
+    reduced_mech_vals = aggregate_dendritic_mech(reduced_seg_to_original_seg,
+                                                 all_segments,
+                                                 segment_to_mech_vals,
+                                                 reducer)
+
     if len(all_segments) != len(reduced_seg_to_original_seg):
         logger.warning('There is no segment to segment copy, it means that some segments in the'
                     'reduced model did not receive channels from the original cell.'
                     'Trying to compensate by copying channels from neighboring segments')
-        handle_orphan_segments(original_seg_to_reduced_seg,
-                               all_segments,
-                               vals_per_mech_per_segment,
-                               mech_names_per_segment)
-
-
-def handle_orphan_segments(original_seg_to_reduced_seg,
-                           all_segments,
-                           vals_per_mech_per_segment,
-                           mech_names_per_segment):
-    ''' This function handle reduced segments that did not had original segments mapped to them'''
-    # Get all reduced segments that have been mapped by a original model segment
-    all_mapped_control_segments = original_seg_to_reduced_seg.values()
-    non_mapped_segments = set(all_segments) - set(all_mapped_control_segments)
-
-    for reduced_seg in non_mapped_segments:
-        seg_secs = list(reduced_seg.sec)
-        # find valid parent
-        parent_seg_index = seg_secs.index(reduced_seg) - 1
-        parent_seg = None
-        while parent_seg_index > -1:
-            if seg_secs[parent_seg_index] in all_mapped_control_segments:
-                parent_seg = seg_secs[parent_seg_index]
-                break
-            else:
-                parent_seg_index -= 1
-
-        # find valid child
-        child_seg_index = seg_secs.index(reduced_seg) + 1
-        child_seg = None
-        while child_seg_index < len(seg_secs):
-            if seg_secs[child_seg_index] in all_mapped_control_segments:
-                child_seg = seg_secs[child_seg_index]
-                break
-            else:
-                child_seg_index += 1
-
-        if not parent_seg and not child_seg:
-            raise Exception("no child seg nor parent seg, with active channels, was found")
-
-        if parent_seg and not child_seg:
-            for mech in mech_names_per_segment[parent_seg]:
-                reduced_seg.sec.insert(mech)
-            for n in vals_per_mech_per_segment[parent_seg]:
-                setattr(reduced_seg, n, np.mean(vals_per_mech_per_segment[parent_seg][n]))
-
-        if not parent_seg and child_seg:
-            for mech in mech_names_per_segment[child_seg]:
-                reduced_seg.sec.insert(mech)
-            for n in vals_per_mech_per_segment[child_seg]:
-                setattr(reduced_seg, n, np.mean(vals_per_mech_per_segment[child_seg][n]))
-
-        # if both parent and child were found, we add to the segment all the mech in both
-        # this is just a decision
-
-        if parent_seg and child_seg:
-            for mech in set(mech_names_per_segment[child_seg]) & set(mech_names_per_segment[parent_seg]):
-                reduced_seg.sec.insert(mech)
-
-            for n in vals_per_mech_per_segment[child_seg]:
-                child_mean = np.mean(vals_per_mech_per_segment[child_seg][n])
-                if n in vals_per_mech_per_segment[parent_seg]:
-                    parent_mean = np.mean(vals_per_mech_per_segment[parent_seg][n])
-                    setattr(reduced_seg, n, (child_mean + parent_mean) / 2)
-                else:
-                    setattr(reduced_seg, n, child_mean)
-
-            for n in vals_per_mech_per_segment[parent_seg]:
-                parent_mean = np.mean(vals_per_mech_per_segment[parent_seg][n])
-                if n in vals_per_mech_per_segment[child_seg]:
-                    child_mean = np.mean(vals_per_mech_per_segment[child_seg][n])
-                    setattr(reduced_seg, n, (child_mean + parent_mean) / 2)
-                else:
-                    setattr(reduced_seg, n, parent_mean)
+        mapped = np.array([seg in reduced_seg_to_original_seg for seg in all_segments])
+        reduced_mech_vals = handle_orphan_segments(reduced_mech_vals, mapped)
+
+    with instrumentation.stage('apply_mechanisms'):
+        reduced_mech_vals.apply()
+
+
+def _nearest_mapped_neighbors(section_names, mapped):
+    '''returns, for every segment, the index of the nearest mapped segment
+    before it and after it in the same section (-1 if there is none)
+
+    section_names - the section of every segment, the segments of a section are consecutive
+    '''
+    n = len(mapped)
+    positions = np.arange(n)
+    first_of_section = np.ones(n, dtype=bool)
+    first_of_section[1:] = section_names[1:] != section_names[:-1]
+    last_of_section = np.ones(n, dtype=bool)
+    last_of_section[:-1] = first_of_section[1:]
+    section_start = np.maximum.accumulate(np.where(first_of_section, positions, 0))
+    section_end = np.minimum.accumulate(np.where(last_of_section, positions, n - 1)[::-1])[::-1]
+
+    parent = np.maximum.accumulate(np.where(mapped, positions, -1))
+    parent[parent < section_start] = -1
+    child = np.minimum.accumulate(np.where(mapped, positions, n)[::-1])[::-1]
+    child[child > section_end] = -1
+    return parent, child
+
+
+def handle_orphan_segments(reduced_mech_vals, mapped):
+    ''' This function handle reduced segments that did not had original segments mapped to them
+
+    reduced_mech_vals - MechanismSnapshot of all the reduced segments (as
+    aggregated from the original segments), mapped - boolean array, True for the
+    reduced segments that had original segments mapped to them
+
+    every orphan gets the values of the nearest mapped segment before it (parent)
+    and after it (child) in its section; parameters both have are averaged.
+    Returns a new MechanismSnapshot with the orphans filled in
+    '''
+    mapped = np.asarray(mapped, dtype=bool)
+    parent, child = _nearest_mapped_neighbors(np.asarray(reduced_mech_vals.section_names), mapped)
+    orphans = np.flatnonzero(~mapped)
+    if np.any((parent[orphans] < 0) & (child[orphans] < 0)):
+        raise Exception("no child seg nor parent seg, with active channels, was found")
+    instrumentation.count('orphan_segments_filled', len(orphans))
+
+    mechanisms = collections.OrderedDict()
+    for mech_name, columns in reduced_mech_vals.mechanisms.items():
+        row_of_segment = np.full(len(mapped), -1)
+        row_of_segment[columns.segment_index] = np.arange(len(columns.segment_index))
+        parent_row = np.where(parent[orphans] >= 0, row_of_segment[parent[orphans]], -1)
+        child_row = np.where(child[orphans] >= 0, row_of_segment[child[orphans]], -1)
+        has_parent = (parent_row >= 0)[:, None]
+        has_child = (child_row >= 0)[:, None]
+
+        # if both parent and child were found, the orphan gets the mean of the
+        # two, this is just a decision
+        summed = (np.where(has_parent, columns.values[parent_row], 0) +
+                  np.where(has_child, columns.values[child_row], 0))
+        count = has_parent.astype(int) + has_child
+        filled = count[:, 0] > 0
+
+        segment_index = np.concatenate([columns.segment_index, orphans[filled]])
+        values = np.concatenate([columns.values, summed[filled] / count[filled]])
+        order = np.argsort(segment_index, kind='stable')
+        mechanisms[mech_name] = columns._replace(segment_index=segment_index[order], values=values[order])
+
+    return MechanismSnapshot(section_names=reduced_mech_vals.section_names,
+                             segment_x=reduced_mech_vals.segment_x,
+                             segment_area=reduced_mech_vals.segment_area,
+                             mechanisms=mechanisms,
+                             segments=reduced_mech_vals.segments)
 
 
 def add_PP_properties_to_dict(PP, PP_params_dict):
@@ -433,47 +577,14 @@ def add_PP_properties_to_dict(PP, PP_params_dict):
     add the properties of a point process to PP_params_dict.
     The only properties added to the dictionary are those worth comparing
     attributes not worth comparing are not synapse properties or do not differ in value.
+    (see point_process_params.comparable_params)
     """
-    skipped_params = {
-        "Section", "allsec", "baseattr", "cas", "g", "get_loc", "has_loc", "hname",
-        'hocobjptr', "i", "loc", "next", "ref", "same", "setpointer", "state",
-        "get_segment", "DA1", "eta", "omega", "DA2", "NEn", "NE2", "GAP1", "unirand", "randGen", "sfunc", "erand", 
-        "randObjPtr", "A_AMPA", "A_NMDA", "B_AMPA", "B_NMDA", "D1", "D2", "F", "P", "W_nmda", "facfactor", "g_AMPA", "g_NMDA", "iampa", "inmda", "on_ampa", "on_nmda", "random",  "thr_rp","AlphaTmax_gaba", "Beta_gaba", "Cainf", "Cdur_gaba", "Erev_gaba", "ICag", "Icatotal", "P0g", "W", "capoolcon", "destid", "fCag", "fmax", "fmin", "g_gaba", "gbar_gaba", "igaba", "limitW", "maxChange", "neuroM", "normW", "on_gaba", "pooldiam", "postgid", "pregid", "r_gaba", "r_nmda", "scaleW", "srcid", "tauCa", "type", "z",
-        "d1", "gbar_ampa", "gbar_nmda","tau_d_AMPA","tau_d_NMDA","tau_r_AMPA","tau_r_NMDA","Erev_ampa","Erev_nmda", "lambda1", "lambda2", "threshold1", "threshold2",
-    }
-
-    syn_params_list = {
-        "tau_r_AMPA", "tau_r_NMDA", "Use", "Dep", "Fac", "e", "u0", "initW", "taun1", "taun2", "gNMDAmax", "enmda", "taua1", "taua2", "gAMPAmax", "eampa", "AlphaTmax_ampa", "Beta_ampa", "Cdur_ampa", "AlphaTmax_nmda", "Beta_nmda", "Cdur_nmda", "initW_random", "Wmax", "Wmin", "tauD1", "tauD2", "f", "tauF", "P_0", "d2",
-    }
+    PP_params_dict[type_of_point_process(PP)] = comparable_params(PP)
 
-    PP_params = [param for param in dir(PP) if not (param.startswith("__") or callable(getattr(PP, param)))]
 
-    PP_params = list(filter(lambda x: x not in skipped_params, PP_params))
-
-    syn_params = list(filter(lambda x: x in syn_params_list, PP_params))
-
-
-    PP_params_dict[type_of_point_process(PP)] = syn_params
-
-
-def type_of_point_process(PP):
-    s = PP.hname()
-    ix = PP.hname().find("[")
-    return s[:ix]
-
-
-def apply_params_to_section(name, type_of_sectionlist, instance_as_str, section, cable_params, nseg):
-    section.L = cable_params.length
-    section.diam = cable_params.diam
-    section.nseg = nseg
-
-    append_to_section_lists(name, type_of_sectionlist, instance_as_str)
-
-    section.insert('pas')
-    section.cm = cable_params.cm
-    section.g_pas = 1.0 / cable_params.rm
-    section.Ra = cable_params.ra
-    section.e_pas = cable_params.e_pas
+def apply_params_to_section(name, type_of_sectionlist, instance, section, cable_params, nseg):
+    set_cable_params(section, cable_params, nseg)
+    append_to_section_lists(section, type_of_sectionlist, instance)
 
 
 def calculate_subtree_q(root, reduction_frequency):
@@ -486,15 +597,50 @@ def calculate_subtree_q(root, reduction_frequency):
     return q_subtree
 
 
-def synapse_properties_match(synapse, PP, PP_params_dict):
-    if PP.hname()[:PP.hname().rindex('[')] != synapse.hname()[:synapse.hname().rindex('[')]:
-        return False
-    for param in PP_params_dict[type_of_point_process(PP)]:
-        if(param not in ['rng'] and  # https://github.com/neuronsimulator/nrn/issues/136
-           str(type(getattr(PP, param))) != "<type 'hoc.HocObject'>" and  # ignore hoc objects
-           getattr(PP, param) != getattr(synapse, param)):
-            return False
-    return True
+def segment_index(section, x):
+    '''the index of the segment of the section at x (-1 and nseg for the 0 and 1 end nodes)'''
+    if x <= 0:
+        return -1
+    if x >= 1:
+        return section.nseg
+    return min(int(x * section.nseg), section.nseg - 1)
+
+
+class SynapseMergeIndex(object):
+    '''index of the point processes that synapses can be merged into
+
+    Point processes are keyed by (section, segment index, point process type,
+    values of the compared parameters, see point_process_params), so finding
+    the point process a synapse merges into is a single dict lookup instead of a
+    scan of all the point processes in the target segment.
+
+    If seed_existing is True, the point processes that are already in a
+    segment are added to the index the first time the segment is looked up.
+    '''
+    def __init__(self, PP_params_dict, seed_existing=True):
+        self.pp_params = PointProcessParams(PP_params_dict)
+        self.seed_existing = seed_existing
+        self._index = {}
+        self._seeded_segments = set()
+
+    def _key(self, PP, section, x):
+        return (section, segment_index(section, x), type_of_point_process(PP), self.pp_params.values(PP))
+
+    def _seed(self, section, x):
+        segment = (section, segment_index(section, x))
+        if self.seed_existing and segment not in self._seeded_segments:
+            self._seeded_segments.add(segment)
+            for PP in section(x).point_processes():
+                self._index.setdefault(self._key(PP, section, x), PP)
+
+    def add(self, PP, section, x):
+        '''registers a point process located at (section, x)'''
+        self._index.setdefault(self._key(PP, section, x), PP)
+
+    def find(self, synapse, section, x):
+        '''returns the point process at the segment of (section, x) that the synapse can be merged into, or None'''
+        self._seed(section, x)
+        return self._index.get(self._key(synapse, section, x))
 
 
 def load_model(model_filename):
@@ -511,6 +657,7 @@ def load_model(model_filename):
     return model_obj_name
 
 
+@instrumentation.timed
 def gather_subtrees(soma_ref):
     '''get all the subtrees of the soma
 
@@ -545,10 +692,11 @@ def gather_subtrees(soma_ref):
     return roots_of_subtrees, num_of_subtrees
 
 
+@instrumentation.timed
 def gather_cell_subtrees(roots_of_subtrees):
-    # dict that maps section indexes to the subtree index they are in: keys are
-    # string tuples: ("apic"/"basal", orig_section_index) , values are ints:
-    # subtree_instance_index
+    # dict that maps the sections to the subtree they are in: keys are the
+    # sections, values are SubtreeSection("apic"/"basal", section type,
+    # orig_section_index, subtree_instance_index)
     sections_to_delete = []
     section_per_subtree_index = {}
     mapping_sections_to_subtree_index = {}
@@ -575,6 +723,7 @@ def gather_cell_subtrees(roots_of_subtrees):
     return sections_to_delete, section_per_subtree_index, mapping_sections_to_subtree_index
 
 
+@instrumentation.timed
 def create_reduced_cell(soma_cable,
                         has_apical,
                         original_cell,
@@ -584,53 +733,37 @@ def create_reduced_cell(soma_cable,
                         subtrees_xs):
     h("objref reduced_cell")
     h("reduced_cell = new " + model_obj_name + "()")
+    reduced_cell = h.reduced_cell
 
-    create_sections_in_hoc("soma", 1, "reduced_cell")
+    create_sections_in_hoc("soma", 1, reduced_cell)
 
     soma = original_cell.soma[0]
       
-    append_to_section_lists("soma[0]", "somatic", "reduced_cell")
+    append_to_section_lists(reduced_cell.soma[0], "somatic", reduced_cell)
 
     if has_apical:  # creates reduced apical cable if apical subtree existed
-        create_sections_in_hoc("apic", 1, "reduced_cell")
-        apic = h.reduced_cell.apic[0]
-        num_of_basal_subtrees = len(new_cable_properties) - 1
-
-        cable_params = new_cable_properties[0]
-        nseg = new_cables_nsegs[0]
-        apply_params_to_section("apic[0]", "apical", "reduced_cell",
-                                apic, cable_params, nseg)
+        apic, = build_cables(reduced_cell, "apic", "apical", new_cable_properties[:1], new_cables_nsegs[:1])
         apic.connect(soma, subtrees_xs[0], 0)
+        first_basal = 1
     else:
         apic = None
-        num_of_basal_subtrees = len(new_cable_properties)
+        first_basal = 0
 
     # creates reduced basal cables
-    create_sections_in_hoc("dend", num_of_basal_subtrees, "reduced_cell")
-    basals = [h.reduced_cell.dend[i] for i in range(num_of_basal_subtrees)]
-
-    for i in range(num_of_basal_subtrees):
-        if has_apical:
-            index_in_reduced_cables_dimensions = i + 1
-        else:
-            index_in_reduced_cables_dimensions = i
-
-        cable_params = new_cable_properties[index_in_reduced_cables_dimensions]
-        nseg = new_cables_nsegs[index_in_reduced_cables_dimensions]
-
-        apply_params_to_section("dend[" + str(i) + "]", "basal", "reduced_cell",
-                                basals[i], cable_params, nseg)
-
-        basals[i].connect(soma, subtrees_xs[index_in_reduced_cables_dimensions], 0)
+    basals = build_cables(reduced_cell, "dend", "basal",
+                          new_cable_properties[first_basal:], new_cables_nsegs[first_basal:])
+    for basal, subtree_x in zip(basals, subtrees_xs[first_basal:]):
+        basal.connect(soma, subtree_x, 0)
 
     # create cell python template
-    cell = Neuron(h.reduced_cell)
+    cell = Neuron(reduced_cell)
     cell.soma = original_cell.soma[0]
     cell.apic = apic
 
     return cell, basals
 
 
+@instrumentation.timed
 def merge_and_add_synapses(num_of_subtrees,
                            new_cable_properties,
                            PP_params_dict,
@@ -642,7 +775,11 @@ def merge_and_add_synapses(num_of_subtrees,
                            original_cell,
                            basals,
                            cell,
-                           reduction_frequency):
+                           reduction_frequency,
+                           impedance_cache=None):
+    if impedance_cache is None:
+        impedance_cache = ImpedanceCache()
+
     # dividing the original synapses into baskets, so that all synapses that are
     # on the same subtree will be together in the same basket
 
@@ -651,83 +788,80 @@ def merge_and_add_synapses(num_of_subtrees,
     baskets = [[] for _ in num_of_subtrees]
     soma_synapses_syn_to_netcon = {}
 
+    synapse_segments = [synapse.get_segment() for synapse in synapses_list]
+    synapse_subtree_index, _, synapse_x = find_synapse_locs(synapse_segments, mapping_sections_to_subtree_index)
     for syn_index, synapse in enumerate(synapses_list):
-        synapse_location = find_synapse_loc(synapse, mapping_sections_to_subtree_index)
-
-        # for a somatic synapse
-        # TODO: 'axon' is never returned by find_synapse_loc...
-        if synapse_location.subtree_index in (SOMA_LABEL, 'axon'):
+        # for a somatic (or axonal) synapse
+        if synapse_subtree_index[syn_index] < 0:
             soma_synapses_syn_to_netcon[synapse] = netcons_list[syn_index]
         else:
-            baskets[synapse_location.subtree_index].append((synapse, synapse_location, syn_index))
+            baskets[synapse_subtree_index[syn_index]].append((synapse, syn_index))
 
     # mapping (non-somatic) synapses to their new location on the reduced model
     # (the new location is the exact location of the middle of the segment they
     # were mapped to, in order to enable merging)
     new_synapses_list, subtree_ind_to_q = [], {}
+    num_of_merged = 0
+    merge_index = SynapseMergeIndex(PP_params_dict)
     for subtree_index in num_of_subtrees:
-        imp_obj, subtree_input_impedance = measure_input_impedance_of_subtree(
-            roots_of_subtrees[subtree_index], reduction_frequency)
+        impedance_table = impedance_cache.impedance_table(roots_of_subtrees[subtree_index],
+                                                          reduction_frequency)
         subtree_ind_to_q[subtree_index] = calculate_subtree_q(
             roots_of_subtrees[subtree_index], reduction_frequency)
 
-        # iterates over the synapses in the curr basket
-        for synapse, synapse_location, syn_index in baskets[subtree_index]:
-            on_basal_subtree = not (has_apical and subtree_index == 0)
-
-            # "reduces" the synapse - finds this synapse's new "merged"
-            # location on its corresponding reduced cable
-            x = reduce_synapse(original_cell,
-                               synapse_location,
-                               on_basal_subtree,
-                               imp_obj,
-                               subtree_input_impedance,
-                               new_cable_properties[subtree_index].electrotonic_length,
-                               subtree_ind_to_q[subtree_index])
-
-            # find the section of the synapse
-            if on_basal_subtree:
-                if has_apical:
-                    section_for_synapse = basals[subtree_index - 1]
-                else:
-                    section_for_synapse = basals[subtree_index]
+        on_basal_subtree = not (has_apical and subtree_index == 0)
+
+        # "reduces" the synapses of the curr basket - finds each synapse's new
+        # "merged" location on its corresponding reduced cable
+        new_xs = reduce_synapses(impedance_table,
+                                 [synapse_segments[syn_index].sec for _, syn_index in baskets[subtree_index]],
+                                 synapse_x[[syn_index for _, syn_index in baskets[subtree_index]]],
+                                 new_cable_properties[subtree_index].electrotonic_length,
+                                 subtree_ind_to_q[subtree_index])
+
+        # find the section of the synapses
+        if on_basal_subtree:
+            if has_apical:
+                section_for_synapse = basals[subtree_index - 1]
             else:
-                section_for_synapse = cell.apic
+                section_for_synapse = basals[subtree_index]
+        else:
+            section_for_synapse = cell.apic
 
-            # go over all point processes in this segment and see whether one
-            # of them has the same proporties of this synapse
+        # iterates over the synapses in the curr basket
+        for (synapse, syn_index), x in zip(baskets[subtree_index], new_xs):
+            # look for a point process in this segment that has the same
+            # proporties of this synapse
             # If there's such a synapse link the original NetCon with this point processes
             # If not, move the synapse to this segment.
-            for PP in section_for_synapse(x).point_processes():
-                if type_of_point_process(PP) not in PP_params_dict:
-                    add_PP_properties_to_dict(PP, PP_params_dict)
-
-                if synapse_properties_match(synapse, PP, PP_params_dict):
-                    netcons_list[syn_index].setpost(PP)
-                    break
-            else:  # If for finish the loop -> first appearance of this synapse 
+            PP = merge_index.find(synapse, section_for_synapse, x)
+            if PP is not None:
+                netcons_list[syn_index].setpost(PP)
+                num_of_merged += 1
+            else:  # first appearance of this synapse
                 x=Decimal(str(x)) # patch error for passing float to synapse.loc
                 #print("x:",x,"type:",type(x),"|section_for_synapse:",section_for_synapse,"type:",type(section_for_synapse),"|synapse:",synapse,"type:",type(synapse))
                 synapse.loc(x, sec=section_for_synapse)
+                merge_index.add(synapse, section_for_synapse, float(x))
                 new_synapses_list.append(synapse)
 
     # merging somatic and axonal synapses
-    synapses_per_seg = collections.defaultdict(list)
+    soma_merge_index = SynapseMergeIndex(PP_params_dict, seed_existing=False)
     for synapse in soma_synapses_syn_to_netcon:
         seg_pointer = synapse.get_segment()
 
-        for PP in synapses_per_seg[seg_pointer]:
-            if type_of_point_process(PP) not in PP_params_dict:
-                add_PP_properties_to_dict(PP, PP_params_dict)
-
-            if synapse_properties_match(synapse, PP, PP_params_dict):
-                soma_synapses_syn_to_netcon[synapse].setpost(PP)
-                break
-        else:  # If for finish the loop -> first appearance of this synapse
+        PP = soma_merge_index.find(synapse, seg_pointer.sec, seg_pointer.x)
+        if PP is not None:
+            soma_synapses_syn_to_netcon[synapse].setpost(PP)
+            num_of_merged += 1
+        else:  # first appearance of this synapse
             synapse.loc(seg_pointer.x, sec=seg_pointer.sec)
             new_synapses_list.append(synapse)
-            synapses_per_seg[seg_pointer].append(synapse)
+            soma_merge_index.add(synapse, seg_pointer.sec, seg_pointer.x)
 
+    instrumentation.count('synapses_moved', len(new_synapses_list))
+    instrumentation.count('synapses_merged', num_of_merged)
+    instrumentation.count('netcons_repointed', num_of_merged)
     return new_synapses_list, subtree_ind_to_q
 
 def textify_seg_to_seg(segs):
@@ -735,6 +869,7 @@ def textify_seg_to_seg(segs):
     ret = {str(k): str(v) for k, v in segs.items()}
     return ret
    
+@instrumentation.profiled
 def subtree_reductor(original_cell,
                      synapses_list,
                      netcons_list,
@@ -743,7 +878,12 @@ def subtree_reductor(original_cell,
                      total_segments_manual=-1,
                      PP_params_dict=None,
                      mapping_type='impedance',
-                     return_seg_to_seg=False
+                     return_seg_to_seg=False,
+                     plan_cache_dir=None,
+                     mechanism_reducer='mean',
+                     in_place=True,
+                     geometry_cache=None,
+                     nseg_policy=None
                      ):
 
     '''
@@ -776,6 +916,25 @@ def subtree_reductor(original_cell,
                            original_number_of_segments*total_segments_manual
     return_seg_to_seg: if True the function will also return a textify version of the mapping
                        between the original segments to the reduced segments 
+    plan_cache_dir: if given, the reduction plan (cable dimensions, synapse
+                    locations and merges, segment mapping) is stored in this
+                    directory, keyed by the morphology, biophysics, synapses and
+                    arguments, and reducing the same cell again only replays it
+    mechanism_reducer: how the mechanism values of the original segments mapped to
+                       a reduced segment are combined - 'mean', 'area_weighted_mean',
+                       'max' (see mechanism_snapshot.REDUCERS) or a reducer function
+    in_place: if False, the cell, synapses and netcons are copied (see
+              cell_copy.copy_cell) and the copies are reduced, so the original
+              model is left untouched and can be simulated alongside the reduced one
+    geometry_cache: a dict shared between calls (see population.reduce_population),
+                    the reduced cables, the segment mapping and the impedances of
+                    the subtrees are computed once per morphology, biophysics
+                    and reduction arguments, and every other cell only maps its synapses
+    nseg_policy: None (a segment for every 0.1 lambda, see above), or a DLambdaPolicy
+                 to segment the cables by their AC length constant at a given frequency,
+                 with a given d_lambda or error budget (see calculate_nsegs_from_d_lambda);
+                 frequency_sweep.predict_nsegs gives the resulting numbers of segments
+                 without reducing the cell
 
 
     Returns the new reduced cell, a list of the new synapses, and the list of
@@ -783,7 +942,8 @@ def subtree_reductor(original_cell,
 
     Notes:
     1) The original cell instance, synapses and Netcons given as arguments are altered
-    by the function and cannot be used outside of it in their original context.
+    by the function and cannot be used outside of it in their original context
+    (unless in_place=False).
     2) Synapses are determined to be of the same type and mergeable if their reverse
     potential, tau1 and tau2 values are identical.
     3) Merged synapses are assigned a single new synapse object that represents them
@@ -794,6 +954,10 @@ def subtree_reductor(original_cell,
     if PP_params_dict is None:
         PP_params_dict = {}
 
+    if not in_place:
+        with instrumentation.stage('copy_cell'):
+            original_cell, synapses_list, netcons_list, _ = copy_cell(original_cell, synapses_list, netcons_list)
+
     h.init()
 
     model_obj_name = load_model(model_filename)
@@ -819,37 +983,65 @@ def subtree_reductor(original_cell,
     # remove active conductances and get seg_to_mech dictionary
     segment_to_mech_vals = create_segments_to_mech_vals(sections_to_delete)
 
+    plan = None
+    if plan_cache_dir is not None:
+        # the merging of synapses compares these parameters, so they are part of the key
+        for synapse in synapses_list:
+            if type_of_point_process(synapse) not in PP_params_dict:
+                add_PP_properties_to_dict(synapse, PP_params_dict)
+        plan_key = reduction_plan_key(soma, sections_to_delete, segment_to_mech_vals, synapses_list,
+                                      PP_params_dict, reduction_frequency, total_segments_manual,
+                                      mapping_type, nseg_policy, netcons_list)
+        plan = load_reduction_plan(plan_cache_dir, plan_key)
+        if plan is not None and not plan_matches(plan, synapses_list, netcons_list):
+            logger.warning("the reduction plan %s does not match the synapses and NetCons, "
+                           "reducing the cell again" % plan_key)
+            plan = None
+
+    geometry = None
+    if plan is None and geometry_cache is not None:
+        # the reduced cables do not depend on the synapses, cells with the same
+        # morphology and biophysics share them
+        geometry_key = reduction_plan_key(soma, sections_to_delete, segment_to_mech_vals, [], {},
+                                          reduction_frequency, total_segments_manual, mapping_type,
+                                          nseg_policy)
+        geometry = geometry_cache.get(geometry_key)
+
     # disconnects all the subtrees from the soma
     subtrees_xs = []
     for subtree_root in roots_of_subtrees:
         subtrees_xs.append(subtree_root.parentseg().x)
         h.disconnect(sec=subtree_root)
 
-    # reducing the subtrees
-    new_cable_properties = [reduce_subtree(roots_of_subtrees[i], reduction_frequency)
-                            for i in num_of_subtrees]
+    # reducing the subtrees, the impedance of every subtree is computed once
+    # and shared by all the stages below
+    impedance_cache = ImpedanceCache()
+    if plan is None and geometry is None:
+        with instrumentation.stage('reduce_subtree'):
+            new_cable_properties = [reduce_subtree(roots_of_subtrees[i], reduction_frequency, impedance_cache)
+                                    for i in num_of_subtrees]
 
-    if total_segments_manual > 1:
-        new_cables_nsegs = calculate_nsegs_from_manual_arg(new_cable_properties,
-                                                           total_segments_manual)
+        original_cell_seg_n = (sum(i.nseg for i in list(original_cell.basal)) +
+                               sum(i.nseg for i in list(original_cell.apical))
+                               )
+        new_cables_nsegs = calculate_nsegs(new_cable_properties, total_segments_manual, original_cell_seg_n,
+                                           nseg_policy)
+    elif plan is None:
+        logger.debug("reusing the reduced geometry %s" % geometry_key)
+        instrumentation.count('geometry_cache_hits')
+        new_cable_properties, new_cables_nsegs = geometry['cable_params'], geometry['nsegs']
+        for subtree_root, impedance_table in zip(roots_of_subtrees, geometry['impedance_tables']):
+            impedance_cache.add_table(subtree_root,
+                                      reduction_frequency,
+                                      impedance_table.with_sections(subtree_sections(subtree_root)))
     else:
-        new_cables_nsegs = calculate_nsegs_from_lambda(new_cable_properties)
-        if total_segments_manual > 0:
-            original_cell_seg_n = (sum(i.nseg for i in list(original_cell.basal)) +
-                                   sum(i.nseg for i in list(original_cell.apical))
-                                   )
-            min_reduced_seg_n = int(round((total_segments_manual * original_cell_seg_n)))
-            if sum(new_cables_nsegs) < min_reduced_seg_n:
-                logger.debug("number of segments calculated using lambda is {}, "
-                      "the original cell had {} segments.  "
-                      "The min reduced segments is set to {}% of reduced cell segments".format(
-                          sum(new_cables_nsegs),
-                          original_cell_seg_n,
-                          total_segments_manual * 100))
-                logger.debug("the reduced cell nseg is set to %s" % min_reduced_seg_n)
-                new_cables_nsegs = calculate_nsegs_from_manual_arg(new_cable_properties,
-                                                                   min_reduced_seg_n)
+        logger.debug("replaying the cached reduction plan %s" % plan_key)
+        instrumentation.count('plan_cache_hits')
+        new_cable_properties, new_cables_nsegs = plan['cable_params'], plan['nsegs']
 
+    logger.info("the reduced cables will have %s segments (%d in total)" % (new_cables_nsegs,
+                                                                          sum(new_cables_nsegs)))
+    instrumentation.count('reduced_segments', sum(new_cables_nsegs))
     cell, basals = create_reduced_cell(soma_cable,
                                        has_apical,
                                        original_cell,
@@ -858,33 +1050,61 @@ def subtree_reductor(original_cell,
                                        new_cables_nsegs,
                                        subtrees_xs)
 
-    new_synapses_list, subtree_ind_to_q = merge_and_add_synapses(
-        num_of_subtrees,
-        new_cable_properties,
-        PP_params_dict,
-        synapses_list,
-        mapping_sections_to_subtree_index,
-        netcons_list,
-        has_apical,
-        roots_of_subtrees,
-        original_cell,
-        basals,
-        cell,
-        reduction_frequency)
-
-    # create segment to segment mapping
-    original_seg_to_reduced_seg, reduced_seg_to_original_seg = create_seg_to_seg(
-        original_cell,
-        section_per_subtree_index,
-        roots_of_subtrees,
-        mapping_sections_to_subtree_index,
-        new_cable_properties,
-        has_apical,
-        cell.apic,
-        basals,
-        subtree_ind_to_q,
-        mapping_type,
-        reduction_frequency)
+    cables = ([cell.apic] if has_apical else []) + basals
+    if plan is not None:
+        with instrumentation.stage('replay_synapses'):
+            new_synapses_list = replay_synapses(plan, synapses_list, netcons_list, cables)
+        original_seg_to_reduced_seg, reduced_seg_to_original_seg = replay_seg_to_seg(
+            plan, section_per_subtree_index, cables)
+    else:
+        new_synapses_list, subtree_ind_to_q = merge_and_add_synapses(
+            num_of_subtrees,
+            new_cable_properties,
+            PP_params_dict,
+            synapses_list,
+            mapping_sections_to_subtree_index,
+            netcons_list,
+            has_apical,
+            roots_of_subtrees,
+            original_cell,
+            basals,
+            cell,
+            reduction_frequency,
+            impedance_cache)
+
+        # create segment to segment mapping
+        if geometry is not None:
+            original_seg_to_reduced_seg, reduced_seg_to_original_seg = replay_seg_to_seg(
+                geometry, section_per_subtree_index, cables)
+        else:
+            original_seg_to_reduced_seg, reduced_seg_to_original_seg = create_seg_to_seg(
+                original_cell,
+                section_per_subtree_index,
+                roots_of_subtrees,
+                mapping_sections_to_subtree_index,
+                new_cable_properties,
+                has_apical,
+                cell.apic,
+                basals,
+                subtree_ind_to_q,
+                mapping_type,
+                reduction_frequency,
+                impedance_cache)
+
+        if geometry_cache is not None and geometry is None:
+            geometry_cache[geometry_key] = {
+                'cable_params': new_cable_properties,
+                'nsegs': new_cables_nsegs,
+                'seg_to_seg': record_seg_to_seg(section_per_subtree_index, original_seg_to_reduced_seg),
+                'impedance_tables': [impedance_cache.impedance_table(subtree_root, reduction_frequency)
+                                     for subtree_root in roots_of_subtrees]}
+
+        if plan_cache_dir is not None:
+            plan = {'cable_params': new_cable_properties,
+                    'nsegs': new_cables_nsegs,
+                    'seg_to_seg': record_seg_to_seg(section_per_subtree_index, original_seg_to_reduced_seg)}
+            plan.update(record_synapses(synapses_list, netcons_list, new_synapses_list, cables))
+            save_reduction_plan(plan_cache_dir, plan_key, plan)
 
     # copy active mechanisms
     copy_dendritic_mech(original_seg_to_reduced_seg,
@@ -892,7 +1112,8 @@ def subtree_reductor(original_cell,
                         cell.apic,
                         basals,
                         segment_to_mech_vals,
-                        mapping_type)
+                        mapping_type,
+                        mechanism_reducer)
     
     if return_seg_to_seg:
         original_seg_to_reduced_seg_text = textify_seg_to_seg(original_seg_to_reduced_seg)
@@ -905,12 +1126,16 @@ def subtree_reductor(original_cell,
             axon_section[0].connect(soma, soma_axon_x)
 
     # Now we delete the original model
-    for section in sections_to_delete:
-        with push_section(section):
-            h.delete_section()
+    impedance_cache.invalidate()
+    with instrumentation.stage('delete_sections'):
+        for section in sections_to_delete:
+            with push_section(section):
+                h.delete_section()
 
     cell.axon = axon_section
     cell.dend = cell.hoc_model.dend
+    if not in_place:
+        cell.cell_copy = original_cell  # keeps the copied soma and axon sections alive
 
     with push_section(cell.hoc_model.soma[0]):
         h.delete_section()